@@ -0,0 +1,80 @@
+"""
+Бенчмарк обращений к Redis через общий пул (src/dataBase/redis_pool.py): сколько команд в секунду и сколько
+обращений к серверу дают
+    * команды по одной, последовательно (одно обращение на команду);
+    * те же команды, отправленные параллельными корутинами напрямую в пул;
+    * параллельные корутины через CommandBatcher (команды, пришедшие, пока пачка в пути, уходят следующей пачкой);
+    * одна пачка pipeline_execute.
+Команды - EVALSHA скрипта лимита запросов (RedisTokenBuckets), как у middleware при параллельных запросах.
+
+Нужен Redis (переменные окружения как у API). Ключи bench:* удаляются в конце.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_redis [--commands 5000] [--concurrency 200]
+"""
+import argparse
+import asyncio
+import sys
+import time
+from typing import Awaitable, Callable, List
+from src.api.service.ratelimit import RedisTokenBuckets
+from src.dataBase.redis_pool import batcher, close_redis, get_redis, pipeline_execute
+from src.metrics import metrics
+
+def command(number: int):
+    return ("EVALSHA", RedisTokenBuckets.SHA, 1, f"bench:{number % 100}", 1000, 1000)
+
+async def sequential(count: int, concurrency: int):
+    for number in range(count):
+        await get_redis().execute_command(*command(number))
+
+async def in_parallel(count: int, concurrency: int, call: Callable[[int], Awaitable]):
+    numbers = iter(range(count))
+
+    async def worker():
+        for number in numbers:
+            await call(number)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+async def parallel_direct(count: int, concurrency: int):
+    await in_parallel(count, concurrency, lambda number: get_redis().execute_command(*command(number)))
+
+async def parallel_batched(count: int, concurrency: int):
+    await in_parallel(count, concurrency, lambda number: batcher.execute(*command(number)))
+
+async def one_pipeline(count: int, concurrency: int):
+    await pipeline_execute(command(number) for number in range(count))
+
+async def bench(count: int, concurrency: int):
+    redis = get_redis()
+    try:
+        await redis.script_load(RedisTokenBuckets.SCRIPT)
+        for name, run in (
+            ("по одной", sequential),
+            ("параллельно в пул", parallel_direct),
+            ("параллельно через батчер", parallel_batched),
+            ("одна пачка", one_pipeline),
+        ):
+            pipelines = metrics.get("redis_pipelines")
+            started = time.perf_counter()
+            await run(count, concurrency)
+            elapsed = time.perf_counter() - started
+            round_trips = metrics.get("redis_pipelines") - pipelines
+            round_trips_text = f"{round_trips:6d}" if round_trips else f"{count:6d}"
+            print(f"{name:28s}: {count / elapsed:10,.0f} команд/с, обращений {round_trips_text}")
+    finally:
+        keys: List[str] = [f"bench:{number}" for number in range(100)]
+        await redis.delete(*keys)
+        await close_redis()
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commands", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(bench(args.commands, args.concurrency))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
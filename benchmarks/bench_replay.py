@@ -0,0 +1,106 @@
+"""
+Бенчмарк симуляции: синтетический поток лимитных, рыночных ордеров и отмен воспроизводится на бирже
+в памяти (src/engine/replay.py). Печатает пропускную способность и проверяет детерминированность:
+два прогона с одним seed должны дать одинаковые сделки и балансы.
+
+Вместо синтетического потока можно воспроизвести сделки из ленты (src/engine/tape.py): каждая сделка
+становится парой ордеров - лимитным мейкером и рыночным тейкером того же объема по той же цене.
+
+Запуск из корня репозитория (Postgres и переменные окружения не нужны):
+    python -m benchmarks.bench_replay [--events 20000] [--users 50] [--seed 1]
+    python -m benchmarks.bench_replay --tape-dir tape --tape-ticker MEME --tape-day 2026-01-05
+Код возврата 1, если прогоны разошлись.
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import random
+import sys
+from typing import Any, Dict, List
+from src.engine.replay import Replay
+from src.engine.tape import read_trades
+
+TICKERS = ["MEME", "GOLD"]
+
+def synthetic_events(count: int, users: int, seed: int) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    start = datetime.datetime(2026, 1, 5, 10, tzinfo=datetime.timezone.utc)
+    events, refs = [], []
+    for number in range(count):
+        ts = (start + datetime.timedelta(milliseconds=number)).isoformat()
+        user = f"u{rng.randrange(users)}"
+        roll = rng.random()
+        if roll < 0.15 and refs:
+            owner, ref = refs.pop(rng.randrange(len(refs)))
+            events.append({"ts": ts, "user": owner, "action": "cancel", "ref": ref})
+            continue
+        event = {
+            "ts": ts,
+            "user": user,
+            "action": "order",
+            "ref": f"o{number}",
+            "direction": rng.choice(["BUY", "SELL"]),
+            "ticker": rng.choice(TICKERS),
+            "qty": rng.randint(1, 20),
+        }
+        if roll > 0.25:
+            event["price"] = rng.randint(95, 105)
+            refs.append((user, event["ref"]))
+        events.append(event)
+    return events
+
+def tape_events(directory: str, ticker: str, day: datetime.date) -> List[Dict[str, Any]]:
+    trades = read_trades(ticker, day, directory)
+    events = []
+    for number, (ts, price, qty, side) in enumerate(zip(trades["ts"].tolist(), trades["price"].tolist(), trades["qty"].tolist(), trades["side"].tolist())):
+        taker, maker = ("BUY", "SELL") if side > 0 else ("SELL", "BUY")
+        events.append({"ts": ts / 1e9, "user": "maker", "action": "order", "ref": f"m{number}", "direction": maker, "ticker": ticker, "qty": qty, "price": price})
+        events.append({"ts": ts / 1e9, "user": "taker", "action": "order", "ref": f"t{number}", "direction": taker, "ticker": ticker, "qty": qty})
+    return events
+
+async def run_once(events: List[Dict[str, Any]], users: List[str], tickers: List[str], seed: int):
+    fills = []
+    replay = Replay(seed=seed, on_fill=fills.append)
+    for user in users:
+        replay.deposit(user, "RUB", 10_000_000)
+        for ticker in tickers:
+            replay.deposit(user, ticker, 100_000)
+    stats = await replay.run(events)
+    digest = hashlib.sha256(json.dumps([fills, replay.balances()], sort_keys=True).encode()).hexdigest()
+    return stats, digest
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tape-dir", default="tape")
+    parser.add_argument("--tape-ticker")
+    parser.add_argument("--tape-day", type=datetime.date.fromisoformat, default=datetime.date.today())
+    args = parser.parse_args()
+
+    if args.tape_ticker:
+        events = tape_events(args.tape_dir, args.tape_ticker, args.tape_day)
+        users, tickers = ["maker", "taker"], [args.tape_ticker]
+        print(f"сделок в ленте: {len(events) // 2}")
+    else:
+        events = synthetic_events(args.events, args.users, args.seed)
+        users, tickers = [f"u{number}" for number in range(args.users)], TICKERS
+    first, first_digest = asyncio.run(run_once(events, users, tickers, args.seed))
+    second, second_digest = asyncio.run(run_once(events, users, tickers, args.seed))
+
+    for name, stats in (("прогон 1", first), ("прогон 2", second)):
+        print(
+            f"{name}: событий {stats.events}, сделок {stats.fills}, отклонено {stats.rejected}, "
+            f"{stats.seconds:.2f} с, {stats.events_per_second:,.0f} событий/с"
+        )
+    if first_digest != second_digest:
+        print(f"прогоны разошлись: {first_digest} != {second_digest}")
+        return 1
+    print(f"прогоны совпали: {first_digest[:16]}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""
+Микробенчмарк сериализации ответов: модели pydantic + повторная валидация по response_model
+(как делает FastAPI) против быстрого пути через словари и заранее собранные TypeAdapter.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_serialization
+"""
+import datetime
+import timeit
+import uuid
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import List
+
+from pydantic import TypeAdapter
+
+from src.schemas.order import (
+    LimitOrder,
+    LimitOrderBody,
+    MarketOrder,
+    MarketOrderBody,
+    OrderStatus,
+    OrderType,
+    OperationDirection,
+    TimeInForce,
+    Level,
+    L2OrderBook,
+)
+from src.schemas.instrument import Transaction
+from src.schemas.serialization import order_to_dict, orders_adapter, orderbook_adapter, transactions_adapter
+
+ROWS = 10_000
+REPEAT = 5
+
+def make_orders(n: int):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    user_id = uuid.uuid4()
+    return [
+        SimpleNamespace(
+            id=uuid.uuid4(),
+            type=OrderType.LIMIT if i % 4 else OrderType.MARKET,
+            status=OrderStatus.NEW,
+            user_id=user_id,
+            timestamp=now,
+            direction=OperationDirection.BUY if i % 2 else OperationDirection.SELL,
+            ticker="MEMCOIN",
+            qty=10 + i,
+            price=100 + i % 50,
+            filled=0,
+            time_in_force=TimeInForce.GTC,
+        )
+        for i in range(n)
+    ]
+
+def models_path(orders) -> bytes:
+    response = []
+    for order in orders:
+        base_order_data = {"id": order.id, "status": order.status, "user_id": order.user_id, "timestamp": order.timestamp}
+        if order.type == OrderType.MARKET:
+            body = MarketOrderBody(direction=order.direction, ticker=order.ticker, qty=order.qty)
+            response.append(MarketOrder(**base_order_data, body=body))
+        else:
+            body = LimitOrderBody(direction=order.direction, ticker=order.ticker, qty=order.qty, price=order.price, time_in_force=order.time_in_force)
+            response.append(LimitOrder(**base_order_data, body=body, filled=order.filled))
+    return revalidate(List[LimitOrder | MarketOrder], response)
+
+def fast_path(orders) -> bytes:
+    return orders_adapter.dump_json([order_to_dict(order) for order in orders])
+
+@lru_cache
+def response_adapter(response_model) -> TypeAdapter:
+    return TypeAdapter(response_model)
+
+def revalidate(response_model, content) -> bytes:
+    # Повторяет serialize_response FastAPI: dump -> валидация по response_model -> JSON
+    adapter = response_adapter(response_model)
+    dumped = [item.model_dump() for item in content] if isinstance(content, list) else content.model_dump()
+    return adapter.dump_json(adapter.validate_python(dumped))
+
+def bench(name: str, fn, *args):
+    best = min(timeit.repeat(lambda: fn(*args), number=1, repeat=REPEAT))
+    print(f"{name:<28} {best * 1000:9.2f} ms")
+    return best
+
+def main():
+    orders = make_orders(ROWS)
+    levels = [(100 + i, 10 * i + 1) for i in range(ROWS)]
+    now = datetime.datetime.now(datetime.timezone.utc)
+    trades = [{"ticker": "MEMCOIN", "amount": 1 + i % 7, "price": 100 + i % 50, "timestamp": now} for i in range(ROWS)]
+
+    print(f"{ROWS} строк, лучшее из {REPEAT}")
+
+    slow = bench("orders: models", models_path, orders)
+    fast = bench("orders: fast path", fast_path, orders)
+    print(f"{'':<28} x{slow / fast:.1f}")
+
+    slow = bench("orderbook: models", lambda: revalidate(L2OrderBook, L2OrderBook(
+        bid_levels=[Level(price=p, qty=q) for p, q in levels],
+        ask_levels=[Level(price=p, qty=q) for p, q in levels],
+    )))
+    fast = bench("orderbook: fast path", lambda: orderbook_adapter.dump_json({
+        "bid_levels": [{"price": p, "qty": q} for p, q in levels],
+        "ask_levels": [{"price": p, "qty": q} for p, q in levels],
+    }))
+    print(f"{'':<28} x{slow / fast:.1f}")
+
+    slow = bench("transactions: models", lambda: revalidate(List[Transaction], [Transaction(**trade) for trade in trades]))
+    fast = bench("transactions: fast path", lambda: transactions_adapter.dump_json(trades))
+    print(f"{'':<28} x{slow / fast:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Бенчмарк матчинга по шардам (src/engine/sharding.py): сколько сделок в секунду дает матчинг K активных тикеров
+в процессе API и на шардах. Для каждого K создаются K временных инструментов, в стакан каждого кладется
+по --orders продаж и пересекающих их покупок с резервами, затем проходы матчинга всех тикеров запускаются
+одновременно и замеряется время до их завершения. При K <= числа шардов время должно почти не расти с K,
+если ядер хватает и шардам, и Postgres: на одном ядре шарды только делят его между собой.
+В конце печатается сводка: сделок/с в процессе и на шардах для каждого K и их отношение.
+
+Нужен Postgres с примененными миграциями (переменные окружения как у API).
+Временные пользователи и инструменты BENCH* удаляются в конце.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_sharding [--tickers 1,2,4,8] [--orders 200] [--shards -1] [--shared-users]
+--shared-users - одни и те же покупатель и продавец на всех тикерах: расчеты разных шардов
+упираются в блокировку одних и тех же строк баланса RUB.
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import time
+import uuid
+from typing import Dict, List, Tuple
+from sqlalchemy import delete, select
+from src.dataBase.session import async_session_factory, dispose_engines
+from src.dataBase.models.balance import BalanceORM, TransactionORM
+from src.dataBase.models.instrument import InstrumentORM
+from src.dataBase.models.order import OrderORM
+from src.dataBase.models.user import UserORM
+from src.api.stockMarket.order import match_limit_orders
+from src.engine.sharding import shards
+from src.schemas.order import OperationDirection, OrderStatus, OrderType, TimeInForce
+from src.schemas.user import Role
+
+PRICE = 100
+
+def pick_tickers(count: int) -> List[str]:
+    # Тикеры подбираются так, чтобы распределиться по шардам поровну
+    if not shards.enabled:
+        return [f"BENCH{chr(65 + number)}" for number in range(count)]
+    per_shard: Dict[int, int] = {}
+    tickers = []
+    for first in range(26):
+        for second in range(26):
+            ticker = f"BENCH{chr(65 + first)}{chr(65 + second)}"
+            shard = shards.shard_for(ticker)
+            if per_shard.get(shard, 0) <= min(per_shard.get(other, 0) for other in range(shards.count)):
+                per_shard[shard] = per_shard.get(shard, 0) + 1
+                tickers.append(ticker)
+                if len(tickers) == count:
+                    return tickers
+    return tickers
+
+async def seed(tickers: List[str], orders: int, shared_users: bool) -> List[uuid.UUID]:
+    users: Dict[str, Tuple[uuid.UUID, uuid.UUID]] = {}
+    shared = (uuid.uuid4(), uuid.uuid4())
+    for ticker in tickers:
+        users[ticker] = shared if shared_users else (uuid.uuid4(), uuid.uuid4())
+    user_ids = sorted({user_id for pair in users.values() for user_id in pair})
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    async with async_session_factory() as session:
+        session.add_all(InstrumentORM(ticker=ticker, name=ticker) for ticker in tickers)
+        session.add_all(UserORM(id=user_id, name="bench", role=Role.USER, api_key=f"bench-{user_id}") for user_id in user_ids)
+        await session.flush()
+        balances: Dict[Tuple[uuid.UUID, str], BalanceORM] = {}
+        for ticker, (buyer, seller) in users.items():
+            for key in ((buyer, "RUB"), (seller, ticker)):
+                if key not in balances:
+                    balances[key] = BalanceORM(user_id=key[0], ticker=key[1], amount=0, reserved=0)
+            balances[(buyer, "RUB")].amount += orders * PRICE
+            balances[(buyer, "RUB")].reserved += orders * PRICE
+            balances[(seller, ticker)].amount += orders
+            balances[(seller, ticker)].reserved += orders
+            for number in range(orders):
+                for user_id, direction in ((seller, OperationDirection.SELL), (buyer, OperationDirection.BUY)):
+                    session.add(OrderORM(
+                        id=uuid.uuid4(),
+                        type=OrderType.LIMIT,
+                        status=OrderStatus.NEW,
+                        user_id=user_id,
+                        timestamp=now + datetime.timedelta(microseconds=number),
+                        direction=direction,
+                        ticker=ticker,
+                        qty=1,
+                        price=PRICE,
+                        filled=0,
+                        reserved=PRICE if direction == OperationDirection.BUY else 1,
+                        time_in_force=TimeInForce.GTC
+                    ))
+        session.add_all(balances.values())
+        await session.commit()
+    return user_ids
+
+async def cleanup(tickers: List[str], user_ids: List[uuid.UUID]):
+    async with async_session_factory() as session:
+        await session.execute(delete(InstrumentORM).where(InstrumentORM.ticker.in_(tickers)))
+        await session.execute(delete(UserORM).where(UserORM.id.in_(user_ids)))
+        await session.commit()
+
+async def count_trades(tickers: List[str]) -> int:
+    async with async_session_factory() as session:
+        result = await session.execute(select(TransactionORM.id).where(TransactionORM.ticker.in_(tickers)))
+        return len(result.all())
+
+async def measure(count: int, orders: int, shared_users: bool) -> Tuple[float, int]:
+    tickers = pick_tickers(count)
+    user_ids = await seed(tickers, orders, shared_users)
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(match_limit_orders(ticker) for ticker in tickers))
+        elapsed = time.perf_counter() - started
+        return elapsed, await count_trades(tickers)
+    finally:
+        await cleanup(tickers, user_ids)
+
+async def run(ticker_counts: List[int], orders: int, shared_users: bool, label: str) -> Dict[int, float]:
+    rates = {}
+    for count in ticker_counts:
+        elapsed, trades = await measure(count, orders, shared_users)
+        rates[count] = trades / elapsed
+        print(f"{label}: тикеров {count:3d}, сделок {trades:6d}, {elapsed:6.2f} с, {rates[count]:8.0f} сделок/с")
+    return rates
+
+def report(inline: Dict[int, float], sharded: Dict[int, float]):
+    print("тикеров  в процессе, сделок/с  шарды, сделок/с  шарды / в процессе")
+    for count, rate in inline.items():
+        print(f"{count:7d}  {rate:20.0f}  {sharded[count]:15.0f}  {sharded[count] / rate:18.2f}")
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tickers", default="1,2,4,8")
+    parser.add_argument("--orders", type=int, default=200)
+    parser.add_argument("--shards", type=int, default=-1)
+    parser.add_argument("--shared-users", action="store_true")
+    args = parser.parse_args()
+    ticker_counts = [int(count) for count in args.tickers.split(",")]
+
+    async def bench():
+        try:
+            inline = await run(ticker_counts, args.orders, args.shared_users, "в процессе")
+            shards.start(args.shards)
+            # Первый проход в каждом шарде платит за импорт модулей и подключение к БД
+            await asyncio.gather(*(match_limit_orders(ticker) for ticker in pick_tickers(shards.count)))
+            report(inline, await run(ticker_counts, args.orders, args.shared_users, f"шарды ({shards.count})"))
+        finally:
+            shards.stop()
+            await dispose_engines()
+
+    print(f"ядер: {os.cpu_count()}")
+    asyncio.run(bench())
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
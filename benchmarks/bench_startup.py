@@ -0,0 +1,79 @@
+"""
+Бенчмарк старта воркера: время импорта src.main в чистом интерпретаторе и самые тяжелые импорты
+по данным python -X importtime. Проверяет бюджет времени и то, что при импорте приложения
+не загружаются подсистемы, нужные только по требованию (драйвер БД, Redis, jwt, NumPy).
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_startup [--budget-ms 1500] [--runs 5]
+Код возврата 1, если бюджет превышен или загружен лишний модуль.
+"""
+import argparse
+import json
+import re
+import statistics
+import subprocess
+import sys
+
+TARGET = "src.main"
+# Модули, которые приложение загружает лениво: при импорте src.main их быть не должно
+LAZY_MODULES = ["psycopg", "asyncpg", "redis", "jwt", "numpy", "uvicorn"]
+
+MEASURE = f"""
+import json, sys, time
+started = time.perf_counter()
+import {TARGET}
+elapsed = time.perf_counter() - started
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {LAZY_MODULES!r} if m in sys.modules]}}))
+"""
+
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)$")
+
+def measure_once() -> dict:
+    output = subprocess.run([sys.executable, "-c", MEASURE], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def heaviest_imports(top: int):
+    # Кумулятивное время прямых импортов src.main (отступ на один уровень глубже верхнего)
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {TARGET}"], capture_output=True, text=True, check=True).stderr
+    # Вложенные импорты печатаются раньше родителя: копим строки до строки самого src.main
+    rows = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match is None:
+            continue
+        if len(match[3]) == 1:
+            if match[4] == TARGET:
+                break
+            rows = []
+        elif len(match[3]) == 3:
+            rows.append((int(match[2]), match[4]))
+    return sorted(rows, reverse=True)[:top]
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget-ms", type=float, default=1500)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [measure_once() for _ in range(args.runs)]
+    timings = [run["seconds"] * 1000 for run in runs]
+    median = statistics.median(timings)
+    loaded = sorted({module for run in runs for module in run["loaded"]})
+
+    print(f"импорт {TARGET}: медиана {median:.0f} ms, мин {min(timings):.0f} ms, макс {max(timings):.0f} ms ({args.runs} запусков)")
+    print(f"самые тяжелые импорты (-X importtime, с накладными расходами):")
+    for microseconds, module in heaviest_imports(args.top):
+        print(f"  {microseconds / 1000:8.1f} ms  {module}")
+
+    ok = True
+    if median > args.budget_ms:
+        print(f"бюджет {args.budget_ms:.0f} ms превышен")
+        ok = False
+    if loaded:
+        print(f"при импорте загружены ленивые модули: {', '.join(loaded)}")
+        ok = False
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,158 +1,336 @@
-from fastapi import Depends, HTTPException, status, APIRouter
+import csv
+import json
+from collections import defaultdict
+from fastapi import Depends, HTTPException, Request, status, APIRouter
+from pydantic import ValidationError
 from uuid import UUID
-from sqlalchemy import select
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.dialects.postgresql import insert
 from src.api.profile.user import get_user_by_token, is_admin, UserORM
 from src.dataBase.models.instrument import InstrumentORM
-from src.api.profile.instrument import get_instruments_list
+from src.api.profile.ledger import get_account, record
 from src.dataBase.models.balance import BalanceORM, TransactionORM
 from src.dataBase.session import async_session_factory
+from src.engine.storage import ExchangeStorage, sql_backend
+from src.config import settings
 from src.schemas.schemas import succesMessage, OK
 from src.schemas.instrument import TickerStr
 from src.schemas.order import OperationDirection
 from src.schemas.user import User
-from src.schemas.balance import BalanceTransaction, AmountInt
-from typing import Dict
+from src.schemas.balance import BalanceTransaction, BalanceView, AmountInt, BatchRowError, BalanceBatchResult
+from typing import AsyncIterator, Dict, List, Tuple
 
 balance_router = APIRouter(prefix='/api/v1')
 
 @balance_router.get("/balance", tags=["balance"])
 async def get_balances(user: User = Depends(get_user_by_token)) -> Dict[str, int]:
-    async with async_session_factory() as session:
-        # Получаем все инструменты
-        instruments = await get_instruments_list()
-        all_tickers = {ticker for _, ticker in instruments}
-        
-        # Получаем только ненулевые балансы
-        balances_result = await session.execute(
-            select(BalanceORM.ticker, BalanceORM.amount)
-            .where(BalanceORM.user_id == user.id, BalanceORM.amount > 0)
-        )
-
-        # Создаем словарь только с ненулевыми значениями
-        user_balance = {ticker: amount for ticker, amount in balances_result.all()}
-        
-        return user_balance
+    # Балансы читаются из леджера в памяти, в ответ попадают только ненулевые
+    account = await get_account(user.id)
+    return {ticker: amount for ticker, (amount, _) in account.items() if amount > 0}
+
+@balance_router.get("/balance/detailed", tags=["balance"])
+async def get_balances_detailed(user: User = Depends(get_user_by_token)) -> Dict[str, BalanceView]:
+    """
+    Возвращает по каждому тикеру всего средств, в резерве под ордера и доступно для новых ордеров
+    """
+    account = await get_account(user.id)
+    return {
+        ticker: BalanceView(amount=amount, reserved=reserved, available=amount - reserved)
+        for ticker, (amount, reserved) in account.items()
+        if amount > 0 or reserved > 0
+    }
 
 @balance_router.post("/admin/balance/deposit", tags=["admin","balance"])
 async def deposit(transaction: BalanceTransaction, rights: None = Depends(is_admin)) -> OK:
-    async with async_session_factory() as session:
-        await increase_balance(session, user_id=transaction.user_id, ticker=transaction.ticker, amount=transaction.amount)
-        await session.commit()
+    async with sql_backend.transaction() as storage:
+        await increase_balance(storage, user_id=transaction.user_id, ticker=transaction.ticker, amount=transaction.amount)
+        await storage.commit()
         return succesMessage
 
 @balance_router.post("/admin/balance/withdraw", tags=["admin","balance"])
 async def withdraw(transaction: BalanceTransaction, rights: None = Depends(is_admin)) -> OK:
-    async with async_session_factory() as session:
-        await decrease_balance(session, user_id=transaction.user_id, ticker=transaction.ticker, amount=transaction.amount)
-        await session.commit()
+    async with sql_backend.transaction() as storage:
+        await decrease_balance(storage, user_id=transaction.user_id, ticker=transaction.ticker, amount=transaction.amount)
+        await storage.commit()
         return succesMessage
 
-async def update_balances(session: AsyncSession, buyer_id: UUID, seller_id: UUID, orderTransaction: TransactionORM, isMarket: bool = False):
+BATCH_CSV_HEADER = ["user_id", "ticker", "amount"]
+NDJSON_CONTENT_TYPES = {"application/x-ndjson", "application/ndjson", "application/jsonl"}
+BATCH_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {"schema": {"type": "array", "items": BalanceTransaction.model_json_schema()}},
+            "application/x-ndjson": {"schema": {"type": "string", "description": "Одна операция JSON на строку"}},
+            "text/csv": {"schema": {"type": "string", "description": "Заголовок user_id,ticker,amount и строки операций"}},
+        },
+    }
+}
+
+@balance_router.post("/admin/balance/deposit/batch", tags=["admin","balance"], openapi_extra=BATCH_OPENAPI)
+async def deposit_batch(request: Request, all_or_nothing: bool = False, rights: None = Depends(is_admin)) -> BalanceBatchResult:
+    """
+    Пополняет балансы пачкой операций одной транзакцией. Тело - JSON-список, NDJSON или CSV.
+    Ошибочные строки возвращаются в errors, остальные применяются (при all_or_nothing - ни одна)
+    """
+    return await apply_balance_batch(request, withdraw=False, all_or_nothing=all_or_nothing)
+
+@balance_router.post("/admin/balance/withdraw/batch", tags=["admin","balance"], openapi_extra=BATCH_OPENAPI)
+async def withdraw_batch(request: Request, all_or_nothing: bool = False, rights: None = Depends(is_admin)) -> BalanceBatchResult:
+    """
+    Списывает балансы пачкой операций одной транзакцией; строки одного счета применяются по порядку,
+    строка, для которой не хватает свободных (не зарезервированных) средств, возвращается в errors
+    """
+    return await apply_balance_batch(request, withdraw=True, all_or_nothing=all_or_nothing)
+
+def validation_message(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, item['loc'])) or 'row'}: {item['msg']}" for item in error.errors())
+
+async def request_lines(request: Request) -> AsyncIterator[bytes]:
+    # Тело читается по частям: большой CSV или NDJSON не собирается в памяти целиком
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        lines = buffer.split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+async def parse_batch(request: Request) -> Tuple[List[Tuple[int, BalanceTransaction]], List[BatchRowError]]:
+    """
+    Разбирает тело пакетного запроса в зависимости от Content-Type; возвращает (номер строки, операция)
+    для корректных строк и ошибки разбора для остальных
+    """
+    rows: List[Tuple[int, BalanceTransaction]] = []
+    errors: List[BatchRowError] = []
+
+    def add(number: int, data) -> None:
+        if number > settings.BALANCE_BATCH_MAX_ROWS:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"Не больше {settings.BALANCE_BATCH_MAX_ROWS} операций за запрос")
+        try:
+            rows.append((number, BalanceTransaction.model_validate(data)))
+        except ValidationError as error:
+            errors.append(BatchRowError(row=number, error=validation_message(error)))
+
+    content_type = request.headers.get("content-type", "application/json").split(";")[0].strip().lower()
+    if content_type == "text/csv":
+        header = None
+        number = 0
+        async for line in request_lines(request):
+            line = line.strip()
+            if not line:
+                continue
+            if header is None:
+                header = [field.strip() for field in next(csv.reader([line.decode(errors="replace")]))]
+                if header != BATCH_CSV_HEADER:
+                    raise HTTPException(status_code=400, detail=f"Ожидается заголовок CSV: {','.join(BATCH_CSV_HEADER)}")
+                continue
+            number += 1
+            try:
+                values = next(csv.reader([line.decode()]))
+            except UnicodeDecodeError:
+                errors.append(BatchRowError(row=number, error="Строка не в кодировке UTF-8"))
+                continue
+            if len(values) != len(BATCH_CSV_HEADER):
+                errors.append(BatchRowError(row=number, error=f"Ожидается {len(BATCH_CSV_HEADER)} поля"))
+                continue
+            add(number, dict(zip(BATCH_CSV_HEADER, (value.strip() for value in values))))
+    elif content_type in NDJSON_CONTENT_TYPES:
+        number = 0
+        async for line in request_lines(request):
+            if not line.strip():
+                continue
+            number += 1
+            try:
+                data = json.loads(line)
+            except ValueError:
+                errors.append(BatchRowError(row=number, error="Некорректный JSON"))
+                continue
+            add(number, data)
+    else:
+        try:
+            data = json.loads(await request.body())
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Некорректный JSON")
+        if not isinstance(data, list):
+            raise HTTPException(status_code=400, detail="Ожидается список операций")
+        if len(data) > settings.BALANCE_BATCH_MAX_ROWS:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"Не больше {settings.BALANCE_BATCH_MAX_ROWS} операций за запрос")
+        for number, item in enumerate(data, 1):
+            add(number, item)
+    return rows, errors
+
+async def apply_balance_batch(request: Request, withdraw: bool, all_or_nothing: bool) -> BalanceBatchResult:
+    rows, errors = await parse_batch(request)
+    applied = 0
+    if rows and not (all_or_nothing and errors):
+        async with async_session_factory() as session:
+            rows, rejected = await stage_batch(session, rows)
+            errors += rejected
+            if withdraw:
+                rows, rejected = await withdraw_staged(session, rows)
+                errors += rejected
+            else:
+                await deposit_staged(session, rows)
+
+            if all_or_nothing and errors:
+                await session.rollback()
+            else:
+                await session.commit()
+                applied = len(rows)
+    errors.sort(key=lambda error: error.row)
+    return BalanceBatchResult(applied=applied, errors=errors)
+
+async def stage_batch(session: AsyncSession, rows: List[Tuple[int, BalanceTransaction]]) -> Tuple[List[Tuple[int, BalanceTransaction]], List[BatchRowError]]:
+    """
+    Загружает операции через COPY во временную таблицу balance_batch (удаляется при коммите)
+    и убирает из нее строки с несуществующими пользователями и инструментами.
+    Оставшиеся пользователи и инструменты блокируются FOR KEY SHARE до конца транзакции
+    """
+    await session.execute(text(
+        "CREATE TEMP TABLE balance_batch (line int PRIMARY KEY, user_id uuid NOT NULL, ticker text NOT NULL, amount bigint NOT NULL) ON COMMIT DROP"
+    ))
+    connection = await session.connection()
+    driver_connection = (await connection.get_raw_connection()).driver_connection
+    async with driver_connection.cursor() as cursor:
+        async with cursor.copy("COPY balance_batch (line, user_id, ticker, amount) FROM STDIN") as copy:
+            for number, row in rows:
+                await copy.write_row((number, row.user_id, row.ticker, row.amount))
+    await session.execute(text("ANALYZE balance_batch"))
+
+    result = await session.execute(text("""
+        SELECT b.line, u.id IS NULL, i.ticker IS NULL
+        FROM balance_batch b
+        LEFT JOIN (SELECT id FROM "user" WHERE id IN (SELECT user_id FROM balance_batch) FOR KEY SHARE) u ON u.id = b.user_id
+        LEFT JOIN (SELECT ticker FROM instrument WHERE ticker IN (SELECT ticker FROM balance_batch) FOR KEY SHARE) i ON i.ticker = b.ticker
+        WHERE u.id IS NULL OR i.ticker IS NULL
+    """))
+    errors = [
+        BatchRowError(row=line, error="Пользователь не найден" if user_missing else "Инструмент не найден")
+        for line, user_missing, ticker_missing in result.all()
+    ]
+    if not errors:
+        return rows, errors
+    rejected = {error.row for error in errors}
+    await session.execute(text("DELETE FROM balance_batch WHERE line = ANY(:lines)"), {"lines": list(rejected)})
+    return [(number, row) for number, row in rows if number not in rejected], errors
+
+def batch_totals(rows: List[Tuple[int, BalanceTransaction]]) -> Dict[Tuple[UUID, str], int]:
+    totals: Dict[Tuple[UUID, str], int] = defaultdict(int)
+    for _, row in rows:
+        totals[(row.user_id, row.ticker)] += row.amount
+    return totals
+
+async def deposit_staged(session: AsyncSession, rows: List[Tuple[int, BalanceTransaction]]):
+    # Одна строка balance не может меняться дважды в одном INSERT ... ON CONFLICT, поэтому операции суммируются по счету.
+    # Строки вставляются в порядке (user_id, ticker), как их блокирует lock_balances хранилища
+    await session.execute(text("""
+        INSERT INTO balance (user_id, ticker, amount, reserved)
+        SELECT user_id, ticker, sum(amount), 0 FROM balance_batch
+        GROUP BY user_id, ticker
+        ORDER BY user_id, ticker
+        ON CONFLICT (user_id, ticker) DO UPDATE SET amount = balance.amount + excluded.amount
+    """))
+    for (user_id, ticker), amount in batch_totals(rows).items():
+        record(session, user_id, ticker, amount=amount)
+
+async def withdraw_staged(session: AsyncSession, rows: List[Tuple[int, BalanceTransaction]]) -> Tuple[List[Tuple[int, BalanceTransaction]], List[BatchRowError]]:
+    result = await session.execute(text("""
+        SELECT b.user_id, b.ticker, b.amount - b.reserved FROM balance b
+        WHERE (b.user_id, b.ticker) IN (SELECT user_id, ticker FROM balance_batch)
+        ORDER BY b.user_id, b.ticker
+        FOR UPDATE
+    """))
+    available = {(user_id, ticker): free for user_id, ticker, free in result.all()}
+
+    accepted: List[Tuple[int, BalanceTransaction]] = []
+    errors: List[BatchRowError] = []
+    for number, row in rows:
+        key = (row.user_id, row.ticker)
+        if key not in available:
+            errors.append(BatchRowError(row=number, error="Инструмент у пользователя не найден"))
+        elif available[key] < row.amount:
+            errors.append(BatchRowError(row=number, error="Недостаточно средств на балансе"))
+        else:
+            available[key] -= row.amount
+            accepted.append((number, row))
+
+    if errors:
+        await session.execute(text("DELETE FROM balance_batch WHERE line = ANY(:lines)"), {"lines": [error.row for error in errors]})
+    await session.execute(text("""
+        UPDATE balance b SET amount = b.amount - s.amount
+        FROM (SELECT user_id, ticker, sum(amount) AS amount FROM balance_batch GROUP BY user_id, ticker) s
+        WHERE b.user_id = s.user_id AND b.ticker = s.ticker
+    """))
+    for (user_id, ticker), amount in batch_totals(accepted).items():
+        record(session, user_id, ticker, amount=-amount)
+    return accepted, errors
+
+async def update_balances(storage: ExchangeStorage, buyer_id: UUID, seller_id: UUID, orderTransaction: TransactionORM):
+    # Переводит актив и RUB по сделке. Резервы снимает исполнение каждого ордера отдельно (release_order_reserve)
     ticker = orderTransaction.ticker
     amount = orderTransaction.amount
     price = orderTransaction.price
     rub_amount = amount * price
 
-    await decrease_balance(session, user_id=seller_id, ticker=ticker, amount=amount)
-    await increase_balance(session, user_id=buyer_id, ticker=ticker, amount=amount)
-
-    await decrease_balance(session, user_id=buyer_id, ticker="RUB", amount=rub_amount)
-    await increase_balance(session, user_id=seller_id, ticker="RUB", amount=rub_amount)
-
-    rub_balance_result = await session.execute(
-        select(BalanceORM).where(BalanceORM.user_id == buyer_id, BalanceORM.ticker == "RUB").with_for_update()
-    )
-    buyer_balance_RUB = rub_balance_result.scalar_one_or_none()
+    await decrease_balance(storage, user_id=seller_id, ticker=ticker, amount=amount)
+    await increase_balance(storage, user_id=buyer_id, ticker=ticker, amount=amount)
 
-    if buyer_balance_RUB is None:
-        raise HTTPException(status_code=404, detail="Баланс RUB покупателя не найден")
+    await decrease_balance(storage, user_id=buyer_id, ticker="RUB", amount=rub_amount)
+    await increase_balance(storage, user_id=seller_id, ticker="RUB", amount=rub_amount)
 
-    seller_balance_result = await session.execute(
-        select(BalanceORM).where(BalanceORM.user_id == seller_id, BalanceORM.ticker == ticker).with_for_update()
-    )
-    seller_balance = seller_balance_result.scalar_one_or_none()
+async def increase_balance(storage: ExchangeStorage, user_id: UUID, ticker: str, amount: int):
+    await storage.increase_balance(user_id, ticker, amount)
+    storage.record(user_id, ticker, amount=amount)
 
-    if seller_balance is None:
-        raise HTTPException(status_code=404, detail=f"Баланс {ticker} продавца не найден")
-    
-    if not isMarket:
-        buyer_balance_RUB.reserved = max(buyer_balance_RUB.reserved - rub_amount, 0)
-        seller_balance.reserved = max(seller_balance.reserved - amount, 0)
-
-async def increase_balance(session: AsyncSession, user_id: UUID, ticker: str, amount: int):
-    stmt = (
-        insert(BalanceORM)
-        .values(user_id=user_id, ticker=ticker, amount=amount, reserved=0)
-        .on_conflict_do_update(
-            index_elements=["user_id", "ticker"],
-            set_={"amount": BalanceORM.amount + amount}
-        )
-    )
-    await session.execute(stmt)
-
-async def decrease_balance(session: AsyncSession, user_id: UUID, ticker: str, amount: int):
-    result = await session.execute(
-        select(BalanceORM).where(BalanceORM.user_id == user_id, BalanceORM.ticker == ticker).with_for_update()
-    )
-    balance = result.scalar_one_or_none()
+async def decrease_balance(storage: ExchangeStorage, user_id: UUID, ticker: str, amount: int):
+    balance = await storage.lock_balance(user_id, ticker)
     if balance is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Инструмент у пользователя не найден")
     if balance.amount < amount:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Недостаточно средств на балансе")
     
     balance.amount -= amount
+    storage.record(user_id, ticker, amount=-amount)
 
 async def reserve_funds(
-    session: AsyncSession, 
+    storage: ExchangeStorage, 
     user_id: UUID, 
     ticker: TickerStr, 
     qty: AmountInt, 
     price: AmountInt, 
     direction: OperationDirection
-):
+) -> int:
+    """
+    Резервирует средства под лимитный ордер и возвращает размер резерва - его запоминает ордер (OrderORM.reserved)
+    """
     if direction == OperationDirection.BUY:
         rub_needed = qty * price
-        rub_balance = await lock_balance(session, user_id, "RUB")
+        rub_balance = await lock_balance(storage, user_id, "RUB")
 
         available = rub_balance.amount - rub_balance.reserved
         if available < rub_needed:
             raise HTTPException(status_code=400, detail="Недостаточно RUB для резервации")
 
         rub_balance.reserved += rub_needed
+        storage.record(user_id, "RUB", reserved=rub_needed)
+        return rub_needed
 
     elif direction == OperationDirection.SELL:
-        asset_balance = await lock_balance(session, user_id, ticker)
+        asset_balance = await lock_balance(storage, user_id, ticker)
 
         available = asset_balance.amount - asset_balance.reserved
         if available < qty:
             raise HTTPException(status_code=400, detail=f"Недостаточно {ticker} для резервации")
 
         asset_balance.reserved += qty
+        storage.record(user_id, ticker, reserved=qty)
+        return qty
 
-async def lock_balance(session: AsyncSession, user_id: UUID, ticker: TickerStr) -> BalanceORM:
-    result = await session.execute(
-        select(BalanceORM).where(
-            BalanceORM.user_id == user_id,
-            BalanceORM.ticker == ticker
-        ).with_for_update()
-    )
-    balance = result.scalar_one_or_none()
+async def lock_balance(storage: ExchangeStorage, user_id: UUID, ticker: TickerStr) -> BalanceORM:
+    balance = await storage.lock_balance(user_id, ticker)
     if not balance:
         raise HTTPException(status_code=404, detail=f"Баланс {ticker} не найден")
     return balance
-
-async def release_user_reserve(session: AsyncSession, user_id: UUID, ticker: str):
-    """
-    Снимает весь резерв (reserved = 0) у пользователя по указанному активу (тикеру).
-    """
-    balance_result = await session.execute(
-        select(BalanceORM).where(BalanceORM.user_id == user_id, BalanceORM.ticker == ticker).with_for_update()
-    )
-    balance = balance_result.scalar_one_or_none()
-
-    if balance is None:
-        raise HTTPException(status_code=404, detail=f"Баланс {ticker} пользователя {user_id} не найден")
-
-    balance.reserved = 0
\ No newline at end of file
@@ -0,0 +1,150 @@
+"""
+Удаление пользователей и инструментов без загрузки зависимых строк в память.
+
+Удаление идет в три шага:
+    1. активные лимитные и ожидающие стоп-ордера отменяются одним UPDATE с проверкой версии после блокировки их балансов,
+       резервы под них снимаются одним проходом по балансам, чтобы ордера сразу ушли из стакана и перестали исполняться;
+    2. история (завершенные ордера, архив, сделки инструмента) удаляется пачками по DELETE_BATCH_SIZE строк,
+       каждая пачка - отдельная короткая транзакция, стакан и балансы при этом не блокируются;
+    3. в последней транзакции строка пользователя или инструмента блокируется (новые ордера ждут коммита),
+       ордера, появившиеся после шага 1, отменяются, и строка удаляется. Оставшиеся ордера, балансы
+       и сделки удаляет Postgres по ON DELETE CASCADE (в ORM у связей passive_deletes).
+"""
+from collections import defaultdict
+from typing import Dict, List, Tuple
+from uuid import UUID
+from sqlalchemy import Table, delete, func, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.config import settings
+from src.dataBase.session import async_session_factory
+from src.dataBase.models.balance import BalanceORM, TransactionORM
+from src.dataBase.models.order import OrderORM, OrderArchiveORM
+from src.api.profile.ledger import record
+from src.api.stockMarket.cache import mark_changed
+from src.engine.book import BookUpdate, record_book_updates
+from src.engine.tape import record_level_changes
+from src.schemas.order import OrderStatus, OrderType, OperationDirection
+
+OPEN_STATUSES = [OrderStatus.NEW, OrderStatus.PART_EXEC]
+TERMINAL_STATUSES = [OrderStatus.EXEC, OrderStatus.CANCELLED]
+RESTING_TYPES = [OrderType.LIMIT, OrderType.STOP_LIMIT, OrderType.STOP]
+
+def reserve_key(user_id: UUID, ticker: str, direction: OperationDirection) -> Tuple[UUID, str]:
+    return user_id, "RUB" if direction == OperationDirection.BUY else ticker
+
+async def cancel_resting_orders(session: AsyncSession, *conditions) -> int:
+    """
+    Отменяет активные лимитные и ожидающие стоп-ордера, подходящие под условия, и снимает оставшиеся резервы ордеров.
+    Блокировки берутся в том же порядке, что и при расчете сделок: сначала балансы, затем строки ордеров.
+    Ордера читаются без блокировок и отменяются с проверкой версии (как в OrderORM.version_id_col);
+    ордера, которые параллельный матчинг успел изменить, перечитываются и отменяются повторно.
+    Версия ордеров увеличивается, поэтому параллельный матчинг, прочитавший их раньше, получит конфликт версии
+    """
+    order = OrderORM.__table__
+    candidates = select(
+        order.c.id,
+        order.c.type,
+        order.c.user_id,
+        order.c.ticker,
+        order.c.direction,
+        order.c.price,
+        order.c.qty - func.coalesce(order.c.filled, 0),
+        order.c.timestamp,
+        order.c.version,
+        order.c.reserved
+    ).where(order.c.type.in_(RESTING_TYPES), order.c.status.in_(OPEN_STATUSES), *conditions)
+    rows = (await session.execute(candidates)).all()
+    if not rows:
+        return 0
+
+    # Резерв ордера после приема только уменьшается, поэтому при повторных чтениях новые балансы не понадобятся
+    keys = sorted({reserve_key(row.user_id, row.ticker, row.direction) for row in rows if row.reserved})
+    balances = []
+    if keys:
+        result = await session.execute(
+            select(BalanceORM)
+            .where(tuple_(BalanceORM.user_id, BalanceORM.ticker).in_(keys))
+            .order_by(BalanceORM.user_id, BalanceORM.ticker)
+            .with_for_update(),
+            execution_options={"populate_existing": True}
+        )
+        balances = result.scalars().all()
+
+    cancelled = []
+    while rows:
+        result = await session.execute(
+            update(order)
+            .where(tuple_(order.c.id, order.c.version).in_([(row.id, row.version) for row in rows]), order.c.status.in_(OPEN_STATUSES))
+            .values(status=OrderStatus.CANCELLED, reserved=0, version=order.c.version + 1)
+            .returning(order.c.id)
+        )
+        done = set(result.scalars())
+        cancelled += [row for row in rows if row.id in done]
+        stale = [row.id for row in rows if row.id not in done]
+        if not stale:
+            break
+        rows = (await session.execute(candidates.where(order.c.id.in_(stale)))).all()
+    if not cancelled:
+        return 0
+
+    reserves: Dict[Tuple[UUID, str], int] = defaultdict(int)
+    updates: List[BookUpdate] = []
+    for order_id, type, user_id, ticker, direction, price, remaining, timestamp, version, reserved in cancelled:
+        # У стоп-рыночных ордеров резерва нет, в стакане лежат только лимитные
+        if reserved:
+            reserves[reserve_key(user_id, ticker, direction)] += reserved
+        if type == OrderType.LIMIT:
+            updates.append(BookUpdate(ticker, order_id, user_id, direction, price, remaining, timestamp, version + 1, False))
+
+    for balance in balances:
+        released = min(balance.reserved, reserves[(balance.user_id, balance.ticker)])
+        balance.reserved -= released
+        record(session, balance.user_id, balance.ticker, reserved=-released)
+
+    record_book_updates(session, updates)
+    record_level_changes(session, [(update.ticker, update.direction, update.price, -update.remaining) for update in updates])
+    mark_changed(session, {update.ticker for update in updates})
+    return len(cancelled)
+
+async def delete_in_batches(table: Table, *conditions) -> int:
+    """
+    Удаляет строки таблицы пачками по DELETE_BATCH_SIZE, каждая пачка в своей транзакции.
+    Возвращает число удаленных строк
+    """
+    primary_key = list(table.primary_key.columns)
+    key = primary_key[0] if len(primary_key) == 1 else tuple_(*primary_key)
+    batch = select(*primary_key).where(*conditions).limit(settings.DELETE_BATCH_SIZE)
+    statement = delete(table).where(key.in_(batch)).returning(primary_key[0])
+
+    total = 0
+    while True:
+        async with async_session_factory() as session:
+            deleted = len((await session.execute(statement)).all())
+            await session.commit()
+        total += deleted
+        if deleted < settings.DELETE_BATCH_SIZE:
+            return total
+
+async def purge_user_history(user_id: UUID) -> int:
+    order, archive = OrderORM.__table__, OrderArchiveORM.__table__
+    deleted = await delete_in_batches(order, order.c.user_id == user_id, order.c.status.in_(TERMINAL_STATUSES))
+    # У архива нет внешних ключей, каскад его не затронет
+    deleted += await delete_in_batches(archive, archive.c.user_id == user_id)
+    return deleted
+
+async def purge_instrument_history(ticker: str) -> int:
+    order, archive, transaction = OrderORM.__table__, OrderArchiveORM.__table__, TransactionORM.__table__
+    deleted = await delete_in_batches(transaction, transaction.c.ticker == ticker)
+    deleted += await delete_in_batches(order, order.c.ticker == ticker, order.c.status.in_(TERMINAL_STATUSES))
+    deleted += await delete_in_batches(archive, archive.c.ticker == ticker)
+    return deleted
+
+async def delete_instrument_balances(session: AsyncSession, ticker: str):
+    # Балансы удаляются явно, а не каскадом, чтобы леджер в памяти узнал об изменении
+    result = await session.execute(
+        delete(BalanceORM.__table__)
+        .where(BalanceORM.__table__.c.ticker == ticker)
+        .returning(BalanceORM.__table__.c.user_id, BalanceORM.__table__.c.amount, BalanceORM.__table__.c.reserved)
+    )
+    for user_id, amount, reserved in result.all():
+        record(session, user_id, ticker, amount=-amount, reserved=-reserved)
@@ -1,22 +1,69 @@
+import time
+from src.config import settings
 from src.schemas.instrument import Instrument, Transaction, TickerStr, LimitInt
 from src.dataBase.models.instrument import InstrumentORM
 from src.api.profile.user import is_admin
 from src.dataBase.session import async_session_factory
 from sqlalchemy import select
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
+from typing import List, Optional, Tuple
 from src.schemas.schemas import succesMessage, OK
 from src.dataBase.models.balance import TransactionORM
+from src.dataBase.models.order import OrderORM
+from src.dataBase.retry import run_with_retry
+from src.api.profile.deletion import cancel_resting_orders, purge_instrument_history, delete_instrument_balances
+from src.engine.book import books
+from src.schemas.serialization import transactions_adapter, instruments_adapter
+from src.api.stockMarket.cache import cached_response, sequences, INSTRUMENTS
 
 
 
 instrument_router = APIRouter(prefix="/api/v1")
 
-@instrument_router.get("/public/instrument", tags=["public"])
+@instrument_router.get("/public/instrument", response_model=List[Instrument], tags=["public"])
+async def get_instruments(request: Request) -> Response:
+    return await cached_response(request, INSTRUMENTS, build_instruments)
+
+class InstrumentCache:
+    """
+    Список инструментов в памяти процесса. Перечитывается после изменения инструментов в этом процессе
+    и не реже раза в INSTRUMENT_CACHE_SECONDS, чтобы увидеть изменения из других воркеров
+    """
+    def __init__(self):
+        self._instruments: Optional[List[Tuple[str, str]]] = None
+        self._sequence = -1
+        self._loaded_at = float("-inf")
+
+    def _valid(self) -> bool:
+        return (
+            self._instruments is not None
+            and self._sequence == sequences.get(INSTRUMENTS)
+            and time.monotonic() - self._loaded_at < settings.INSTRUMENT_CACHE_SECONDS
+        )
+
+    async def get(self) -> List[Tuple[str, str]]:
+        if not self._valid():
+            await self.load()
+        return self._instruments
+
+    async def load(self) -> List[Tuple[str, str]]:
+        # Номер читается до запроса: изменение во время чтения сделает список устаревшим
+        sequence = sequences.get(INSTRUMENTS)
+        loaded_at = time.monotonic()
+        async with async_session_factory() as session:
+            result = await session.execute(select(InstrumentORM.name, InstrumentORM.ticker))
+            instruments = [(name, ticker) for name, ticker in result.all()]
+        self._instruments, self._sequence, self._loaded_at = instruments, sequence, loaded_at
+        return instruments
+
+instrument_cache = InstrumentCache()
+
 async def get_instruments_list() -> List[Instrument]:
-    async with async_session_factory() as session:
-        result = await session.execute(select(InstrumentORM.name, InstrumentORM.ticker))
-        return result.all()
+    return await instrument_cache.get()
+
+async def build_instruments() -> bytes:
+    instruments = await get_instruments_list()
+    return instruments_adapter.dump_json([{"name": name, "ticker": ticker} for name, ticker in instruments])
 
 @instrument_router.post("/admin/instrument", tags=["admin"])
 async def add_instrument(instrument: Instrument, rights: None = Depends(is_admin)) -> OK:
@@ -28,19 +75,48 @@ async def add_instrument(instrument: Instrument, rights: None = Depends(is_admin
 
 @instrument_router.delete("/admin/instrument/{ticker}", tags=["admin"])
 async def del_instrument(ticker : TickerStr, rights: None = Depends(is_admin)) -> OK:
-    async with async_session_factory() as session:
-        result = await session.execute(select(InstrumentORM).filter(InstrumentORM.ticker == ticker))
-        instrument = result.scalar_one_or_none()
-        if instrument is None:
-            raise HTTPException(status_code=404, detail="Instrument not found")
-        await session.delete(instrument)
-        await session.commit()
-        return succesMessage
+    """
+    Удаляет инструмент: отменяет активные ордера с возвратом резервов, пачками удаляет сделки и историю ордеров,
+    затем удаляет инструмент вместе с балансами (оставшееся удаляет каскад в БД)
+    """
+    async def cancel_orders():
+        async with async_session_factory() as session:
+            result = await session.execute(select(InstrumentORM.ticker).filter(InstrumentORM.ticker == ticker))
+            if result.scalar_one_or_none() is None:
+                raise HTTPException(status_code=404, detail="Instrument not found")
+            await cancel_resting_orders(session, OrderORM.ticker == ticker)
+            await session.commit()
+
+    async def delete():
+        async with async_session_factory() as session:
+            # Блокировка строки инструмента: новые ордера, балансы и сделки по тикеру ждут коммита
+            result = await session.execute(select(InstrumentORM).filter(InstrumentORM.ticker == ticker).with_for_update())
+            instrument = result.scalar_one_or_none()
+            if instrument is None:
+                raise HTTPException(status_code=404, detail="Instrument not found")
+            await cancel_resting_orders(session, OrderORM.ticker == ticker)
+            await delete_instrument_balances(session, ticker)
+            await session.delete(instrument)
+            await session.commit()
+
+    await run_with_retry(cancel_orders)
+    await purge_instrument_history(ticker)
+    await run_with_retry(delete)
+    books.drop(ticker)
+    return succesMessage
+
+@instrument_router.get("/public/transaction/{ticker}", response_model=List[Transaction], tags=["public"])
+async def get_transaction_history(request: Request, ticker : TickerStr, limit : LimitInt) -> Response:
+    return await cached_response(request, ticker, lambda: build_transaction_history(ticker, limit))
 
-@instrument_router.get("/public/transaction/{ticker}", tags=["public"])
-async def get_transaction_history(ticker : TickerStr, limit : LimitInt) -> List[Transaction]:
+async def build_transaction_history(ticker: TickerStr, limit: int) -> bytes:
     async with async_session_factory() as session:
-        query = select(TransactionORM).where(TransactionORM.ticker == ticker).order_by(TransactionORM.timestamp).limit(limit)
+        query = (
+            select(TransactionORM.ticker, TransactionORM.amount, TransactionORM.price, TransactionORM.timestamp)
+            .where(TransactionORM.ticker == ticker)
+            .order_by(TransactionORM.timestamp)
+            .limit(limit)
+        )
         result = await session.execute(query)
-        transactions = result.scalars().all()
-        return transactions
+        transactions = [row._asdict() for row in result.all()]
+    return transactions_adapter.dump_json(transactions)
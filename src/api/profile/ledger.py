@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import time
+from uuid import UUID
+from typing import Dict, List, Tuple, Optional
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from src.config import settings
+from src.dataBase.models.balance import BalanceORM
+from src.dataBase.session import async_session_factory
+
+# Изменение баланса: (user_id, ticker, изменение amount, изменение reserved)
+LedgerEvent = Tuple[UUID, str, int, int]
+
+LEDGER_EVENTS_KEY = "ledger_events"
+
+logger = logging.getLogger(__name__)
+
+class AccountLedger:
+    """
+    Балансы активных пользователей в памяти процесса: amount и reserved по каждому тикеру.
+    Обновляется приращениями после коммита транзакций и периодически сверяется с таблицей balance.
+
+    Снимок из БД читается с await: приращение, закоммиченное за это время, могло не попасть в снимок или
+    уже примениться к старому состоянию. Поэтому перед чтением снимок отмечается счетчиком изменений
+    пользователя (stamp), и load() отбрасывает снимок, если с отметки к пользователю приходили изменения
+    """
+    def __init__(self):
+        self._accounts: Dict[UUID, Dict[str, List[int]]] = {}
+        self._last_read: Dict[UUID, float] = {}
+        # Число примененных приращений по пользователям, которые загружены или загружаются
+        self._versions: Dict[UUID, int] = {}
+
+    def __contains__(self, user_id: UUID) -> bool:
+        return user_id in self._accounts
+
+    def get(self, user_id: UUID) -> Optional[Dict[str, Tuple[int, int]]]:
+        account = self._accounts.get(user_id)
+        if account is None:
+            return None
+        self._last_read[user_id] = time.monotonic()
+        return {ticker: (amount, reserved) for ticker, (amount, reserved) in account.items()}
+
+    def stamp(self, user_ids: List[UUID]) -> Dict[UUID, int]:
+        return {user_id: self._versions.setdefault(user_id, 0) for user_id in user_ids}
+
+    def load(self, user_id: UUID, rows: List[Tuple[str, int, int]], version: int) -> bool:
+        """
+        Заменяет счет снимком из БД, прочитанным после stamp(). Возвращает False, если снимок устарел
+        """
+        if self._versions.get(user_id) != version:
+            return False
+        self._accounts[user_id] = {ticker: [amount, reserved] for ticker, amount, reserved in rows}
+        self._last_read.setdefault(user_id, time.monotonic())
+        return True
+
+    def apply(self, events: List[LedgerEvent]):
+        # Пользователи, которых нет в памяти, будут загружены из БД при первом чтении
+        for user_id, ticker, amount, reserved in events:
+            if user_id in self._versions:
+                self._versions[user_id] += 1
+            account = self._accounts.get(user_id)
+            if account is None:
+                continue
+            balance = account.setdefault(ticker, [0, 0])
+            balance[0] += amount
+            balance[1] += reserved
+
+    def forget(self, user_id: UUID):
+        self._accounts.pop(user_id, None)
+        self._last_read.pop(user_id, None)
+        self._versions.pop(user_id, None)
+
+    def active_users(self) -> List[UUID]:
+        return list(self._accounts)
+
+    def evict_idle(self, idle_seconds: float):
+        deadline = time.monotonic() - idle_seconds
+        for user_id, last_read in list(self._last_read.items()):
+            if last_read < deadline:
+                self.forget(user_id)
+
+ledger = AccountLedger()
+
+def record(session, user_id: UUID, ticker: str, amount: int = 0, reserved: int = 0):
+    """
+    Запоминает изменение баланса в рамках сессии; в леджер оно попадет только после коммита
+    """
+    if amount == 0 and reserved == 0:
+        return
+    session.info.setdefault(LEDGER_EVENTS_KEY, []).append((user_id, ticker, amount, reserved))
+
+@event.listens_for(Session, "after_commit")
+def _apply_committed(session: Session):
+    events = session.info.pop(LEDGER_EVENTS_KEY, None)
+    if events:
+        ledger.apply(events)
+
+@event.listens_for(Session, "after_transaction_end")
+def _discard_uncommitted(session: Session, transaction):
+    # Откат или закрытие сессии без коммита: изменения в леджер не попадают
+    if transaction.parent is None:
+        session.info.pop(LEDGER_EVENTS_KEY, None)
+
+async def get_account(user_id: UUID) -> Dict[str, Tuple[int, int]]:
+    account = ledger.get(user_id)
+    if account is not None:
+        return account
+
+    version = ledger.stamp([user_id])[user_id]
+    async with async_session_factory() as session:
+        result = await session.execute(
+            select(BalanceORM.ticker, BalanceORM.amount, BalanceORM.reserved).where(BalanceORM.user_id == user_id)
+        )
+        rows = result.all()
+    if ledger.load(user_id, rows, version):
+        return ledger.get(user_id)
+    # Пока шло чтение, балансы изменились: ответ - прочитанный снимок, в память он не попадает
+    return {ticker: (amount, reserved) for ticker, amount, reserved in rows}
+
+async def reconcile_ledger():
+    """
+    Перечитывает из БД балансы всех пользователей, находящихся в памяти, и вытесняет неактивных
+    """
+    ledger.evict_idle(settings.LEDGER_IDLE_SECONDS)
+    users = ledger.active_users()
+    if not users:
+        return
+
+    accounts: Dict[UUID, List[Tuple[str, int, int]]] = {user_id: [] for user_id in users}
+    versions = ledger.stamp(users)
+    async with async_session_factory() as session:
+        result = await session.execute(
+            select(BalanceORM.user_id, BalanceORM.ticker, BalanceORM.amount, BalanceORM.reserved)
+            .where(BalanceORM.user_id.in_(users))
+        )
+        for user_id, ticker, amount, reserved in result.all():
+            accounts[user_id].append((ticker, amount, reserved))
+
+    # Пользователи, у которых за время чтения менялись балансы, сверятся в следующий раз
+    for user_id, rows in accounts.items():
+        if user_id in ledger:
+            ledger.load(user_id, rows, versions[user_id])
+
+async def run_ledger_reconciliation():
+    while True:
+        await asyncio.sleep(settings.LEDGER_RECONCILE_SECONDS)
+        try:
+            await reconcile_ledger()
+        except Exception:
+            logger.exception("Не удалось сверить леджер с таблицей balance")
@@ -1,15 +1,54 @@
-import jwt
+import time
 import uuid
 from sqlalchemy import select
 from fastapi import Depends, HTTPException, Header , status, APIRouter
 from src.config import settings
 from src.schemas.user import User, NewUser, Role
 from src.dataBase.models.user import UserORM
+from src.dataBase.models.order import OrderORM
 from src.dataBase.session import async_session_factory
-from typing import Optional
+from src.dataBase.retry import run_with_retry
+from src.api.profile.ledger import ledger
+from src.api.profile.deletion import cancel_resting_orders, purge_user_history
+from typing import Dict, Optional, Tuple
 
 auth_router = APIRouter(prefix='/api/v1')
 
+class ApiKeyCache:
+    """
+    Пользователи по API-ключу в памяти процесса, заполняется при аутентификации. Запись живет API_KEY_CACHE_SECONDS:
+    удаление пользователя в этом процессе сразу убирает его ключ, в другом воркере - становится видно здесь
+    не позже этого срока. Срок короткий намеренно: это окно, в котором удаленный ключ еще принимается
+    """
+    def __init__(self):
+        self._users: Dict[str, Tuple[User, float]] = {}
+        # Истекшие записи удаляются при чтении и пачкой, когда кэш вырос вдвое с прошлой чистки
+        self._sweep_at = 1024
+
+    def get(self, api_key: str) -> Optional[User]:
+        entry = self._users.get(api_key)
+        if entry is None:
+            return None
+        user, stored_at = entry
+        if time.monotonic() - stored_at >= settings.API_KEY_CACHE_SECONDS:
+            del self._users[api_key]
+            return None
+        return user
+
+    def put(self, user: User):
+        if settings.API_KEY_CACHE_SECONDS <= 0:
+            return
+        now = time.monotonic()
+        if len(self._users) >= self._sweep_at:
+            self._users = {key: entry for key, entry in self._users.items() if now - entry[1] < settings.API_KEY_CACHE_SECONDS}
+            self._sweep_at = max(1024, 2 * len(self._users))
+        self._users[user.api_key] = (user, now)
+
+    def discard(self, api_key: str):
+        self._users.pop(api_key, None)
+
+api_keys = ApiKeyCache()
+
 async def get_user_by_token(token: Optional[str] = Header(alias="authorization")) -> User:
     if token is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Authorization header missing")
@@ -18,12 +57,17 @@ async def get_user_by_token(token: Optional[str] = Header(alias="authorization")
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authorization header format")
 
     token = token.split(" ", 1)[1]
+    cached = api_keys.get(token)
+    if cached is not None:
+        return cached
     async with async_session_factory() as session:
         result = await session.execute(select(UserORM).filter(UserORM.api_key == token))
         user = result.scalar_one_or_none()
         if user is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='token invalid')
-        return User(id=user.id, name=user.name, role=user.role, api_key=user.api_key)
+        found = User(id=user.id, name=user.name, role=user.role, api_key=user.api_key)
+    api_keys.put(found)
+    return found
 
 
 async def is_admin(user: User = Depends(get_user_by_token)) -> None:
@@ -33,6 +77,8 @@ async def is_admin(user: User = Depends(get_user_by_token)) -> None:
 
 @auth_router.post('/public/register', tags=["public"])
 async def register_user(newUser: NewUser) -> User:
+    # jwt нужен только при регистрации, не загружаем его при старте
+    import jwt
     token = jwt.encode(payload={"name": newUser.name}, key=settings.SECRET_JWT_KEY, algorithm='HS256')
     user = UserORM(id=uuid.uuid4(),name=newUser.name, role=newUser.role, api_key = token)
     async with async_session_factory() as session:
@@ -43,13 +89,35 @@ async def register_user(newUser: NewUser) -> User:
 
 @auth_router.delete('/admin/user/{user_id}', tags=["admin", "user"])
 async def delete_user(user_id : uuid.UUID, token : str = Depends(is_admin)) -> User:
-    async with async_session_factory() as session:
-        result = await session.execute(select(UserORM).filter(UserORM.id == user_id))
-        user = result.scalar_one_or_none()
-        if user is None:
-            raise HTTPException(status_code=404, detail="User not found")
-        await session.delete(user)
-        await session.commit()
+    """
+    Удаляет пользователя: отменяет его активные ордера, пачками удаляет историю ордеров,
+    затем удаляет пользователя (балансы и оставшиеся ордера удаляет каскад в БД)
+    """
+    async def cancel_orders():
+        async with async_session_factory() as session:
+            result = await session.execute(select(UserORM.id).filter(UserORM.id == user_id))
+            if result.scalar_one_or_none() is None:
+                raise HTTPException(status_code=404, detail="User not found")
+            await cancel_resting_orders(session, OrderORM.user_id == user_id)
+            await session.commit()
+
+    async def delete():
+        async with async_session_factory() as session:
+            # Блокировка строки пользователя: новые ордера и балансы ждут коммита и не переживут удаление
+            result = await session.execute(select(UserORM).filter(UserORM.id == user_id).with_for_update())
+            user = result.scalar_one_or_none()
+            if user is None:
+                raise HTTPException(status_code=404, detail="User not found")
+            await cancel_resting_orders(session, OrderORM.user_id == user_id)
+            await session.delete(user)
+            await session.commit()
+            return user
+
+    await run_with_retry(cancel_orders)
+    await purge_user_history(user_id)
+    user = await run_with_retry(delete)
+    ledger.forget(user_id)
+    api_keys.discard(user.api_key)
     return User(id=user.id, name = user.name, role = user.role, api_key=user.api_key)
 
 
@@ -0,0 +1,13 @@
+from fastapi import APIRouter, Depends
+from typing import Dict
+from src.api.profile.user import is_admin
+from src.metrics import metrics
+
+metrics_router = APIRouter(prefix='/api/v1')
+
+@metrics_router.get("/admin/metrics", tags=["admin"])
+async def get_metrics(rights: None = Depends(is_admin)) -> Dict[str, int]:
+    """
+    Возвращает счетчики процесса (взаимоблокировки, повторы транзакций и т.д.)
+    """
+    return metrics.snapshot()
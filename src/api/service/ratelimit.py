@@ -0,0 +1,189 @@
+"""
+Ограничение частоты запросов и контроль допуска.
+
+Каждый запрос относится к полосе (lane):
+    * submit - создание ордера (POST /order);
+    * cancel - отмена ордера (DELETE /order/{id});
+    * default - все остальное.
+
+1. Token bucket на пару (полоса, API-ключ), для запросов без ключа - (полоса, IP клиента).
+   У каждой полосы свой бюджет, поэтому поток новых ордеров не расходует лимит на отмены.
+   Бакеты хранятся в памяти процесса или в Redis (RATE_LIMIT_BACKEND=redis) для нескольких воркеров.
+2. Допуск по числу одновременно выполняемых запросов: не больше ADMISSION_MAX_INFLIGHT (меньше пула соединений БД),
+   из них ADMISSION_RESERVED_FOR_CANCEL мест доступны только отменам.
+
+Запрос сверх лимита сразу получает 429 с заголовком Retry-After, не дожидаясь соединения из пула.
+"""
+import logging
+import math
+import time
+from hashlib import blake2b, sha1
+from typing import Dict, Tuple
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+from src.config import settings
+from src.dataBase.redis_pool import batcher, get_redis
+from src.metrics import metrics
+
+SUBMIT = "submit"
+CANCEL = "cancel"
+DEFAULT = "default"
+
+logger = logging.getLogger(__name__)
+
+def lane_limits(lane: str) -> Tuple[float, int]:
+    # (пополнение токенов в секунду, емкость бакета)
+    if lane == SUBMIT:
+        return settings.RATE_LIMIT_SUBMIT_PER_SECOND, settings.RATE_LIMIT_SUBMIT_BURST
+    if lane == CANCEL:
+        return settings.RATE_LIMIT_CANCEL_PER_SECOND, settings.RATE_LIMIT_CANCEL_BURST
+    return settings.RATE_LIMIT_DEFAULT_PER_SECOND, settings.RATE_LIMIT_DEFAULT_BURST
+
+def classify(method: str, path: str) -> str:
+    if path == "/api/v1/order" and method == "POST":
+        return SUBMIT
+    if path.startswith("/api/v1/order/") and method == "DELETE":
+        return CANCEL
+    return DEFAULT
+
+class MemoryTokenBuckets:
+    """
+    Token bucket в памяти процесса: (токены, время последнего пополнения) по ключу
+    """
+    PRUNE_EVERY = 10_000
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._calls = 0
+
+    async def acquire(self, key: str, rate: float, burst: int) -> float:
+        """
+        Забирает токен; возвращает 0, если запрос разрешен, иначе через сколько секунд появится токен
+        """
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+
+        self._calls += 1
+        if self._calls % self.PRUNE_EVERY == 0:
+            self._prune(now)
+
+        if tokens >= 1:
+            self._buckets[key] = (tokens - 1, now)
+            return 0.0
+        self._buckets[key] = (tokens, now)
+        return (1 - tokens) / rate
+
+    def _prune(self, now: float):
+        # Бакет, который успел бы пополниться до конца, ничем не отличается от нового
+        idle = settings.RATE_LIMIT_IDLE_SECONDS
+        for key, (_, updated) in list(self._buckets.items()):
+            if now - updated > idle:
+                del self._buckets[key]
+
+class RedisTokenBuckets:
+    """
+    Token bucket в Redis: проверка и списание выполняются одним Lua-скриптом по часам сервера Redis.
+    Проверки параллельных запросов уходят в Redis общим pipeline (CommandBatcher), скрипт вызывается по SHA
+    """
+    SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(state[1]) or burst
+        local updated = tonumber(state[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+        return tostring(wait)
+    """
+
+    SHA = sha1(SCRIPT.encode()).hexdigest()
+
+    async def acquire(self, key: str, rate: float, burst: int) -> float:
+        from redis.exceptions import NoScriptError
+
+        try:
+            wait = await batcher.execute("EVALSHA", self.SHA, 1, f"ratelimit:{key}", rate, burst)
+        except NoScriptError:
+            # Кэш скриптов Redis пуст (перезапуск или SCRIPT FLUSH): загружаем скрипт и повторяем
+            await get_redis().script_load(self.SCRIPT)
+            wait = await batcher.execute("EVALSHA", self.SHA, 1, f"ratelimit:{key}", rate, burst)
+        return float(wait)
+
+class AdmissionController:
+    """
+    Счетчик выполняемых запросов с резервом мест под отмены ордеров
+    """
+    def __init__(self):
+        self.inflight = 0
+
+    def try_acquire(self, lane: str) -> bool:
+        limit = settings.ADMISSION_MAX_INFLIGHT
+        if lane != CANCEL:
+            limit -= settings.ADMISSION_RESERVED_FOR_CANCEL
+        if self.inflight >= limit:
+            return False
+        self.inflight += 1
+        return True
+
+    def release(self):
+        self.inflight -= 1
+
+def client_identity(scope: Scope) -> str:
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            # В хранилище бакетов попадает хэш ключа, а не сам ключ
+            return "key:" + blake2b(value, digest_size=16).hexdigest()
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}"
+
+def too_many_requests(detail: str, retry_after: float) -> JSONResponse:
+    return JSONResponse(
+        status_code=429,
+        content={"detail": detail},
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+class RateLimitMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.buckets = RedisTokenBuckets() if settings.RATE_LIMIT_BACKEND == "redis" else MemoryTokenBuckets()
+        self.admission = AdmissionController()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not settings.RATE_LIMIT_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        lane = classify(scope["method"], scope["path"])
+        rate, burst = lane_limits(lane)
+        try:
+            wait = await self.buckets.acquire(f"{lane}:{client_identity(scope)}", rate, burst)
+        except Exception:
+            # Недоступное хранилище бакетов не должно останавливать биржу
+            metrics.increment("rate_limit_backend_errors")
+            logger.exception("Не удалось проверить лимит запросов")
+            wait = 0.0
+
+        if wait > 0:
+            metrics.increment(f"rate_limited_{lane}")
+            await too_many_requests("Слишком много запросов", wait)(scope, receive, send)
+            return
+
+        if not self.admission.try_acquire(lane):
+            metrics.increment(f"admission_rejected_{lane}")
+            await too_many_requests("Сервер перегружен, повторите запрос позже", 1)(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.admission.release()
@@ -0,0 +1,77 @@
+"""
+Прогрев воркера при старте: инструменты и стаканы загружаются до того, как воркер
+объявит себя готовым (GET /api/v1/public/ready). API-ключи не прогреваются: кэш ключей заполняется по запросам.
+
+Сначала читается список инструментов, затем параллельно загружаются стаканы тикеров, не больше
+WARMUP_CONCURRENCY тикеров одновременно, чтобы прогрев не занимал весь пул соединений.
+Ход прогрева виден в /api/v1/admin/metrics:
+    warmup_tickers_total, warmup_tickers_loaded, warmup_orders_loaded,
+    warmup_duration_ms, warmup_failures, ready.
+"""
+import asyncio
+import logging
+import time
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from src.config import settings
+from src.metrics import metrics
+from src.engine.book import books
+from src.api.profile.instrument import instrument_cache
+
+readiness_router = APIRouter(prefix='/api/v1')
+
+logger = logging.getLogger(__name__)
+
+class Readiness:
+    def __init__(self):
+        self.ready = False
+
+    def set(self, ready: bool):
+        self.ready = ready
+        metrics.set("ready", int(ready))
+
+readiness = Readiness()
+
+async def warm_up():
+    started = time.perf_counter()
+    instruments = await instrument_cache.load()
+    # Стаканы в памяти нужны, только если воркер один (books.owns_writes)
+    tickers = sorted(ticker for _, ticker in instruments) if books.owns_writes else []
+    metrics.set("warmup_tickers_total", len(tickers))
+    metrics.set("warmup_tickers_loaded", 0)
+    metrics.set("warmup_orders_loaded", 0)
+
+    semaphore = asyncio.Semaphore(settings.WARMUP_CONCURRENCY)
+
+    async def load_ticker(ticker: str):
+        async with semaphore:
+            loaded = await books.load(ticker)
+        metrics.increment("warmup_orders_loaded", loaded)
+        metrics.increment("warmup_tickers_loaded")
+
+    await asyncio.gather(*(load_ticker(ticker) for ticker in tickers))
+    duration_ms = round((time.perf_counter() - started) * 1000)
+    metrics.set("warmup_duration_ms", duration_ms)
+    logger.info("Прогрев завершен за %d ms: тикеров %d, ордеров %d", duration_ms, len(tickers), metrics.get("warmup_orders_loaded"))
+
+async def run_warmup():
+    # Воркер принимает запросы и во время прогрева, но балансировщик не направит трафик, пока ready = False
+    readiness.set(False)
+    while True:
+        try:
+            await warm_up()
+            break
+        except Exception:
+            metrics.increment("warmup_failures")
+            logger.exception("Не удалось прогреть воркер, повтор через %d с", settings.WARMUP_RETRY_SECONDS)
+            await asyncio.sleep(settings.WARMUP_RETRY_SECONDS)
+    readiness.set(True)
+
+@readiness_router.get("/public/ready", tags=["public"])
+async def get_readiness() -> JSONResponse:
+    """
+    Готовность воркера принимать трафик: 503, пока не загружены стаканы и инструменты
+    """
+    if not readiness.ready:
+        return JSONResponse(status_code=503, content={"ready": False})
+    return JSONResponse(content={"ready": True})
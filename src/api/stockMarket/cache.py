@@ -0,0 +1,128 @@
+import time
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from hashlib import blake2b
+from itertools import chain
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+from fastapi import Request, Response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from src.config import settings
+from src.dataBase.models.order import OrderORM
+from src.dataBase.models.balance import TransactionORM
+from src.dataBase.models.instrument import InstrumentORM
+
+CHANGED_TICKERS_KEY = "changed_tickers"
+# Отдельная последовательность для списка инструментов
+INSTRUMENTS = "*instruments"
+# Клиенты могут хранить ответ, но перед использованием обязаны сверить ETag
+PUBLIC_CACHE_CONTROL = "public, no-cache"
+
+class TickerSequences:
+    """
+    Номер изменения по каждому тикеру: увеличивается после каждого коммита, затронувшего ордера или сделки тикера.
+    Номера живут в памяти процесса и используются как ключ кэша ответов
+    """
+    def __init__(self):
+        self._sequences: Dict[str, int] = defaultdict(int)
+
+    def bump(self, keys: Iterable[str]):
+        for key in keys:
+            self._sequences[key] += 1
+
+    def get(self, key: str) -> int:
+        return self._sequences.get(key, 0)
+
+    def snapshot(self) -> Dict[str, int]:
+        return dict(self._sequences)
+
+sequences = TickerSequences()
+
+@event.listens_for(Session, "after_flush")
+def _collect_changed_tickers(session: Session, flush_context):
+    changed = session.info.setdefault(CHANGED_TICKERS_KEY, set())
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance, (OrderORM, TransactionORM)):
+            changed.add(instance.ticker)
+        elif isinstance(instance, InstrumentORM):
+            changed.update((instance.ticker, INSTRUMENTS))
+
+def mark_changed(session: Session, keys: Iterable[str]):
+    # Для изменений в обход ORM (массовые UPDATE и DELETE), которые слушатель flush не видит
+    session.info.setdefault(CHANGED_TICKERS_KEY, set()).update(keys)
+
+@event.listens_for(Session, "after_commit")
+def _bump_committed(session: Session):
+    changed = session.info.pop(CHANGED_TICKERS_KEY, None)
+    if changed:
+        sequences.bump(changed)
+
+@event.listens_for(Session, "after_transaction_end")
+def _discard_uncommitted(session: Session, transaction):
+    if transaction.parent is None:
+        session.info.pop(CHANGED_TICKERS_KEY, None)
+
+def make_etag(body: bytes) -> str:
+    # ETag по содержимому: совпадает между процессами, даже если номера изменений у них разные
+    return f'"{blake2b(body, digest_size=16).hexdigest()}"'
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+@dataclass
+class CachedResponse:
+    body: bytes
+    etag: str
+    sequence: int
+    stored_at: float
+
+class ResponseCache:
+    """
+    LRU-кэш готовых JSON-ответов по ключу (путь, параметры) и номеру изменения.
+    Запись старше RESPONSE_CACHE_TTL_SECONDS пересобирается, чтобы изменения из других процессов
+    были видны с ограниченной задержкой
+    """
+    def __init__(self):
+        self._entries: "OrderedDict[Tuple, CachedResponse]" = OrderedDict()
+
+    def get(self, key: Tuple, sequence: int) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None or entry.sequence != sequence or time.monotonic() - entry.stored_at >= settings.RESPONSE_CACHE_TTL_SECONDS:
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: Tuple, sequence: int, body: bytes) -> CachedResponse:
+        entry = CachedResponse(body=body, etag=make_etag(body), sequence=sequence, stored_at=time.monotonic())
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > settings.RESPONSE_CACHE_MAX_ENTRIES:
+            self._entries.popitem(last=False)
+        return entry
+
+response_cache = ResponseCache()
+
+def conditional_response(request: Request, body: bytes, etag: str) -> Response:
+    """
+    Отдает 304 без тела, если If-None-Match совпал с ETag, иначе готовые байты JSON
+    """
+    headers = {"ETag": etag, "Cache-Control": PUBLIC_CACHE_CONTROL}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+async def cached_response(request: Request, key: str, build: Callable[[], Awaitable[bytes]]) -> Response:
+    """
+    Ответ публичного эндпоинта из кэша; build вызывается, только если с прошлого ответа
+    номер изменения key поменялся или запись устарела
+    """
+    # Номер читается до сборки: изменение во время сборки сделает запись устаревшей
+    sequence = sequences.get(key)
+    cache_key = (request.url.path, tuple(sorted(request.query_params.multi_items())))
+    entry = response_cache.get(cache_key, sequence)
+    if entry is None:
+        entry = response_cache.put(cache_key, sequence, await build())
+    return conditional_response(request, entry.body, entry.etag)
@@ -0,0 +1,113 @@
+import datetime
+from uuid import UUID
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from typing import List, Optional, Tuple
+from fastapi import APIRouter, Depends, HTTPException, Response
+from sqlalchemy import select, literal, tuple_, union_all
+from src.dataBase.session import async_session_factory
+from src.dataBase.models.balance import TransactionORM
+from src.api.profile.user import get_user_by_token
+from src.schemas.user import User
+from src.schemas.order import OperationDirection, PageLimitInt
+from src.schemas.fill import Fill, LiquidityRole
+from src.schemas.serialization import FillDict, fills_adapter
+
+fill_router = APIRouter(prefix="/api/v1")
+
+FillCursor = Tuple[datetime.datetime, UUID, LiquidityRole]
+
+@fill_router.get("/fills", response_model=List[Fill], tags=["order"])
+async def list_fills(
+    user: User = Depends(get_user_by_token),
+    order_id: Optional[UUID] = None,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    limit: PageLimitInt = 100,
+    after: Optional[str] = None
+) -> Response:
+    """
+    Возвращает исполнения пользователя в порядке времени сделки.
+    Курсор следующей страницы отдается в заголовке X-Next-Cursor
+    """
+    cursor = decode_fill_cursor(after) if after is not None else None
+    branches = [
+        fills_side_query(user.id, role, order_id, since, until, cursor).limit(limit)
+        for role in LiquidityRole
+    ]
+    fills = union_all(*branches).subquery()
+    query = select(fills).order_by(fills.c.timestamp, fills.c.id, fills.c.role).limit(limit)
+
+    async with async_session_factory() as session:
+        rows = (await session.execute(query)).all()
+
+    response = Response(content=fills_adapter.dump_json([fill_to_dict(row) for row in rows]), media_type="application/json")
+    if len(rows) == limit:
+        last = rows[-1]
+        response.headers["X-Next-Cursor"] = encode_fill_cursor(last.timestamp, last.id, LiquidityRole(last.role))
+    return response
+
+def fills_side_query(
+    user_id: UUID,
+    role: LiquidityRole,
+    order_id: Optional[UUID],
+    since: Optional[datetime.datetime],
+    until: Optional[datetime.datetime],
+    cursor: Optional[FillCursor]
+):
+    """
+    Исполнения пользователя с одной стороны сделки; каждая сторона читается по своему индексу (user_id, timestamp, id)
+    """
+    if role == LiquidityRole.MAKER:
+        user_column, order_column = TransactionORM.maker_user_id, TransactionORM.maker_order_id
+    else:
+        user_column, order_column = TransactionORM.taker_user_id, TransactionORM.taker_order_id
+
+    query = select(
+        TransactionORM.id,
+        TransactionORM.ticker,
+        TransactionORM.amount,
+        TransactionORM.price,
+        TransactionORM.timestamp,
+        TransactionORM.taker_direction,
+        order_column.label("order_id"),
+        literal(role.value).label("role"),
+    ).where(user_column == user_id)
+
+    if order_id is not None:
+        query = query.where(order_column == order_id)
+    if since is not None:
+        query = query.where(TransactionORM.timestamp >= since)
+    if until is not None:
+        query = query.where(TransactionORM.timestamp < until)
+    if cursor is not None:
+        timestamp, trade_id, cursor_role = cursor
+        # При равных (timestamp, id) - самосделка - порядок сторон задается ролью
+        key = tuple_(TransactionORM.timestamp, TransactionORM.id)
+        query = query.where(key >= (timestamp, trade_id) if role.value > cursor_role.value else key > (timestamp, trade_id))
+
+    return query.order_by(TransactionORM.timestamp, TransactionORM.id)
+
+def fill_to_dict(row) -> FillDict:
+    direction = row.taker_direction
+    if row.role == LiquidityRole.MAKER:
+        direction = OperationDirection.SELL if direction == OperationDirection.BUY else OperationDirection.BUY
+    return {
+        "trade_id": row.id,
+        "order_id": row.order_id,
+        "ticker": row.ticker,
+        "direction": direction,
+        "role": LiquidityRole(row.role),
+        "qty": row.amount,
+        "price": row.price,
+        "timestamp": row.timestamp,
+    }
+
+def encode_fill_cursor(timestamp: datetime.datetime, trade_id: UUID, role: LiquidityRole) -> str:
+    return urlsafe_b64encode(f"{timestamp.isoformat()}|{trade_id}|{role.value}".encode()).decode()
+
+def decode_fill_cursor(cursor: str) -> FillCursor:
+    try:
+        timestamp, trade_id, role = urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.datetime.fromisoformat(timestamp), UUID(trade_id), LiquidityRole(role)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
@@ -0,0 +1,159 @@
+import asyncio
+import datetime
+import time
+from typing import Dict, List, Optional, Tuple
+from fastapi import APIRouter, Request, Response
+from sqlalchemy import select, func, case, desc
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.config import settings
+from src.api.stockMarket.cache import sequences, make_etag, conditional_response
+from src.dataBase.session import async_session_factory
+from src.dataBase.models.order import OrderORM
+from src.dataBase.models.balance import TransactionORM
+from src.dataBase.models.instrument import InstrumentORM
+from src.schemas.order import OrderStatus, OrderType, OperationDirection, TickerMarketData
+from src.schemas.serialization import MarketDataDict, marketdata_adapter
+
+marketdata_router = APIRouter(prefix="/api/v1")
+
+class MarketDataSnapshot:
+    """
+    Снимок рыночных данных по всем тикерам: лучшие цены, последняя сделка, объем за 24 часа и верх стакана.
+    Тикеры, у которых сменился номер изменения (sequences), пересобираются при следующем чтении.
+    Весь снимок пересобирается не реже раза в MARKETDATA_MAX_AGE_SECONDS: так в него попадают изменения
+    из других процессов и сдвиг окна 24 часов.
+    """
+    def __init__(self):
+        self._entries: Dict[str, MarketDataDict] = {}
+        # Номера изменений тикеров, по которым собран снимок
+        self._seen: Dict[str, int] = {}
+        self._built_at = float("-inf")
+        self._body = b"[]"
+        self._etag = ""
+        self._lock = asyncio.Lock()
+
+    def _expired(self) -> bool:
+        return time.monotonic() - self._built_at >= settings.MARKETDATA_MAX_AGE_SECONDS
+
+    def _changed(self) -> Dict[str, int]:
+        return {ticker: sequence for ticker, sequence in sequences.snapshot().items() if self._seen.get(ticker) != sequence}
+
+    async def get(self) -> Tuple[bytes, str]:
+        """
+        Возвращает JSON снимка и его ETag; пока ничего не менялось, запросов к БД нет
+        """
+        if self._expired() or self._changed():
+            async with self._lock:
+                if self._expired() or self._changed():
+                    await self._rebuild()
+        return self._body, self._etag
+
+    async def _rebuild(self):
+        full = self._expired()
+        # Номера читаются до запроса: изменение во время пересборки будет подхвачено следующим чтением
+        changed = sequences.snapshot() if full else self._changed()
+        started = time.monotonic()
+        async with async_session_factory() as session:
+            entries = await load_market_data(session, None if full else sorted(changed))
+
+        if full:
+            self._entries = entries
+            self._seen = changed
+            self._built_at = started
+        else:
+            for ticker in changed:
+                if ticker in entries:
+                    self._entries[ticker] = entries[ticker]
+                else:
+                    self._entries.pop(ticker, None)
+            self._seen.update(changed)
+
+        body = marketdata_adapter.dump_json([self._entries[ticker] for ticker in sorted(self._entries)])
+        if body != self._body or not self._etag:
+            self._body = body
+            self._etag = make_etag(body)
+
+snapshot = MarketDataSnapshot()
+
+async def load_market_data(session: AsyncSession, tickers: Optional[List[str]] = None) -> Dict[str, MarketDataDict]:
+    """
+    Собирает рыночные данные по указанным тикерам (по всем, если None) двумя запросами:
+    статистика сделок по инструментам и верх стакана по всем тикерам сразу
+    """
+    since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=24)
+    last_price = (
+        select(TransactionORM.price)
+        .where(TransactionORM.ticker == InstrumentORM.ticker)
+        .order_by(desc(TransactionORM.timestamp))
+        .limit(1)
+        .scalar_subquery()
+    )
+    volume = (
+        select(func.coalesce(func.sum(TransactionORM.amount), 0))
+        .where(TransactionORM.ticker == InstrumentORM.ticker, TransactionORM.timestamp >= since)
+        .scalar_subquery()
+    )
+    stats_query = select(InstrumentORM.ticker, last_price, volume)
+    if tickers is not None:
+        stats_query = stats_query.where(InstrumentORM.ticker.in_(tickers))
+
+    entries: Dict[str, MarketDataDict] = {
+        ticker: {
+            "ticker": ticker,
+            "best_bid": None,
+            "best_ask": None,
+            "last_price": price,
+            "volume_24h": volume_24h,
+            "bid_levels": [],
+            "ask_levels": [],
+        }
+        for ticker, price, volume_24h in (await session.execute(stats_query)).all()
+    }
+    if not entries:
+        return entries
+
+    # Уровни каждой стороны нумеруются от лучшей цены, в снимок попадают первые MARKETDATA_DEPTH
+    rank = func.row_number().over(
+        partition_by=(OrderORM.ticker, OrderORM.direction),
+        order_by=case((OrderORM.direction == OperationDirection.BUY, -OrderORM.price), else_=OrderORM.price)
+    )
+    levels = (
+        select(
+            OrderORM.ticker,
+            OrderORM.direction,
+            OrderORM.price,
+            func.sum(OrderORM.qty - func.coalesce(OrderORM.filled, 0)).label("qty"),
+            rank.label("rank")
+        )
+        .where(
+            OrderORM.ticker.in_(list(entries)),
+            OrderORM.type == OrderType.LIMIT,
+            OrderORM.status.in_([OrderStatus.NEW, OrderStatus.PART_EXEC])
+        )
+        .group_by(OrderORM.ticker, OrderORM.direction, OrderORM.price)
+        .subquery()
+    )
+    depth_query = (
+        select(levels.c.ticker, levels.c.direction, levels.c.price, levels.c.qty)
+        .where(levels.c.rank <= settings.MARKETDATA_DEPTH)
+        .order_by(levels.c.ticker, levels.c.direction, levels.c.rank)
+    )
+    for ticker, direction, price, qty in (await session.execute(depth_query)).all():
+        side = "bid_levels" if direction == OperationDirection.BUY else "ask_levels"
+        entries[ticker][side].append({"price": price, "qty": qty})
+
+    for entry in entries.values():
+        if entry["bid_levels"]:
+            entry["best_bid"] = entry["bid_levels"][0]["price"]
+        if entry["ask_levels"]:
+            entry["best_ask"] = entry["ask_levels"][0]["price"]
+    return entries
+
+@marketdata_router.get("/public/marketdata", response_model=List[TickerMarketData], tags=["public"])
+async def get_marketdata(request: Request) -> Response:
+    """
+    Рыночные данные по всем тикерам одним ответом из снимка в памяти.
+    Поддерживает If-None-Match: если снимок не изменился, отдается 304 без тела
+    """
+    body, etag = await snapshot.get()
+    return conditional_response(request, body, etag)
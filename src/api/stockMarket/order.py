@@ -1,116 +1,80 @@
-from uuid import UUID, uuid4
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, desc, asc
-from asyncio import gather
+from uuid import UUID
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, tuple_, union_all
 import datetime
-from typing import List, Dict, Any, Tuple, Optional, Union, overload
+from typing import List, Dict, Any, Set, Tuple, Optional
 from src.dataBase.session import async_session_factory
-from src.dataBase.models.order import OrderORM
-from src.dataBase.models.balance import BalanceORM, TransactionORM
+from src.dataBase.retry import run_with_retry
+from src.engine.storage import ExchangeBackend, ExchangeStorage, STOP_ORDER_TYPES, sql_backend
+from src.engine.sharding import shards
+from src.jobs.expiry import expiry
+from src.metrics import metrics
+from src.dataBase.models.order import OrderORM, OrderArchiveORM
+from src.dataBase.models.balance import TransactionORM
 from src.api.profile.user import get_user_by_token
-from src.api.profile.balance import update_balances, reserve_funds, lock_balance, release_user_reserve
+from src.api.profile.balance import update_balances, reserve_funds, lock_balance
 from src.api.profile.instrument import get_instruments_list
+from src.api.stockMarket.cache import cached_response
+from src.engine.book import books
 from src.schemas.user import User
 from src.schemas.instrument import TickerStr
 from src.schemas.balance import AmountInt
 from src.schemas.order import (
     MarketOrderBody,
     LimitOrderBody,
+    StopOrderBody,
+    StopLimitOrderBody,
     CreateOrderResponse,
     MarketOrder,
     LimitOrder,
+    StopOrder,
+    StopLimitOrder,
     OrderStatus,
     OrderType,
     L2OrderBook,
     OperationDirection,
-    Level
+    TimeInForce,
+    SelfTradePrevention,
+    PageLimitInt
 )
 
 from src.schemas.schemas import succesMessage
+from src.schemas.serialization import order_to_dict, order_adapter, orders_adapter, orderbook_adapter
 
 order_router = APIRouter(prefix="/api/v1")
 
-@overload
-async def get_orderbook_orders(
-    ticker: TickerStr, 
-    session: AsyncSession, 
-    orderSide: OperationDirection
-) -> List[OrderORM]: ...
-
-@overload
-async def get_orderbook_orders(
-    ticker: TickerStr, 
-    session: AsyncSession, 
-    orderSide: None = None
-) -> Tuple[List[OrderORM], List[OrderORM]]: ...
-
-async def get_orderbook_orders(ticker: TickerStr, session: AsyncSession, orderSide: Optional[OperationDirection] = None) -> Union[List[OrderORM], Tuple[List[OrderORM], List[OrderORM]]]:
-    if orderSide is not None:
-        if orderSide == OperationDirection.BUY:
-            buy_query = (
-                    select(OrderORM)
-                        .where(
-                            OrderORM.ticker == ticker,
-                            OrderORM.type == OrderType.LIMIT,
-                            OrderORM.status.in_([OrderStatus.NEW, OrderStatus.PART_EXEC]),
-                            OrderORM.direction == OperationDirection.BUY
-                        )
-                    .order_by(desc(OrderORM.price), asc(OrderORM.timestamp))
-                    .with_for_update()
-                )
-            return (await session.execute(buy_query)).scalars().all()
-        else:
-            sell_query = (
-                    select(OrderORM)
-                        .where(
-                            OrderORM.ticker == ticker,
-                            OrderORM.type == OrderType.LIMIT,
-                            OrderORM.status.in_([OrderStatus.NEW, OrderStatus.PART_EXEC]),
-                            OrderORM.direction == OperationDirection.SELL
-                        )
-                    .order_by(asc(OrderORM.price), asc(OrderORM.timestamp))
-                    .with_for_update()
-                )
-            return (await session.execute(sell_query)).scalars().all()
-    else:
-        buy_query = (
-                    select(OrderORM)
-                        .where(
-                            OrderORM.ticker == ticker,
-                            OrderORM.type == OrderType.LIMIT,
-                            OrderORM.status.in_([OrderStatus.NEW, OrderStatus.PART_EXEC]),
-                            OrderORM.direction == OperationDirection.BUY
-                        )
-                    .order_by(desc(OrderORM.price), asc(OrderORM.timestamp))
-                    .with_for_update()
-                )
-
-        sell_query = (
-                        select(OrderORM)
-                            .where(
-                                OrderORM.ticker == ticker,
-                                OrderORM.type == OrderType.LIMIT,
-                                OrderORM.status.in_([OrderStatus.NEW, OrderStatus.PART_EXEC]),
-                                OrderORM.direction == OperationDirection.SELL
-                            )
-                        .order_by(asc(OrderORM.price), asc(OrderORM.timestamp))
-                        .with_for_update()
-                    )
-
-        buy_orders, sell_orders = await gather(
-            session.execute(buy_query),
-            session.execute(sell_query)
-        )
-        return buy_orders.scalars().all(), sell_orders.scalars().all()
+EXPORT_BATCH_SIZE = 1000
+# Комиссия в базисных пунктах (6 б.п. = 0.06%), округляется вверх до целой минимальной единицы
+COMMISSION_BPS = 6
 
 @order_router.get("/public/orderbook/{ticker}", response_model=L2OrderBook, tags=["public"])
-async def get_orderbook(ticker: TickerStr, limit: AmountInt = 10) -> L2OrderBook:
+async def get_orderbook(request: Request, ticker: TickerStr, limit: AmountInt = 10) -> Response:
     """
-    Возвращает книгу ордеров (стакан) для указанного тикера
+    Возвращает книгу ордеров (стакан) для указанного тикера; пока стакан не менялся, ответ отдается из кэша
     """
-    ask_levels: Dict[float, int] = {}
-    bid_levels: Dict[float, int] = {}
+    return await cached_response(request, ticker, lambda: build_orderbook(ticker, limit))
+
+async def build_orderbook(ticker: TickerStr, limit: int) -> bytes:
+    # Стакан в памяти отдается без запроса к БД, если все изменения ордеров проходят через этот процесс.
+    # Иначе он может отставать от БД: стакан читается запросом, свежесть ограничивает TTL кэша ответов
+    book = None
+    if books.owns_writes:
+        book = books.get(ticker)
+        if book is None and ticker in {ticker for _, ticker in await get_instruments_list()}:
+            # Инструмент добавлен после прогрева
+            await books.load(ticker)
+            book = books.get(ticker)
+    if book is not None:
+        bids, asks = book.levels(limit)
+        return orderbook_adapter.dump_json({
+            "bid_levels": [{"price": p, "qty": q} for p, q in bids],
+            "ask_levels": [{"price": p, "qty": q} for p, q in asks]
+        })
+
+    ask_levels: Dict[int, int] = {}
+    bid_levels: Dict[int, int] = {}
 
     async with async_session_factory() as session:
         query = select(OrderORM).where(
@@ -134,13 +98,34 @@ async def get_orderbook(ticker: TickerStr, limit: AmountInt = 10) -> L2OrderBook
         sorted_asks = sorted(ask_levels.items())[:limit]
         sorted_bids = sorted(bid_levels.items(), reverse=True)[:limit]
 
-        ask_result = [Level(price=p, qty=q) for p, q in sorted_asks]
-        bid_result = [Level(price=p, qty=q) for p, q in sorted_bids]
+        ask_result = [{"price": p, "qty": q} for p, q in sorted_asks]
+        bid_result = [{"price": p, "qty": q} for p, q in sorted_bids]
 
-    return L2OrderBook(ask_levels=ask_result, bid_levels=bid_result)
+    return orderbook_adapter.dump_json({"bid_levels": bid_result, "ask_levels": ask_result})
 
-@order_router.get("/order/{order_id}", response_model=LimitOrder | MarketOrder, tags=["order"])
-async def get_order(order_id: UUID, user: User = Depends(get_user_by_token)) -> LimitOrder | MarketOrder:
+@order_router.get("/order/export", tags=["order"])
+async def export_orders(
+    user: User = Depends(get_user_by_token),
+    status: Optional[OrderStatus] = None,
+    ticker: Optional[TickerStr] = None,
+    after: Optional[str] = None
+) -> StreamingResponse:
+    """
+    Выгружает всю историю ордеров пользователя в формате NDJSON (один ордер на строку).
+    Строки читаются серверным курсором и сериализуются по мере чтения
+    """
+    query = user_orders_query(user.id, status, ticker, after)
+
+    async def stream_orders():
+        async with async_session_factory() as session:
+            result = await session.stream(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+            async for partition in result.partitions():
+                yield b"".join(order_adapter.dump_json(order_to_dict(order)) + b"\n" for order in partition)
+
+    return StreamingResponse(stream_orders(), media_type="application/x-ndjson")
+
+@order_router.get("/order/{order_id}", response_model=LimitOrder | MarketOrder | StopLimitOrder | StopOrder, tags=["order"])
+async def get_order(order_id: UUID, user: User = Depends(get_user_by_token)) -> Response:
     """
     Возвращает информацию о конкретном ордере
     """
@@ -149,121 +134,138 @@ async def get_order(order_id: UUID, user: User = Depends(get_user_by_token)) ->
         result = await session.execute(query)
         order = result.scalar_one_or_none()
 
+        if not order:
+            result = await session.execute(select(OrderArchiveORM).where(OrderArchiveORM.id == order_id))
+            order = result.scalar_one_or_none()
+
         if not order:
             raise HTTPException(status_code=404, detail="Ордер не найден")
         
         if order.user_id != user.id:
             raise HTTPException(status_code=403, detail="Нет доступа к ордеру")
 
-        base_order_data = {
-                "id": order.id,
-                "status": order.status,
-                "user_id": order.user_id,
-                "timestamp": order.timestamp,
-            }
-        if order.type == OrderType.MARKET:
-            body = MarketOrderBody(
-                direction=order.direction,
-                ticker=order.ticker,
-                qty=order.qty
-            )
-            return MarketOrder(**base_order_data, body=body)
-        else:
-            body = LimitOrderBody(
-                direction=order.direction,
-                ticker=order.ticker,
-                qty=order.qty,
-                price=order.price
-            )
-            return LimitOrder(**base_order_data, body=body, filled=order.filled)
+        return json_response(order_adapter.dump_json(order_to_dict(order)))
 
-@order_router.get("/order", response_model=List[LimitOrder | MarketOrder], tags=["order"])
-async def list_orders(user: User = Depends(get_user_by_token)) -> List[LimitOrder | MarketOrder]:
+@order_router.get("/order", response_model=List[LimitOrder | MarketOrder | StopLimitOrder | StopOrder], tags=["order"])
+async def list_orders(
+    user: User = Depends(get_user_by_token),
+    status: Optional[OrderStatus] = None,
+    ticker: Optional[TickerStr] = None,
+    limit: Optional[PageLimitInt] = None,
+    after: Optional[str] = None
+) -> Response:
     """
-    Возвращает список всех ордеров пользователя
+    Возвращает список ордеров пользователя.
+    С параметром limit работает постранично: курсор следующей страницы отдается в заголовке X-Next-Cursor
     """
-    response : List[LimitOrder | MarketOrder] = []
     async with async_session_factory() as session:
-        query = select(OrderORM).where(OrderORM.user_id == user.id).order_by(OrderORM.timestamp)
+        query = user_orders_query(user.id, status, ticker, after, limit)
         result = await session.execute(query)
-        orders = result.scalars().all()
-        for order in orders:
-            base_order_data = {
-                "id": order.id,
-                "status": order.status,
-                "user_id": order.user_id,
-                "timestamp": order.timestamp,
-            }
-            
-            if order.type == OrderType.MARKET:
-                body = MarketOrderBody(
-                    direction=order.direction,
-                    ticker=order.ticker,
-                    qty=order.qty
-                )
-                response.append(MarketOrder(**base_order_data, body=body))
-            else:
-                body = LimitOrderBody(
-                    direction=order.direction,
-                    ticker=order.ticker,
-                    qty=order.qty,
-                    price=order.price
-                )
-                response.append(LimitOrder(**base_order_data, body=body, filled=order.filled))
-                
+        orders = result.all()
+
+    response = json_response(orders_adapter.dump_json([order_to_dict(order) for order in orders]))
+    if limit is not None and len(orders) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(orders[-1].timestamp, orders[-1].id)
     return response
 
+def user_orders_query(user_id: UUID, status: Optional[OrderStatus], ticker: Optional[TickerStr], after: Optional[str], limit: Optional[int] = None):
+    """
+    Запрос ордеров пользователя вместе с архивом в порядке (timestamp, id) для постраничного чтения по ключу.
+    Каждая таблица сортируется и ограничивается отдельно, чтобы обе читались по своему индексу (user_id, timestamp, id)
+    """
+    cursor = decode_cursor(after) if after is not None else None
+    tables = [OrderORM.__table__]
+    # Активные ордера в архив не попадают
+    if status not in (OrderStatus.NEW, OrderStatus.PART_EXEC):
+        tables.append(OrderArchiveORM.__table__)
+
+    branches = []
+    for table in tables:
+        query = select(table).where(table.c.user_id == user_id)
+        if status is not None:
+            query = query.where(table.c.status == status)
+        if ticker is not None:
+            query = query.where(table.c.ticker == ticker)
+        if cursor is not None:
+            query = query.where(tuple_(table.c.timestamp, table.c.id) > cursor)
+        query = query.order_by(table.c.timestamp, table.c.id)
+        branches.append(query.limit(limit) if limit is not None else query)
+
+    if len(branches) == 1:
+        return branches[0]
+    orders = union_all(*branches).subquery()
+    query = select(orders).order_by(orders.c.timestamp, orders.c.id)
+    return query.limit(limit) if limit is not None else query
+
+def encode_cursor(timestamp: datetime.datetime, order_id: UUID) -> str:
+    return urlsafe_b64encode(f"{timestamp.isoformat()}|{order_id}".encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[datetime.datetime, UUID]:
+    try:
+        timestamp, order_id = urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.datetime.fromisoformat(timestamp), UUID(order_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
+
+def json_response(content: bytes) -> Response:
+    # Готовые байты отдаются как есть: FastAPI не валидирует повторно ответ-Response
+    return Response(content=content, media_type="application/json")
+
 @order_router.delete("/order/{order_id}", response_model=succesMessage, tags=["order"])
 async def cancel_order(order_id: UUID, user: User = Depends(get_user_by_token)):
     """
-    Отменяет ордер
+    Отменяет ордер; если ордер успели изменить (исполнить) после чтения, отмена повторяется с новым состоянием
     """
-    async with async_session_factory() as session:
-        query = select(OrderORM).where(
-            OrderORM.id == order_id,
-            OrderORM.user_id == user.id
-        )
-        result = await session.execute(query)
-        order = result.scalar_one_or_none()
+    return await run_with_retry(lambda: cancel_user_order(sql_backend, order_id, user.id))
+
+async def cancel_user_order(backend: ExchangeBackend, order_id: UUID, user_id: UUID):
+    async with backend.transaction() as storage:
+        order = await storage.find_order(order_id, user_id)
         
         if not order:
+            if await storage.is_archived(order_id, user_id):
+                raise HTTPException(status_code=400, detail="Невозможно отменить ордер в текущем статусе")
             raise HTTPException(status_code=404, detail="Ордер не найден")
         
         if order.status in [OrderStatus.CANCELLED, OrderStatus.EXEC]:
             raise HTTPException(status_code=400, detail="Невозможно отменить ордер в текущем статусе")
         
-        remaining_qty = order.qty - order.filled
-        if remaining_qty > 0 and order.type == OrderType.LIMIT:
-            if order.direction == OperationDirection.BUY:
-                rub_to_unreserve = remaining_qty * order.price
-                balance = await lock_balance(session, order.user_id, "RUB")
-                if balance and balance.reserved >= rub_to_unreserve:
-                    balance.reserved -= rub_to_unreserve
-
-            elif order.direction == OperationDirection.SELL:
-                asset_balance = await lock_balance(session, order.user_id, order.ticker)
-                if asset_balance and asset_balance.reserved >= remaining_qty:
-                    asset_balance.reserved -= remaining_qty
-        
+        # Снимается ровно остаток резерва ордера; у рыночных и стоп-рыночных ордеров его нет
+        await release_order_reserve(storage, order)
         order.status = OrderStatus.CANCELLED
-        await session.commit()
+        await storage.commit()
     
     return succesMessage
 
 @order_router.post("/order", response_model=CreateOrderResponse, tags=["order"])
-async def create_order(order_body: MarketOrderBody | LimitOrderBody,
+async def create_order(order_body: MarketOrderBody | LimitOrderBody | StopOrderBody | StopLimitOrderBody,
                         user: User = Depends(get_user_by_token)) -> CreateOrderResponse:
     """
-    Создает новый ордер (рыночный или лимитный)
+    Создает новый ордер (рыночный, лимитный, стоп или стоп-лимитный)
     """
-    async with async_session_factory() as session:
-        instruments = await get_instruments_list()
-        valid_tickers = {ticker for _, ticker in instruments}
-        if order_body.ticker not in valid_tickers:
-            raise HTTPException(status_code=400, detail="Неверный тикер")
+    order = await submit_order(sql_backend, user.id, order_body)
+    if order.expires_at is not None:
+        expiry.schedule(order.id, order.expires_at)
+    return CreateOrderResponse(order_id=order.id)
+
+async def submit_order(
+    backend: ExchangeBackend,
+    user_id: UUID,
+    order_body: MarketOrderBody | LimitOrderBody | StopOrderBody | StopLimitOrderBody
+) -> OrderORM:
+    """
+    Принимает ордер: проверяет баланс, резервирует средства под лимитный ордер и исполняет его по стакану.
+    Стоп-ордер ждет, пока цена сделки дойдет до stop_price; сделки этого ордера могут активировать другие стопы
+    """
+    # Список инструментов читается до открытия транзакции: иначе запрос держит два соединения пула сразу
+    if order_body.ticker not in await backend.tickers():
+        raise HTTPException(status_code=400, detail="Неверный тикер")
+
+    async with backend.transaction() as storage:
+        expires_at = check_expiry(order_body, storage.now())
         has_balance = await check_balance(
-            session=session,
-            user_id=user.id,
+            storage=storage,
+            user_id=user_id,
             ticker=order_body.ticker,
             qty=order_body.qty,
             price=getattr(order_body, 'price', None),
@@ -278,32 +280,129 @@ async def create_order(order_body: MarketOrderBody | LimitOrderBody,
         
         # Создаем ордер
         order = OrderORM(
-            id = uuid4(),
+            id = storage.new_id(),
             type=order_body.type,
             status=OrderStatus.NEW,
-            user_id= user.id,
-            timestamp = datetime.datetime.now(datetime.timezone.utc),
+            user_id= user_id,
+            timestamp = storage.now(),
             direction=order_body.direction,
             ticker=order_body.ticker,
             qty=order_body.qty,
-            price=getattr(order_body, 'price', None)
+            price=getattr(order_body, 'price', None),
+            time_in_force=getattr(order_body, 'time_in_force', None),
+            stop_price=getattr(order_body, 'stop_price', None),
+            expires_at=expires_at,
+            reserved=0
         )
+        resting = order.type == OrderType.LIMIT and order.time_in_force not in {TimeInForce.IOC, TimeInForce.FOK}
+        # Цены сделок, прошедших при приеме ордера: по ним проверяются стоп-ордера тикера
+        prices: List[int] = []
 
-        if order.type == OrderType.LIMIT:
-            await reserve_funds(session, order.user_id, order.ticker, order.qty, order.price, order.direction)
+        if order.time_in_force in {TimeInForce.IOC, TimeInForce.FOK}:
+            # IOC/FOK не попадают в стакан: исполняем в той же транзакции без резерва
+            prices = await run_with_retry(lambda: execute_immediate_order(order, storage), storage)
+        else:
+            if order.time_in_force == TimeInForce.POST_ONLY:
+                best_price = await get_best_price(order.ticker, storage, order.direction)
+                if best_price is not None and crosses(order.direction, order.price, best_price):
+                    raise HTTPException(status_code=400, detail="Post-only ордер был бы исполнен немедленно")
 
-        session.add(order)
-        await session.commit()
-        await session.refresh(order)
-    
-    if order.type == OrderType.MARKET:
-        await execute_market_order(order, session)
-    match_limit_orders(order.ticker)
-    
-    return CreateOrderResponse(order_id=order.id)
+            if order.type in (OrderType.LIMIT, OrderType.STOP_LIMIT):
+                order.reserved = await reserve_funds(storage, order.user_id, order.ticker, order.qty, order.price, order.direction)
+
+            storage.add(order)
+            await storage.commit()
+            await storage.refresh(order)
+
+            if order.type == OrderType.MARKET:
+                prices = await run_with_retry(lambda: execute_market_order(order, storage), storage)
+            elif order.type in STOP_ORDER_TYPES:
+                # Стоп, уровень которого уже пройден последней сделкой, срабатывает сразу
+                last_price = await storage.last_price(order.ticker)
+                prices = [last_price] if last_price is not None else []
+
+    if resting:
+        prices = await match_limit_orders(order.ticker, backend)
+    await trigger_stop_orders(backend, order.ticker, prices)
+    return order
+
+async def trigger_stop_orders(backend: ExchangeBackend, ticker: TickerStr, prices: List[int]):
+    """
+    Активирует стоп-ордера тикера, чей stop_price пройден ценами сделок prices. Читаются только сработавшие
+    стопы (диапазон по индексу stop_price); сделки активированных ордеров проверяются так же, пока новые стопы срабатывают
+    """
+    while prices:
+        async with backend.transaction() as storage:
+            triggered = [(order.id, order.user_id) for order in await storage.triggered_stops(ticker, min(prices), max(prices))]
+        prices = []
+        for order_id, user_id in triggered:
+            prices += await run_with_retry(lambda: activate_stop_order(backend, order_id, user_id))
+
+async def activate_stop_order(backend: ExchangeBackend, order_id: UUID, user_id: UUID) -> List[int]:
+    """
+    Превращает сработавший стоп-ордер в рыночный (STOP) или лимитный (STOP_LIMIT) и исполняет его.
+    Время ордера становится временем срабатывания: по нему определяется приоритет в стакане.
+    Возвращает цены сделок
+    """
+    async with backend.transaction() as storage:
+        order = await storage.find_order(order_id, user_id)
+        # Стоп мог уже активировать или отменить параллельный запрос
+        if order is None or order.status != OrderStatus.NEW or order.type not in STOP_ORDER_TYPES:
+            return []
+        metrics.increment("stop_orders_triggered")
+        order.timestamp = storage.now()
+
+        if order.type == OrderType.STOP:
+            order.type = OrderType.MARKET
+            try:
+                return await execute_market_order(order, storage)
+            except HTTPException:
+                # Средств на исполнение уже нет: стоп отменяется, остальные стопы продолжают срабатывать
+                await storage.rollback()
+                await storage.refresh(order)
+                order.status = OrderStatus.CANCELLED
+                await storage.commit()
+                return []
+
+        order.type = OrderType.LIMIT
+        ticker = order.ticker
+        await storage.commit()
+
+    return await match_limit_orders(ticker, backend)
+
+def check_expiry(order_body: MarketOrderBody | LimitOrderBody | StopOrderBody | StopLimitOrderBody, now: datetime.datetime) -> Optional[datetime.datetime]:
+    """
+    Проверяет срок действия ордера: expires_at обязателен для GTD и запрещен для остальных ордеров.
+    Время без часового пояса считается временем UTC
+    """
+    expires_at = getattr(order_body, 'expires_at', None)
+    if (getattr(order_body, 'time_in_force', None) == TimeInForce.GTD) != (expires_at is not None):
+        raise HTTPException(status_code=400, detail="Срок действия expires_at задается только для GTD ордера и обязателен для него")
+    if expires_at is None:
+        return None
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=datetime.timezone.utc)
+    if expires_at <= now:
+        raise HTTPException(status_code=400, detail="Срок действия ордера уже истек")
+    return expires_at
+
+def crosses(direction: OperationDirection, price: int, oppositePrice: int) -> bool:
+    """
+    Проверяет, пересекается ли цена ордера с ценой встречного ордера
+    """
+    if direction == OperationDirection.BUY:
+        return price >= oppositePrice
+    return price <= oppositePrice
+
+async def get_best_price(ticker: TickerStr, storage: ExchangeStorage, direction: OperationDirection) -> Optional[int]:
+    """
+    Возвращает лучшую встречную цену в стакане для ордера указанного направления
+    """
+    opposite_side = OperationDirection.SELL if direction == OperationDirection.BUY else OperationDirection.BUY
+    return await storage.best_price(ticker, opposite_side)
 
 async def check_balance(
-    session: AsyncSession, 
+    storage: ExchangeStorage, 
     user_id: UUID, 
     ticker: TickerStr, 
     qty: AmountInt, 
@@ -315,15 +414,10 @@ async def check_balance(
     """
     if direction == OperationDirection.BUY and price is not None:
         required_amount = qty * price
-        commission = required_amount * 0.0006
+        commission = -(-required_amount * COMMISSION_BPS // 10_000)
         total_required = required_amount + commission
         
-        balance_query = select(BalanceORM).where( 
-            BalanceORM.user_id == user_id,
-            BalanceORM.ticker == "RUB"
-        )
-        result = await session.execute(balance_query)
-        balance = result.scalar_one_or_none()
+        balance = await storage.get_balance(user_id, "RUB")
 
         if not balance:
             return False
@@ -332,12 +426,7 @@ async def check_balance(
         return free >= total_required
     
     elif direction == OperationDirection.SELL:
-        balance_query = select(BalanceORM).where(
-            BalanceORM.user_id == user_id,
-            BalanceORM.ticker == ticker
-        )
-        result = await session.execute(balance_query)
-        balance = result.scalar_one_or_none()
+        balance = await storage.get_balance(user_id, ticker)
         if not balance:
             return False
 
@@ -346,14 +435,17 @@ async def check_balance(
     
     return True
         
-async def execute_market_order(marketOrder: OrderORM, session: AsyncSession):
+async def execute_market_order(marketOrder: OrderORM, storage: ExchangeStorage) -> List[int]:
     if marketOrder.type != OrderType.MARKET:
         raise HTTPException(status_code=422, detail="Данная операция доступна только для рыночного ордера")
 
     opposite_side = OperationDirection.SELL if marketOrder.direction == OperationDirection.BUY else OperationDirection.BUY
-    orders = await get_orderbook_orders(marketOrder.ticker, session, opposite_side)
+    # Читается только начало стакана, которого хватает на весь ордер
+    orders = await storage.book_orders(marketOrder.ticker, opposite_side, qty=marketOrder.qty, exclude_users=self_trade_users(storage, marketOrder))
+    await storage.lock_balances(settlement_keys(orders + [marketOrder], marketOrder.ticker))
     remaining_qty = marketOrder.qty
-    executed_transactions = []
+    decremented_qty = 0
+    prices = []
 
     for order in orders:
         if order.status not in {OrderStatus.NEW, OrderStatus.PART_EXEC}:
@@ -365,32 +457,41 @@ async def execute_market_order(marketOrder: OrderORM, session: AsyncSession):
         if match_qty <= 0:
             continue
 
-        prev_filled = order.filled or 0
-        prev_status = order.status
+        if is_self_trade(storage, order, marketOrder):
+            taker_cancelled, decremented = await prevent_self_trade(storage, resting=order, taker=marketOrder, qty=match_qty)
+            if taker_cancelled:
+                break
+            remaining_qty -= decremented
+            decremented_qty += decremented
+            if remaining_qty == 0:
+                break
+            continue
 
-        order.filled = prev_filled + match_qty
+        order.filled = (order.filled or 0) + match_qty
         order.status = OrderStatus.EXEC if order.filled >= order.qty else OrderStatus.PART_EXEC
 
         price = order.price or 0
 
         transaction = TransactionORM(
-            id=uuid4(),
+            id=storage.new_id(),
             ticker=marketOrder.ticker,
             amount=match_qty,
             price=price,
-            timestamp=datetime.datetime.now(datetime.timezone.utc)
+            timestamp=storage.now(),
+            **counterparties(maker=order, taker=marketOrder)
         )
 
         await update_balances(
-            session,
+            storage,
             orderTransaction=transaction,
             buyer_id=marketOrder.user_id if marketOrder.direction == OperationDirection.BUY else order.user_id,
-            seller_id=order.user_id if marketOrder.direction == OperationDirection.BUY else marketOrder.user_id,
-            isMarket=True
+            seller_id=order.user_id if marketOrder.direction == OperationDirection.BUY else marketOrder.user_id
         )
+        # Резерв есть только у мейкера из стакана
+        await release_order_reserve(storage, order, match_qty)
 
-        session.add(transaction)
-        executed_transactions.append((order, prev_filled, prev_status, transaction))  # Сохраняем для отката
+        storage.add(transaction)
+        prices.append(transaction.price)
 
         remaining_qty -= match_qty
 
@@ -398,27 +499,242 @@ async def execute_market_order(marketOrder: OrderORM, session: AsyncSession):
             break
 
     if remaining_qty == 0:
-        marketOrder.status = OrderStatus.EXEC
-        marketOrder.filled = marketOrder.qty
+        # Количество, уменьшенное при DECREMENT_BOTH, не исполнено: такой ордер закрывается как отмененный
+        marketOrder.filled = marketOrder.qty - decremented_qty
+        marketOrder.status = OrderStatus.EXEC if decremented_qty == 0 else OrderStatus.CANCELLED
     else:
+        # Рыночный ордер исполняется целиком или отменяется: сделки, переводы и снятые резервы откатываются вместе
+        await storage.rollback()
+        await storage.refresh(marketOrder)
         marketOrder.status = OrderStatus.CANCELLED
         marketOrder.filled = 0
+        prices = []
+
+    storage.add(marketOrder)
+    await storage.commit()
+    return prices
 
-        if executed_transactions:
-            for order, prev_filled, prev_status, transaction in executed_transactions:
-                order.filled = prev_filled
-                order.status = prev_status
-                await session.delete(transaction)
+async def execute_immediate_order(takerOrder: OrderORM, storage: ExchangeStorage) -> List[int]:
+    """
+    Исполняет лимитный ордер IOC/FOK за один проход по стакану.
+    Неисполненный остаток отменяется, резерв под ордер не создается.
+    """
+    if takerOrder.time_in_force not in {TimeInForce.IOC, TimeInForce.FOK}:
+        raise HTTPException(status_code=422, detail="Данная операция доступна только для IOC/FOK ордера")
+
+    opposite_side = OperationDirection.SELL if takerOrder.direction == OperationDirection.BUY else OperationDirection.BUY
+    orders = await storage.book_orders(
+        takerOrder.ticker, opposite_side, price_limit=takerOrder.price, qty=takerOrder.qty, exclude_users=self_trade_users(storage, takerOrder)
+    )
+
+    if takerOrder.time_in_force == TimeInForce.FOK:
+        if tradable_liquidity(orders, takerOrder, storage) < takerOrder.qty:
+            takerOrder.status = OrderStatus.CANCELLED
+            takerOrder.filled = 0
+            storage.add(takerOrder)
+            await storage.commit()
+            return []
+
+    await storage.lock_balances(settlement_keys(orders + [takerOrder], takerOrder.ticker))
+    remaining_qty = takerOrder.qty
+    decremented_qty = 0
+    prices = []
+
+    for order in orders:
+        order_available = order.qty - (order.filled or 0)
+        match_qty = min(order_available, remaining_qty)
+
+        if match_qty <= 0:
+            continue
+
+        if is_self_trade(storage, order, takerOrder):
+            taker_cancelled, decremented = await prevent_self_trade(storage, resting=order, taker=takerOrder, qty=match_qty)
+            if taker_cancelled:
+                break
+            remaining_qty -= decremented
+            decremented_qty += decremented
+            if remaining_qty == 0:
+                break
+            continue
+
+        order.filled = (order.filled or 0) + match_qty
+        order.status = OrderStatus.EXEC if order.filled >= order.qty else OrderStatus.PART_EXEC
+
+        transaction = TransactionORM(
+            id=storage.new_id(),
+            ticker=takerOrder.ticker,
+            amount=match_qty,
+            price=order.price,
+            timestamp=storage.now(),
+            **counterparties(maker=order, taker=takerOrder)
+        )
+
+        await update_balances(
+            storage,
+            orderTransaction=transaction,
+            buyer_id=takerOrder.user_id if takerOrder.direction == OperationDirection.BUY else order.user_id,
+            seller_id=order.user_id if takerOrder.direction == OperationDirection.BUY else takerOrder.user_id
+        )
+        # Тейкер IOC/FOK без резерва: снимается только резерв мейкера
+        await release_order_reserve(storage, order, match_qty)
+
+        storage.add(transaction)
+        prices.append(transaction.price)
+        remaining_qty -= match_qty
+
+        if remaining_qty == 0:
+            break
+
+    takerOrder.filled = takerOrder.qty - remaining_qty - decremented_qty
+    takerOrder.status = OrderStatus.EXEC if takerOrder.filled == takerOrder.qty else OrderStatus.CANCELLED
+
+    storage.add(takerOrder)
+    await storage.commit()
+    return prices
 
-    session.add(marketOrder)
-    await session.commit()
+def is_self_trade(storage: ExchangeStorage, first: OrderORM, second: OrderORM) -> bool:
+    return first.user_id == second.user_id and storage.self_trade_prevention != SelfTradePrevention.NONE
 
-async def match_limit_orders(ticker: TickerStr):
+def self_trade_users(storage: ExchangeStorage, *orders: OrderORM) -> Set[UUID]:
     """
-    Запускает процесс сопоставления ордеров (matching engine)
+    Владельцы ордеров, встречные ордера которых при включенной защите от самосделок не дают объема для сделок
     """
-    async with async_session_factory() as session:
-        buy_orders, sell_orders = await get_orderbook_orders(ticker, session)
+    if storage.self_trade_prevention == SelfTradePrevention.NONE:
+        return set()
+    return {order.user_id for order in orders}
+
+def unfilled(orders: List[OrderORM]) -> int:
+    return sum(order.qty - (order.filled or 0) for order in orders)
+
+def tradable_liquidity(orders: List[OrderORM], taker: OrderORM, storage: ExchangeStorage) -> int:
+    """
+    Сколько тейкер может исполнить по стакану с учетом защиты от самосделок (для FOK)
+    """
+    liquidity = 0
+    for order in orders:
+        if is_self_trade(storage, order, taker):
+            # CANCEL_OLDEST снимает свой ордер и идет дальше, остальные режимы дальше своего ордера не исполняют
+            if storage.self_trade_prevention == SelfTradePrevention.CANCEL_OLDEST:
+                continue
+            break
+        liquidity += order.qty - (order.filled or 0)
+    return liquidity
+
+async def release_order_reserve(storage: ExchangeStorage, order: OrderORM, qty: Optional[int] = None):
+    """
+    Снимает резерв под qty единиц лимитного ордера (без qty - весь оставшийся резерв ордера).
+    Резерв ордера и резерв баланса уменьшаются на одну и ту же величину
+    """
+    if not order.reserved:
+        return
+    if order.direction == OperationDirection.BUY:
+        ticker, amount = "RUB", order.reserved if qty is None else min(order.reserved, qty * order.price)
+    else:
+        ticker, amount = order.ticker, order.reserved if qty is None else min(order.reserved, qty)
+    balance = await lock_balance(storage, order.user_id, ticker)
+    released = min(balance.reserved, amount)
+    balance.reserved -= released
+    order.reserved -= amount
+    storage.record(order.user_id, ticker, reserved=-released)
+
+async def cancel_resting_order(storage: ExchangeStorage, order: OrderORM):
+    await release_order_reserve(storage, order)
+    order.status = OrderStatus.CANCELLED
+
+async def decrement_resting_order(storage: ExchangeStorage, order: OrderORM, qty: int):
+    # Ордер уменьшается на qty без сделки; если остатка не осталось, ордер отменяется
+    if qty >= order.qty - (order.filled or 0):
+        await cancel_resting_order(storage, order)
+        return
+    order.qty -= qty
+    await release_order_reserve(storage, order, qty)
+
+async def prevent_self_trade(storage: ExchangeStorage, resting: OrderORM, taker: OrderORM, qty: int) -> Tuple[bool, int]:
+    """
+    Вместо сделки тейкера (ордер без резерва: рыночный, IOC, FOK) со своим ордером из стакана.
+    Возвращает (отменен ли остаток тейкера, на сколько уменьшен тейкер)
+    """
+    metrics.increment("self_trades_prevented")
+    mode = storage.self_trade_prevention
+    if mode == SelfTradePrevention.CANCEL_NEWEST:
+        return True, 0
+    if mode == SelfTradePrevention.CANCEL_OLDEST:
+        await cancel_resting_order(storage, resting)
+        return False, 0
+    await decrement_resting_order(storage, resting, qty)
+    return False, qty
+
+def counterparties(maker: OrderORM, taker: OrderORM) -> Dict[str, Any]:
+    return {
+        "maker_order_id": maker.id,
+        "taker_order_id": taker.id,
+        "maker_user_id": maker.user_id,
+        "taker_user_id": taker.user_id,
+        "taker_direction": taker.direction,
+    }
+
+def settlement_keys(orders: List[OrderORM], ticker: TickerStr) -> List[Tuple[UUID, str]]:
+    """
+    Балансы, которые может затронуть расчет по сделкам между указанными ордерами
+    """
+    return [(order.user_id, key) for order in orders for key in ("RUB", ticker)]
+
+def matched_prefix(orders: List[OrderORM], qty: int, exclude_users: Set[UUID]) -> List[OrderORM]:
+    """
+    Ордера из начала стакана, которых хватает на исполнение qty; ордера exclude_users объема не дают
+    """
+    prefix = []
+    for order in orders:
+        if qty <= 0:
+            break
+        prefix.append(order)
+        if order.user_id not in exclude_users:
+            qty -= order.qty - (order.filled or 0)
+    return prefix
+
+async def prevent_resting_self_trade(storage: ExchangeStorage, buy_order: OrderORM, sell_order: OrderORM, qty: int):
+    """
+    Вместо сделки между двумя ордерами одного пользователя из стакана. Более новый - тот, что стал бы тейкером
+    """
+    metrics.increment("self_trades_prevented")
+    mode = storage.self_trade_prevention
+    newest, oldest = (sell_order, buy_order) if buy_order.timestamp <= sell_order.timestamp else (buy_order, sell_order)
+    if mode == SelfTradePrevention.CANCEL_NEWEST:
+        await cancel_resting_order(storage, newest)
+    elif mode == SelfTradePrevention.CANCEL_OLDEST:
+        await cancel_resting_order(storage, oldest)
+    else:
+        await decrement_resting_order(storage, buy_order, qty)
+        await decrement_resting_order(storage, sell_order, qty)
+
+async def match_limit_orders(ticker: TickerStr, backend: ExchangeBackend = sql_backend) -> List[int]:
+    """
+    Запускает процесс сопоставления ордеров (matching engine); при конфликте транзакций проход повторяется.
+    Возвращает цены сделок прохода
+    """
+    if backend is sql_backend and shards.enabled:
+        # Тикер матчит процесс его шарда (src/engine/sharding.py)
+        return await shards.match(ticker)
+    return await run_with_retry(lambda: run_matching_pass(backend, ticker))
+
+async def run_matching_pass(backend: ExchangeBackend, ticker: TickerStr) -> List[int]:
+    async with backend.transaction() as storage:
+        best_bid = await storage.best_price(ticker, OperationDirection.BUY)
+        best_ask = await storage.best_price(ticker, OperationDirection.SELL)
+        if best_bid is None or best_ask is None or best_bid < best_ask:
+            return []
+
+        # Исполниться могут только ордера пересекающейся части стакана: покупки не ниже лучшей продажи
+        # и продажи не выше лучшей покупки, причем не больше встречного объема. Продажи читаются, пока их
+        # хватает на все покупки, покупки затем обрезаются по прочитанным продажам.
+        # Балансы участников блокируются заранее одним запросом
+        buy_orders = await storage.book_orders(ticker, OperationDirection.BUY, price_limit=best_ask)
+        sell_orders = await storage.book_orders(
+            ticker, OperationDirection.SELL, price_limit=best_bid, qty=unfilled(buy_orders), exclude_users=self_trade_users(storage, *buy_orders)
+        )
+        buy_orders = matched_prefix(buy_orders, unfilled(sell_orders), self_trade_users(storage, *sell_orders))
+        await storage.lock_balances(settlement_keys(buy_orders + sell_orders, ticker))
+        prices = []
 
         for buy_order in buy_orders:
             if buy_order.status not in {OrderStatus.NEW, OrderStatus.PART_EXEC}:
@@ -427,33 +743,47 @@ async def match_limit_orders(ticker: TickerStr):
             for sell_order in sell_orders:
                 if sell_order.status not in {OrderStatus.NEW, OrderStatus.PART_EXEC}:
                     continue
+
+                # Продажи отсортированы по возрастанию цены: дальше пересечений с этой покупкой нет
+                if buy_order.price < sell_order.price:
+                    break
+
+                buy_available = buy_order.qty - (buy_order.filled or 0)
+                sell_available = sell_order.qty - (sell_order.filled or 0)
+                match_qty = min(buy_available, sell_available)
+
+                if match_qty > 0 and is_self_trade(storage, buy_order, sell_order):
+                    await prevent_resting_self_trade(storage, buy_order, sell_order, match_qty)
+                    if buy_order.status == OrderStatus.CANCELLED:
+                        break
+                    continue
+                
+                if match_qty > 0:
+                    buy_order.filled = (buy_order.filled or 0) + match_qty
+                    sell_order.filled = (sell_order.filled or 0) + match_qty
                     
-                if buy_order.price >= sell_order.price:
-                    buy_available = buy_order.qty - (buy_order.filled or 0)
-                    sell_available = sell_order.qty - (sell_order.filled or 0)
-                    match_qty = min(buy_available, sell_available)
+                    buy_order.status = OrderStatus.EXEC if buy_order.filled >= buy_order.qty else OrderStatus.PART_EXEC
+                    sell_order.status = OrderStatus.EXEC if sell_order.filled >= sell_order.qty else OrderStatus.PART_EXEC
+
+                    # Тейкер - ордер, пришедший в стакан позже
+                    maker, taker = (buy_order, sell_order) if buy_order.timestamp <= sell_order.timestamp else (sell_order, buy_order)
+                    transaction = TransactionORM(
+                        id = storage.new_id(),
+                        ticker = ticker,
+                        amount = match_qty,
+                        price = sell_order.price,
+                        timestamp=storage.now(),
+                        **counterparties(maker=maker, taker=taker)
+                    )
+                    await update_balances(storage, orderTransaction=transaction, buyer_id=buy_order.user_id, seller_id=sell_order.user_id)
+                    # Покупка снимает резерв по своей цене: разница с ценой сделки возвращается вместе с резервом
+                    await release_order_reserve(storage, buy_order, match_qty)
+                    await release_order_reserve(storage, sell_order, match_qty)
                     
-                    if match_qty > 0:
-                        buy_order.filled = (buy_order.filled or 0) + match_qty
-                        sell_order.filled = (sell_order.filled or 0) + match_qty
-                        
-                        if buy_order.filled >= buy_order.qty:
-                            buy_order.status = OrderStatus.EXEC
-                            await release_user_reserve(session, user_id=buy_order.user_id, ticker="RUB")
-                        else:
-                            buy_order.status = OrderStatus.PART_EXEC
-                            
-                        if sell_order.filled >= sell_order.qty:
-                            sell_order.status = OrderStatus.EXEC
-                            await release_user_reserve(session, user_id=sell_order.user_id, ticker=ticker)
-                        else:
-                            sell_order.status = OrderStatus.PART_EXEC
-
-                        transaction = TransactionORM(id = uuid4(), ticker = ticker, amount = match_qty, price = sell_order.price, timestamp=datetime.datetime.now(datetime.timezone.utc))
-                        await update_balances(session, orderTransaction=transaction, buyer_id=buy_order.user_id, seller_id=sell_order.user_id)
-                        
-                        session.add(transaction)
-                        if buy_order.status == OrderStatus.EXEC:
-                            break
-
-        await session.commit()
\ No newline at end of file
+                    storage.add(transaction)
+                    prices.append(transaction.price)
+                    if buy_order.status == OrderStatus.EXEC:
+                        break
+
+        await storage.commit()
+    return prices
@@ -1,10 +1,11 @@
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy import TIMESTAMP, ForeignKey
+from sqlalchemy import TIMESTAMP, BigInteger, ForeignKey, Index
 from typing import TYPE_CHECKING
 from src.dataBase.base import Base
 from datetime import datetime
 from sqlalchemy import UniqueConstraint
 import uuid
+from src.schemas.order import OperationDirection
 
 if TYPE_CHECKING:
     from src.dataBase.models.user import UserORM
@@ -17,19 +18,36 @@ class BalanceORM(Base):
     )
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id: Mapped[uuid.UUID] = mapped_column(ForeignKey("user.id"))
-    ticker: Mapped[str] = mapped_column(ForeignKey("instrument.ticker"))
-    amount: Mapped[float]
-    reserved: Mapped[float] = mapped_column(default=0)
+    user_id: Mapped[uuid.UUID] = mapped_column(ForeignKey("user.id", ondelete="CASCADE"))
+    ticker: Mapped[str] = mapped_column(ForeignKey("instrument.ticker", ondelete="CASCADE"))
+    # Суммы хранятся целыми числами в минимальных единицах инструмента
+    amount: Mapped[int] = mapped_column(BigInteger)
+    reserved: Mapped[int] = mapped_column(BigInteger, default=0)
     user: Mapped["UserORM"] = relationship(back_populates='balance')
     instrument: Mapped["InstrumentORM"] = relationship(back_populates='balance')
 
+# Мейкер - ордер, стоявший в стакане, тейкер - ордер, который с ним пересекся.
+# Для сделок, записанных до появления этих полей, они пустые.
+# Таблица секционирована по месяцам timestamp, поэтому timestamp входит в первичный ключ.
 class TransactionORM(Base):
     __tablename__ = 'transaction'
+    __table_args__ = (
+        Index('ix_transaction_maker_user_timestamp_id', 'maker_user_id', 'timestamp', 'id'),
+        Index('ix_transaction_taker_user_timestamp_id', 'taker_user_id', 'timestamp', 'id'),
+        Index('ix_transaction_maker_order_id', 'maker_order_id'),
+        Index('ix_transaction_taker_order_id', 'taker_order_id'),
+        Index('ix_transaction_ticker_timestamp', 'ticker', 'timestamp'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
 
     id: Mapped[uuid.UUID] = mapped_column(primary_key=True)
-    ticker: Mapped[str] = mapped_column(ForeignKey('instrument.ticker'))
+    ticker: Mapped[str] = mapped_column(ForeignKey('instrument.ticker', ondelete="CASCADE"))
     amount: Mapped[int]
     price: Mapped[int]
-    timestamp: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True))
+    timestamp: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), primary_key=True)
+    maker_order_id: Mapped[uuid.UUID] = mapped_column(nullable=True)
+    taker_order_id: Mapped[uuid.UUID] = mapped_column(nullable=True)
+    maker_user_id: Mapped[uuid.UUID] = mapped_column(nullable=True)
+    taker_user_id: Mapped[uuid.UUID] = mapped_column(nullable=True)
+    taker_direction: Mapped[OperationDirection] = mapped_column(nullable=True)
     instrument: Mapped["InstrumentORM"] = relationship(back_populates='transactions')
\ No newline at end of file
@@ -12,6 +12,7 @@ class InstrumentORM(Base):
 
     name: Mapped[str]
     ticker: Mapped[str] = mapped_column(primary_key=True)
-    balance: Mapped[List["BalanceORM"]] = relationship(back_populates="instrument", cascade="all, delete-orphan")
-    orders: Mapped[List["OrderORM"]] = relationship(back_populates="instrument", cascade="all, delete-orphan")
-    transactions: Mapped[List["TransactionORM"]] = relationship(back_populates="instrument", cascade="all, delete-orphan")
\ No newline at end of file
+    # passive_deletes: зависимые строки удаляет ON DELETE CASCADE в БД, ORM не загружает их при удалении инструмента
+    balance: Mapped[List["BalanceORM"]] = relationship(back_populates="instrument", cascade="all, delete-orphan", passive_deletes=True)
+    orders: Mapped[List["OrderORM"]] = relationship(back_populates="instrument", cascade="all, delete-orphan", passive_deletes=True)
+    transactions: Mapped[List["TransactionORM"]] = relationship(back_populates="instrument", cascade="all, delete-orphan", passive_deletes=True)
\ No newline at end of file
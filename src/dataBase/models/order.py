@@ -1,7 +1,7 @@
 import uuid
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy import TIMESTAMP, CheckConstraint, ForeignKey
+from sqlalchemy import TIMESTAMP, BigInteger, CheckConstraint, ForeignKey, Index, Table, Column, text
 from typing import List, TYPE_CHECKING
 from datetime import datetime
 
@@ -10,7 +10,7 @@ if TYPE_CHECKING:
     from src.dataBase.models.instrument import InstrumentORM
 
 from src.dataBase.base import Base
-from src.schemas.order import OrderType, OrderStatus, OperationDirection
+from src.schemas.order import OrderType, OrderStatus, OperationDirection, TimeInForce
 
 # Решил не разделять ордеры на разные табличны, чтобы не делать лишних джоинов, а все поля храню в 1 таблице, при этом указывая тип ордера. 
 # Те поля которые встречаются не во всех ордерах могут быть null - nullable.
@@ -20,6 +20,23 @@ class OrderORM(Base):
     __table_args__ = (
         CheckConstraint('price > 0', name='check_price_positive'),
         CheckConstraint('qty >= 1', name='check_qty_positive'),
+        CheckConstraint('stop_price > 0', name='check_stop_price_positive'),
+        Index('ix_order_user_timestamp_id', 'user_id', 'timestamp', 'id'),
+        # Стакан читает только активные лимитные ордера, частичный индекс не растет вместе с историей
+        Index(
+            'ix_order_book', 'ticker', 'direction', 'price', 'timestamp',
+            postgresql_where=text("status IN ('NEW', 'PART_EXEC') AND type = 'LIMIT'")
+        ),
+        # Ожидающие стоп-ордера по уровням: после сделки читаются только те, чей stop_price пройден
+        Index(
+            'ix_order_stop_trigger', 'ticker', 'direction', 'stop_price',
+            postgresql_where=text("status = 'NEW' AND type IN ('STOP', 'STOP_LIMIT')")
+        ),
+        # Активные GTD-ордера по времени истечения: планировщик читает только ближайшие
+        Index(
+            'ix_order_expiry', 'expires_at',
+            postgresql_where=text("status IN ('NEW', 'PART_EXEC') AND expires_at IS NOT NULL")
+        ),
     )
 
     id: Mapped[uuid.UUID] = mapped_column(primary_key=True)
@@ -32,5 +49,26 @@ class OrderORM(Base):
     qty: Mapped[int]
     price: Mapped[int] = mapped_column(nullable=True)
     filled: Mapped[int] = mapped_column(nullable=True, default=0)
+    time_in_force: Mapped[TimeInForce] = mapped_column(nullable=True)
+    stop_price: Mapped[int] = mapped_column(nullable=True)
+    expires_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), nullable=True)
+    # Неизрасходованный резерв ордера (RUB для покупки, актив для продажи). Исполнения и отмены уменьшают его
+    # и резерв баланса на одну и ту же величину, поэтому reserved баланса - сумма резервов активных ордеров
+    reserved: Mapped[int] = mapped_column(BigInteger, default=0, server_default=text('0'))
+    # Версия строки: ORM обновляет ордер через UPDATE ... WHERE id = ? AND version = ? и поднимает StaleDataError,
+    # если ордер успели изменить с момента чтения. Блокировки строк ордеров не нужны
+    version: Mapped[int] = mapped_column(server_default=text('0'))
     user: Mapped["UserORM"] = relationship(back_populates='orders')
-    instrument: Mapped["InstrumentORM"] = relationship(back_populates='orders')
\ No newline at end of file
+    instrument: Mapped["InstrumentORM"] = relationship(back_populates='orders')
+
+    __mapper_args__ = {"version_id_col": version}
+
+# Архив исполненных и отмененных ордеров: те же колонки, что у order, но без внешних ключей,
+# чтобы перенос пачками не проверял ссылки. Ордера переносит фоновый архиватор (src/jobs/archive.py).
+class OrderArchiveORM(Base):
+    __table__ = Table(
+        'order_archive',
+        Base.metadata,
+        *(Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable) for column in OrderORM.__table__.columns),
+        Index('ix_order_archive_user_timestamp_id', 'user_id', 'timestamp', 'id'),
+    )
@@ -17,13 +17,16 @@ class UserORM(Base):
     name: Mapped[str]
     role: Mapped[Role]
     api_key: Mapped[str]
+    # passive_deletes: балансы и ордера удаляет ON DELETE CASCADE в БД, ORM не загружает их при удалении пользователя
     balance: Mapped[List["BalanceORM"]] = relationship(
         back_populates="user", 
-        cascade="all, delete-orphan"
+        cascade="all, delete-orphan",
+        passive_deletes=True
     )
     orders: Mapped[List["OrderORM"]] = relationship(
         back_populates="user", 
-        cascade="all, delete-orphan"
+        cascade="all, delete-orphan",
+        passive_deletes=True
     )
     
 
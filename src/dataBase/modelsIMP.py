@@ -1,4 +1,4 @@
 from src.dataBase.models.user import UserORM
 from src.dataBase.models.instrument import InstrumentORM
 from src.dataBase.models.balance import BalanceORM
-from src.dataBase.models.order import OrderORM
\ No newline at end of file
+from src.dataBase.models.order import OrderORM, OrderArchiveORM
\ No newline at end of file
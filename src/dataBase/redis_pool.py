@@ -0,0 +1,100 @@
+"""
+Общий асинхронный клиент Redis процесса: один пул соединений (REDIS_MAX_CONNECTIONS), созданный при первом
+использовании и закрываемый в lifespan приложения, как движки БД в src/dataBase/session.py.
+
+Помощники сокращают число обращений к Redis:
+    * pipeline_execute - пачка команд одним обращением;
+    * CommandBatcher - команды, отправленные разными корутинами, пока предыдущая пачка в пути
+      (например, проверки лимита параллельных запросов), уходят одним pipeline.
+redis импортируется только здесь: процесс, который не обращается к Redis, его не загружает.
+"""
+import asyncio
+from functools import lru_cache
+from typing import Any, Iterable, List, Optional, Sequence, Tuple, TYPE_CHECKING
+from src.config import settings
+from src.metrics import metrics
+
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
+
+@lru_cache
+def get_redis() -> "Redis":
+    from redis.asyncio import ConnectionPool, Redis
+
+    pool = ConnectionPool(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        db=0,
+        username=settings.REDIS_USER,
+        password=settings.REDIS_USER_PASSWORD,
+        max_connections=settings.REDIS_MAX_CONNECTIONS
+    )
+    return Redis(connection_pool=pool)
+
+async def close_redis():
+    if get_redis.cache_info().currsize:
+        # Клиент создан поверх своего пула и сам его не закрывает
+        await get_redis().aclose(close_connection_pool=True)
+        get_redis.cache_clear()
+
+async def pipeline_execute(commands: Iterable[Sequence[Any]], raise_on_error: bool = True) -> List[Any]:
+    """
+    Выполняет команды (("SET", key, value), ("GET", key), ...) одним обращением к Redis, без MULTI/EXEC.
+    С raise_on_error=False ошибка отдельной команды возвращается на ее месте в списке результатов
+    """
+    pipe = get_redis().pipeline(transaction=False)
+    for command in commands:
+        pipe.execute_command(*command)
+    if not pipe.command_stack:
+        return []
+    metrics.increment("redis_pipelines")
+    return await pipe.execute(raise_on_error=raise_on_error)
+
+class CommandBatcher:
+    """
+    Склеивает команды, поставленные корутинами за один проход цикла событий, в один pipeline.
+    Пачки отправляет одна задача по очереди: пока pipeline выполняется, новые команды копятся для следующего
+    """
+    def __init__(self):
+        self._pending: List[Tuple[Sequence[Any], asyncio.Future]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def execute(self, *command: Any) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((command, future))
+        if self._task is None:
+            # Задача начнет работу на следующем проходе цикла: к этому времени команды соседних корутин уже в очереди
+            self._task = asyncio.ensure_future(self._run())
+        return await future
+
+    async def _run(self):
+        batch = []
+        try:
+            while self._pending:
+                batch, self._pending = self._pending, []
+                await self._flush(batch)
+        finally:
+            self._task = None
+            # Задачу отменили (остановка приложения): команды в пути и в очереди не выполнятся
+            for _, future in batch + self._pending:
+                future.cancel()
+            self._pending = []
+
+    async def _flush(self, batch: List[Tuple[Sequence[Any], asyncio.Future]]):
+        try:
+            results = await pipeline_execute((command for command, _ in batch), raise_on_error=False)
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        metrics.increment("redis_batched_commands", len(batch))
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+batcher = CommandBatcher()
@@ -0,0 +1,58 @@
+import asyncio
+import logging
+import random
+from typing import Awaitable, Callable, Optional, Protocol, TypeVar
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm.exc import StaleDataError
+from src.config import settings
+from src.metrics import metrics
+
+T = TypeVar("T")
+
+SERIALIZATION_FAILURE = "40001"
+DEADLOCK_DETECTED = "40P01"
+
+logger = logging.getLogger(__name__)
+
+class Rollbackable(Protocol):
+    """
+    Транзакция, которую можно откатить перед повтором: AsyncSession или ExchangeStorage (src/engine/storage.py)
+    """
+    async def rollback(self) -> None: ...
+
+def conflict_sqlstate(error: DBAPIError) -> Optional[str]:
+    # psycopg и asyncpg отдают код ошибки Postgres под разными именами
+    sqlstate = getattr(error.orig, "sqlstate", None) or getattr(error.orig, "pgcode", None)
+    return sqlstate if sqlstate in (SERIALIZATION_FAILURE, DEADLOCK_DETECTED) else None
+
+async def run_with_retry(operation: Callable[[], Awaitable[T]], transaction: Optional[Rollbackable] = None) -> T:
+    """
+    Выполняет транзакцию и повторяет ее при взаимоблокировке, ошибке сериализации
+    или конфликте версий ордера с экспоненциальной задержкой и случайным разбросом.
+    Если операция работает в переданной транзакции (сессия или хранилище биржи), перед повтором она откатывается
+    """
+    # Настройки читаются только после конфликта: без них работает и хранилище в памяти (src/engine/memory.py)
+    attempt = 0
+    while True:
+        try:
+            return await operation()
+        except (DBAPIError, StaleDataError) as error:
+            if isinstance(error, StaleDataError):
+                reason = "order_version_conflict"
+                metrics.increment("order_version_conflicts")
+            else:
+                reason = conflict_sqlstate(error)
+                if reason is None:
+                    raise
+                metrics.increment("db_deadlocks" if reason == DEADLOCK_DETECTED else "db_serialization_failures")
+            if transaction is not None:
+                await transaction.rollback()
+            attempt += 1
+            if attempt >= settings.DB_RETRY_ATTEMPTS:
+                metrics.increment("db_retries_exhausted")
+                raise
+
+            metrics.increment("db_retries")
+            delay = min(settings.DB_RETRY_MAX_DELAY, settings.DB_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+            logger.warning("Конфликт транзакций (%s), повтор %s через %.3f с", reason, attempt, delay)
+            await asyncio.sleep(random.uniform(0, delay))
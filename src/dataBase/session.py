@@ -1,28 +1,48 @@
+from functools import lru_cache
 from src.config import settings
-from sqlalchemy import create_engine
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, Engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine, AsyncSession
+from sqlalchemy.orm import sessionmaker, Session
+
+# Движки создаются при первом использовании (или в lifespan приложения), а не при импорте:
+# импорт драйвера БД и чтение настроек не замедляют старт воркера, а API не создает синхронный движок вовсе.
 
 #-----------------------------------------------------------------------------------------------------------------#
 #                                                 Sync                                                            #
 #-----------------------------------------------------------------------------------------------------------------#
 
-sync_engine = create_engine(
-    url=settings.DATABASE_URL_PSYCOPG,
-    echo=False,
-)
+@lru_cache
+def get_sync_engine() -> Engine:
+    return create_engine(
+        url=settings.DATABASE_URL_PSYCOPG,
+        echo=False,
+    )
 
 #-----------------------------------------------------------------------------------------------------------------#
 #                                                Async                                                            #
 #-----------------------------------------------------------------------------------------------------------------#
 
-async_engine = create_async_engine(
-    url = settings.DATABASE_URL_PSYCOPG,
-    echo = False
-)
+@lru_cache
+def get_async_engine() -> AsyncEngine:
+    return create_async_engine(
+        url = settings.DATABASE_URL_PSYCOPG,
+        echo = False
+    )
 
 #-----------------------------------------------------------------------------------------------------------------#
 
-async_session_factory = async_sessionmaker(async_engine, expire_on_commit=False)
-session_factory = sessionmaker(sync_engine)
+@lru_cache
+def get_async_sessionmaker() -> async_sessionmaker:
+    return async_sessionmaker(get_async_engine(), expire_on_commit=False)
+
+def async_session_factory() -> AsyncSession:
+    return get_async_sessionmaker()()
+
+def session_factory() -> Session:
+    return sessionmaker(get_sync_engine())()
 
+async def dispose_engines():
+    if get_async_engine.cache_info().currsize:
+        await get_async_engine().dispose()
+    if get_sync_engine.cache_info().currsize:
+        get_sync_engine().dispose()
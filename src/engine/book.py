@@ -0,0 +1,250 @@
+"""
+Стаканы в памяти процесса: активные лимитные ордера по каждому тикеру и агрегированные уровни цен.
+
+Стакан тикера загружается из Postgres серверным курсором (BookRegistry.load) и дальше поддерживается
+изменениями ордеров, закоммиченными в этом процессе (слушатели сессии ниже). Каждое изменение несет
+версию строки ордера (OrderORM.version), поэтому устаревшее изменение никогда не перезапишет более новое.
+Изменения, закоммиченные во время загрузки тикера, копятся и применяются поверх загруженного снимка.
+
+Изменения, закоммиченные другими процессами, сюда не попадают. Поэтому стаканы загружаются и отдаются,
+только если все изменения ордеров проходят через этот процесс (BookRegistry.owns_writes): API работает
+одним воркером, а шарды матчинга возвращают свои изменения ему же (src/engine/sharding.py).
+При нескольких воркерах стакан читается из БД.
+"""
+import heapq
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from itertools import chain
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from sqlalchemy import event, select, func
+from sqlalchemy.orm import Session
+from src.config import settings
+from src.dataBase.session import async_session_factory
+from src.dataBase.models.order import OrderORM
+from src.schemas.order import OrderStatus, OrderType, OperationDirection
+
+BOOK_UPDATES_KEY = "book_updates"
+OPEN_STATUSES = (OrderStatus.NEW, OrderStatus.PART_EXEC)
+
+class BookUpdate(NamedTuple):
+    """
+    Состояние ордера после коммита; live=False - ордер ушел из стакана
+    """
+    ticker: str
+    order_id: uuid.UUID
+    user_id: uuid.UUID
+    direction: OperationDirection
+    price: int
+    remaining: int
+    timestamp: datetime
+    version: int
+    live: bool
+
+@dataclass(slots=True)
+class RestingOrder:
+    order_id: uuid.UUID
+    user_id: uuid.UUID
+    direction: OperationDirection
+    price: int
+    remaining: int
+    timestamp: datetime
+    version: int
+
+class OrderBook:
+    """
+    Стакан одного тикера: ордера по id и суммарный остаток по каждой цене для каждой стороны
+    """
+    def __init__(self, ticker: str):
+        self.ticker = ticker
+        self.orders: Dict[uuid.UUID, RestingOrder] = {}
+        self.bids: Dict[int, int] = {}
+        self.asks: Dict[int, int] = {}
+        # Версии ордеров, ушедших из стакана: устаревшая строка из снимка не вернет их обратно
+        self._closed: Dict[uuid.UUID, int] = {}
+
+    def _levels(self, direction: OperationDirection) -> Dict[int, int]:
+        return self.bids if direction == OperationDirection.BUY else self.asks
+
+    def _remove(self, order: RestingOrder):
+        levels = self._levels(order.direction)
+        left = levels[order.price] - order.remaining
+        if left > 0:
+            levels[order.price] = left
+        else:
+            del levels[order.price]
+        del self.orders[order.order_id]
+
+    def apply(self, update: BookUpdate):
+        current = self.orders.get(update.order_id)
+        known_version = current.version if current is not None else self._closed.get(update.order_id, -1)
+        if update.version < known_version:
+            return
+        if current is not None:
+            self._remove(current)
+
+        if not update.live or update.remaining <= 0:
+            self._closed[update.order_id] = update.version
+            return
+        self._closed.pop(update.order_id, None)
+        self.orders[update.order_id] = RestingOrder(
+            order_id=update.order_id,
+            user_id=update.user_id,
+            direction=update.direction,
+            price=update.price,
+            remaining=update.remaining,
+            timestamp=update.timestamp,
+            version=update.version
+        )
+        levels = self._levels(update.direction)
+        levels[update.price] = levels.get(update.price, 0) + update.remaining
+
+    def forget_closed(self):
+        # Отметки о закрытых ордерах нужны только до следующей загрузки снимка
+        self._closed.clear()
+
+    def levels(self, limit: int) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]:
+        """
+        Лучшие limit уровней: покупки по убыванию цены, продажи по возрастанию
+        """
+        bids = [(price, self.bids[price]) for price in heapq.nlargest(limit, self.bids)]
+        asks = [(price, self.asks[price]) for price in heapq.nsmallest(limit, self.asks)]
+        return bids, asks
+
+    def best_bid(self) -> Optional[int]:
+        return max(self.bids) if self.bids else None
+
+    def best_ask(self) -> Optional[int]:
+        return min(self.asks) if self.asks else None
+
+class BookRegistry:
+    """
+    Загруженные стаканы по тикерам. Пока тикер загружается, его изменения копятся в буфере
+    """
+    def __init__(self):
+        self._books: Dict[str, OrderBook] = {}
+        self._pending: Dict[str, List[BookUpdate]] = {}
+
+    @property
+    def owns_writes(self) -> bool:
+        """
+        Все изменения ордеров проходят через этот процесс: только тогда стакан в памяти совпадает с БД
+        """
+        return settings.WEB_CONCURRENCY == 1
+
+    def get(self, ticker: str) -> Optional[OrderBook]:
+        return self._books.get(ticker)
+
+    def drop(self, ticker: str):
+        self._books.pop(ticker, None)
+
+    def apply(self, updates: List[BookUpdate]):
+        for update in updates:
+            pending = self._pending.get(update.ticker)
+            if pending is not None:
+                pending.append(update)
+                continue
+            book = self._books.get(update.ticker)
+            # Стакан незагруженного тикера соберется из БД целиком, когда понадобится
+            if book is not None:
+                book.apply(update)
+
+    async def load(self, ticker: str) -> int:
+        """
+        Читает активные лимитные ордера тикера серверным курсором и заменяет стакан в памяти.
+        Возвращает число загруженных ордеров
+        """
+        if ticker in self._pending:
+            return 0
+        self._pending[ticker] = []
+        try:
+            book = OrderBook(ticker)
+            previous = self._books.get(ticker)
+            if previous is not None:
+                # Ордера, закрытые до начала загрузки, могут еще встретиться в снимке устаревшей строкой
+                book._closed = dict(previous._closed)
+            query = (
+                select(
+                    OrderORM.id,
+                    OrderORM.user_id,
+                    OrderORM.direction,
+                    OrderORM.price,
+                    OrderORM.qty - func.coalesce(OrderORM.filled, 0),
+                    OrderORM.timestamp,
+                    OrderORM.version
+                )
+                .where(
+                    OrderORM.ticker == ticker,
+                    OrderORM.type == OrderType.LIMIT,
+                    OrderORM.status.in_(OPEN_STATUSES)
+                )
+                .execution_options(yield_per=settings.WARMUP_BATCH_SIZE)
+            )
+            loaded = 0
+            async with async_session_factory() as session:
+                result = await session.stream(query)
+                async for partition in result.partitions():
+                    for order_id, user_id, direction, price, remaining, timestamp, version in partition:
+                        book.apply(BookUpdate(ticker, order_id, user_id, direction, price, remaining, timestamp, version, True))
+                    loaded += len(partition)
+
+            # Между чтением снимка и этой строкой нет точек переключения: буфер применяется целиком
+            book.forget_closed()
+            for update in self._pending[ticker]:
+                book.apply(update)
+            self._books[ticker] = book
+            return loaded
+        finally:
+            del self._pending[ticker]
+
+books = BookRegistry()
+
+def book_update(order: OrderORM, deleted: bool = False) -> Optional[BookUpdate]:
+    # Читаем только уже загруженные атрибуты: обращение к истекшему атрибуту внутри flush пошло бы в БД
+    state = order.__dict__
+    if state.get("type") != OrderType.LIMIT or "version" not in state or state.get("price") is None:
+        return None
+    return BookUpdate(
+        ticker=state["ticker"],
+        order_id=state["id"],
+        user_id=state["user_id"],
+        direction=state["direction"],
+        price=state["price"],
+        remaining=state["qty"] - (state.get("filled") or 0),
+        timestamp=state["timestamp"],
+        version=state["version"],
+        live=not deleted and state["status"] in OPEN_STATUSES
+    )
+
+def record_book_updates(session: Session, updates: List[BookUpdate]):
+    """
+    Изменения ордеров, сделанные в обход ORM (массовый UPDATE); в стакан попадут после коммита
+    """
+    pending = session.info.setdefault(BOOK_UPDATES_KEY, {})
+    for update in updates:
+        pending[update.order_id] = update
+
+@event.listens_for(Session, "after_flush")
+def _collect_book_updates(session: Session, flush_context):
+    updates = session.info.setdefault(BOOK_UPDATES_KEY, {})
+    for instance in chain(session.new, session.dirty):
+        if isinstance(instance, OrderORM):
+            update = book_update(instance)
+            if update is not None:
+                updates[update.order_id] = update
+    for instance in session.deleted:
+        if isinstance(instance, OrderORM):
+            update = book_update(instance, deleted=True)
+            if update is not None:
+                updates[update.order_id] = update
+
+@event.listens_for(Session, "after_commit")
+def _apply_committed(session: Session):
+    updates = session.info.pop(BOOK_UPDATES_KEY, None)
+    if updates:
+        books.apply(list(updates.values()))
+
+@event.listens_for(Session, "after_transaction_end")
+def _discard_uncommitted(session: Session, transaction):
+    if transaction.parent is None:
+        session.info.pop(BOOK_UPDATES_KEY, None)
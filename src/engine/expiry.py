@@ -0,0 +1,43 @@
+"""
+Планировщик истечения GTD-ордеров: min-куча (expires_at, номер, id ордера).
+
+Ордер попадает в кучу один раз - при приеме или при подгрузке ближайших истечений из БД, за тик
+из вершины кучи снимаются все наступившие сроки (O(k log n)), стакан при этом не просматривается.
+Отмененные и исполненные раньше срока ордера из кучи не удаляются: при снятии они просто пропускаются
+тем, кто проверяет статус.
+"""
+import datetime
+import heapq
+from typing import List, Optional, Set, Tuple
+from uuid import UUID
+
+class ExpiryScheduler:
+    def __init__(self):
+        self._heap: List[Tuple[datetime.datetime, int, UUID]] = []
+        self._scheduled: Set[UUID] = set()
+        # Номер поступления: при равных сроках ордера снимаются в порядке планирования
+        self._sequence = 0
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def schedule(self, order_id: UUID, expires_at: datetime.datetime):
+        if order_id in self._scheduled:
+            return
+        self._sequence += 1
+        heapq.heappush(self._heap, (expires_at, self._sequence, order_id))
+        self._scheduled.add(order_id)
+
+    def next_deadline(self) -> Optional[datetime.datetime]:
+        return self._heap[0][0] if self._heap else None
+
+    def due(self, now: datetime.datetime) -> List[UUID]:
+        """
+        Снимает из кучи ордера со сроком не позже now
+        """
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, order_id = heapq.heappop(self._heap)
+            self._scheduled.discard(order_id)
+            expired.append(order_id)
+        return expired
@@ -0,0 +1,327 @@
+"""
+Хранилище биржи в памяти процесса для детерминированной симуляции (бэктесты, воспроизведение истории).
+
+MemoryBackend реализует тот же интерфейс, что и SqlBackend (src/engine/storage.py), поэтому ордера
+принимаются, исполняются и отменяются той же логикой, что и в боевом режиме (submit_order, cancel_user_order,
+match_limit_orders), но без Postgres:
+    - время берется из SimulatedClock, который двигает драйвер воспроизведения;
+    - идентификаторы ордеров и сделок выдает генератор со стартовым зерном (seed);
+    - стакан - отсортированные списки (цена, время, номер поступления) по тикеру и стороне;
+    - ожидающие стоп-ордера - отсортированные по stop_price списки по тикеру и стороне: покупки по возрастанию,
+      продажи по убыванию, так что сработавшие на сделке стопы всегда образуют начало списка;
+    - сроки GTD-ордеров - куча ExpiryScheduler (src/engine/expiry.py), ее разбирает драйвер воспроизведения;
+    - транзакция запоминает изменяемые поля выданных ей ордеров и исходные значения прочитанных балансов;
+      при коммите переиндексируются, а при откате восстанавливаются только ордера, поля которых изменились,
+      новые ордера и сделки попадают в хранилище только при коммите.
+
+Один и тот же поток ордеров с одним seed всегда дает одни и те же сделки и балансы.
+"""
+import datetime
+import random
+import uuid
+from bisect import bisect_left, bisect_right, insort
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Collection, Dict, Iterable, List, Optional, Set, Tuple
+from uuid import UUID
+from src.dataBase.models.order import OrderORM
+from src.dataBase.models.balance import TransactionORM
+from src.engine.expiry import ExpiryScheduler
+from src.schemas.order import OrderStatus, OrderType, OperationDirection, SelfTradePrevention
+
+OPEN_STATUSES = (OrderStatus.NEW, OrderStatus.PART_EXEC)
+STOP_ORDER_TYPES = (OrderType.STOP, OrderType.STOP_LIMIT)
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# (цена со знаком для сортировки, время, номер поступления, id ордера)
+BookEntry = Tuple[int, datetime.datetime, int, UUID]
+# (stop_price со знаком для сортировки, номер поступления, id ордера)
+StopEntry = Tuple[int, int, UUID]
+# Поля ордера, которые меняет логика биржи: qty - при DECREMENT_BOTH, type и timestamp - при срабатывании стоп-ордера
+ORDER_FIELDS = ("filled", "status", "qty", "type", "timestamp", "reserved")
+OrderSnapshot = Tuple[OrderORM, tuple]
+
+class SimulatedClock:
+    """
+    Часы симуляции: стоят на месте, пока их не передвинут. Время не идет назад
+    """
+    def __init__(self, start: datetime.datetime = EPOCH):
+        self._now = start
+
+    def now(self) -> datetime.datetime:
+        return self._now
+
+    def set(self, moment: datetime.datetime):
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=datetime.timezone.utc)
+        self._now = max(self._now, moment)
+
+    def advance(self, seconds: float):
+        self._now += datetime.timedelta(seconds=seconds)
+
+@dataclass(slots=True)
+class MemoryBalance:
+    user_id: UUID
+    ticker: str
+    amount: int = 0
+    reserved: int = 0
+
+class MemoryBackend:
+    def __init__(
+        self,
+        seed: int = 0,
+        clock: Optional[SimulatedClock] = None,
+        on_trade: Optional[Callable[[TransactionORM], None]] = None,
+        self_trade_prevention: SelfTradePrevention = SelfTradePrevention.CANCEL_NEWEST
+    ):
+        self.clock = clock or SimulatedClock()
+        self.on_trade = on_trade
+        self.self_trade_prevention = self_trade_prevention
+        self.instruments: Set[str] = {"RUB"}
+        self.orders: Dict[UUID, OrderORM] = {}
+        self.balances: Dict[Tuple[UUID, str], MemoryBalance] = {}
+        self.trades: List[TransactionORM] = []
+        self.last_prices: Dict[str, int] = {}
+        self.expiry = ExpiryScheduler()
+        self._book: Dict[Tuple[str, OperationDirection], List[BookEntry]] = {}
+        self._book_keys: Dict[UUID, BookEntry] = {}
+        self._stops: Dict[Tuple[str, OperationDirection], List[StopEntry]] = {}
+        self._stop_keys: Dict[UUID, StopEntry] = {}
+        self._random = random.Random(seed)
+        self._sequence = 0
+
+    def add_instrument(self, ticker: str):
+        self.instruments.add(ticker)
+
+    def deposit(self, user_id: UUID, ticker: str, amount: int):
+        balance = self.balances.setdefault((user_id, ticker), MemoryBalance(user_id, ticker))
+        balance.amount += amount
+
+    def new_id(self) -> UUID:
+        return uuid.UUID(int=self._random.getrandbits(128), version=4)
+
+    def side(self, ticker: str, direction: OperationDirection) -> List[BookEntry]:
+        return self._book.setdefault((ticker, direction), [])
+
+    def stops(self, ticker: str, direction: OperationDirection) -> List[StopEntry]:
+        return self._stops.setdefault((ticker, direction), [])
+
+    def triggered_stops(self, ticker: str, low: int, high: int) -> List[StopEntry]:
+        # Покупка срабатывает при stop_price <= high, продажа (ключ -stop_price) при -stop_price <= -low
+        buys = self.stops(ticker, OperationDirection.BUY)
+        sells = self.stops(ticker, OperationDirection.SELL)
+        triggered = buys[:bisect_right(buys, (high, float("inf")))] + sells[:bisect_right(sells, (-low, float("inf")))]
+        return sorted(triggered, key=lambda entry: entry[1])
+
+    def index(self, order: OrderORM):
+        """
+        Приводит стакан и списки стоп-ордеров в соответствие с закоммиченным состоянием ордера
+        """
+        stop = self._stop_keys.get(order.id)
+        pending = order.type in STOP_ORDER_TYPES and order.status == OrderStatus.NEW
+        if stop is not None and not pending:
+            entries = self.stops(order.ticker, order.direction)
+            del entries[bisect_left(entries, stop)]
+            del self._stop_keys[order.id]
+        elif stop is None and pending:
+            self._sequence += 1
+            stop_price = order.stop_price if order.direction == OperationDirection.BUY else -order.stop_price
+            stop = (stop_price, self._sequence, order.id)
+            insort(self.stops(order.ticker, order.direction), stop)
+            self._stop_keys[order.id] = stop
+
+        entry = self._book_keys.get(order.id)
+        resting = order.type == OrderType.LIMIT and order.status in OPEN_STATUSES
+        if entry is not None and not resting:
+            entries = self.side(order.ticker, order.direction)
+            del entries[bisect_left(entries, entry)]
+            del self._book_keys[order.id]
+        elif entry is None and resting:
+            self._sequence += 1
+            price = -order.price if order.direction == OperationDirection.BUY else order.price
+            entry = (price, order.timestamp, self._sequence, order.id)
+            insort(self.side(order.ticker, order.direction), entry)
+            self._book_keys[order.id] = entry
+
+    async def tickers(self) -> Set[str]:
+        return set(self.instruments)
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator["MemoryStorage"]:
+        storage = MemoryStorage(self)
+        try:
+            yield storage
+        finally:
+            # Как и у сессии SQLAlchemy, незакоммиченное при выходе отбрасывается
+            await storage.rollback()
+
+def order_fields(order: OrderORM) -> tuple:
+    # Значения читаются из __dict__ в обход инструментирования атрибутов: это самое частое действие транзакции
+    return tuple(map(order.__dict__.get, ORDER_FIELDS))
+
+class MemoryStorage:
+    """
+    Транзакция MemoryBackend. Ордера и балансы изменяются на месте, исходные значения хранятся до коммита
+    """
+    def __init__(self, backend: MemoryBackend):
+        self.backend = backend
+        # Ордера, выданные транзакции, и их поля на момент выдачи или последнего коммита:
+        # изменить вызывающий код может только их
+        self._orders: Dict[UUID, OrderSnapshot] = {}
+        self._balances: Dict[Tuple[UUID, str], Tuple[MemoryBalance, int, int]] = {}
+        self._created: List[Tuple[UUID, str]] = []
+        self._new_orders: Dict[UUID, OrderORM] = {}
+        self._new_trades: Dict[UUID, TransactionORM] = {}
+
+    @property
+    def self_trade_prevention(self) -> SelfTradePrevention:
+        return self.backend.self_trade_prevention
+
+    def now(self) -> datetime.datetime:
+        return self.backend.clock.now()
+
+    def new_id(self) -> UUID:
+        return self.backend.new_id()
+
+    def _touch_order(self, order: OrderORM) -> OrderORM:
+        if order.id not in self._orders:
+            self._orders[order.id] = (order, order_fields(order))
+        return order
+
+    def _touch_balance(self, balance: MemoryBalance) -> MemoryBalance:
+        key = (balance.user_id, balance.ticker)
+        if key not in self._balances:
+            self._balances[key] = (balance, balance.amount, balance.reserved)
+        return balance
+
+    def _balance(self, user_id: UUID, ticker: str, create: bool = False) -> Optional[MemoryBalance]:
+        balance = self.backend.balances.get((user_id, ticker))
+        if balance is None:
+            if not create:
+                return None
+            balance = self.backend.balances[(user_id, ticker)] = MemoryBalance(user_id, ticker)
+            self._created.append((user_id, ticker))
+        return self._touch_balance(balance)
+
+    async def book_orders(
+        self,
+        ticker: str,
+        side: OperationDirection,
+        price_limit: Optional[int] = None,
+        qty: Optional[int] = None,
+        exclude_users: Collection[UUID] = ()
+    ) -> List[OrderORM]:
+        # Ключ стакана - цена со знаком: обе стороны обходятся по возрастанию ключа до price_limit
+        key_limit = None if price_limit is None else (-price_limit if side == OperationDirection.BUY else price_limit)
+        covered = 0
+        orders = []
+        for key, _, _, order_id in self.backend.side(ticker, side):
+            if key_limit is not None and key > key_limit:
+                break
+            order = self.backend.orders[order_id]
+            # Изменения этой транзакции видны сразу, как после autoflush в сессии
+            if order.status not in OPEN_STATUSES:
+                continue
+            orders.append(self._touch_order(order))
+            if qty is not None and order.user_id not in exclude_users:
+                covered += order.qty - (order.filled or 0)
+                if covered >= qty:
+                    break
+        return orders
+
+    async def best_price(self, ticker: str, side: OperationDirection) -> Optional[int]:
+        for price, _, _, order_id in self.backend.side(ticker, side):
+            if self.backend.orders[order_id].status in OPEN_STATUSES:
+                return -price if side == OperationDirection.BUY else price
+        return None
+
+    async def triggered_stops(self, ticker: str, low: int, high: int) -> List[OrderORM]:
+        orders = (self.backend.orders[order_id] for _, _, order_id in self.backend.triggered_stops(ticker, low, high))
+        return [self._touch_order(order) for order in orders if order.type in STOP_ORDER_TYPES and order.status == OrderStatus.NEW]
+
+    async def last_price(self, ticker: str) -> Optional[int]:
+        return self.backend.last_prices.get(ticker)
+
+    async def find_order(self, order_id: UUID, user_id: UUID) -> Optional[OrderORM]:
+        order = self.backend.orders.get(order_id)
+        if order is None or order.user_id != user_id:
+            return None
+        return self._touch_order(order)
+
+    async def is_archived(self, order_id: UUID, user_id: UUID) -> bool:
+        return False
+
+    async def get_balance(self, user_id: UUID, ticker: str) -> Optional[MemoryBalance]:
+        return self._balance(user_id, ticker)
+
+    async def lock_balance(self, user_id: UUID, ticker: str) -> Optional[MemoryBalance]:
+        return self._balance(user_id, ticker)
+
+    async def lock_balances(self, keys: Iterable[Tuple[UUID, str]]) -> Dict[Tuple[UUID, str], MemoryBalance]:
+        return {key: self._balance(*key, create=True) for key in sorted(set(keys))}
+
+    async def increase_balance(self, user_id: UUID, ticker: str, amount: int):
+        self._balance(user_id, ticker, create=True).amount += amount
+
+    def record(self, user_id: UUID, ticker: str, amount: int = 0, reserved: int = 0):
+        # Леджер процесса следит за балансами в Postgres, здесь балансы и так в памяти
+        pass
+
+    def add(self, instance):
+        if isinstance(instance, TransactionORM):
+            self._new_trades[instance.id] = instance
+        elif instance.id in self.backend.orders:
+            self._touch_order(instance)
+        else:
+            self._new_orders[instance.id] = instance
+
+    async def delete(self, instance):
+        self._new_trades.pop(instance.id, None)
+        self._new_orders.pop(instance.id, None)
+
+    async def refresh(self, instance):
+        pass
+
+    async def commit(self):
+        backend = self.backend
+        for order in self._new_orders.values():
+            if order.filled is None:
+                order.filled = 0
+            backend.orders[order.id] = order
+            backend.index(order)
+            self._orders[order.id] = (order, order_fields(order))
+            if order.expires_at is not None:
+                backend.expiry.schedule(order.id, order.expires_at)
+        for order_id, (order, fields) in self._orders.items():
+            current = order_fields(order)
+            if current != fields:
+                backend.index(order)
+                # Транзакция продолжается: следующий откат возвращает ордер к закоммиченному состоянию
+                self._orders[order_id] = (order, current)
+        for trade in self._new_trades.values():
+            backend.trades.append(trade)
+            backend.last_prices[trade.ticker] = trade.price
+            if backend.on_trade is not None:
+                backend.on_trade(trade)
+
+        # Транзакция продолжается: объекты, которые держит вызывающий код, откатываются к закоммиченному состоянию
+        self._balances = {key: (balance, balance.amount, balance.reserved) for key, (balance, _, _) in self._balances.items()}
+        self._created.clear()
+        self._new_orders.clear()
+        self._new_trades.clear()
+
+    async def rollback(self):
+        # Транзакция закрывается откатом и после коммита: восстанавливаем только то, что действительно менялось
+        for order, fields in self._orders.values():
+            if order_fields(order) != fields:
+                for name, value in zip(ORDER_FIELDS, fields):
+                    setattr(order, name, value)
+        for balance, amount, reserved in self._balances.values():
+            balance.amount = amount
+            balance.reserved = reserved
+        for key in self._created:
+            self.backend.balances.pop(key, None)
+        self._balances = {key: entry for key, entry in self._balances.items() if key in self.backend.balances}
+        self._created.clear()
+        self._new_orders.clear()
+        self._new_trades.clear()
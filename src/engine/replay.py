@@ -0,0 +1,227 @@
+"""
+Детерминированное воспроизведение потока ордеров без Postgres.
+
+Поток событий читается из NDJSON, по одному событию на строку:
+    {"ts": "2026-01-05T10:00:00Z", "user": "alice", "action": "order", "ref": "a1",
+     "direction": "BUY", "ticker": "MEME", "qty": 10, "price": 5, "time_in_force": "GTD", "expires_at": "2026-01-05T10:05:00Z"}
+    {"ts": 1767607201.5, "user": "alice", "action": "cancel", "ref": "a1"}
+    {"ts": 1767607202, "user": "bob", "action": "deposit", "ticker": "RUB", "amount": 1000}
+ts - время ISO 8601 или секунды Unix; без price ордер рыночный, со stop_price - стоп или стоп-лимитный.
+GTD-ордера снимаются перед первым событием, ts которого не раньше их expires_at. Пользователи и ордера задаются
+именами (user, ref), в выводе используются те же имена.
+
+Начальные балансы - JSON {"alice": {"RUB": 100000, "MEME": 50}, ...}.
+
+Ордера проходят через ту же логику, что и POST/DELETE /api/v1/order, с MemoryBackend и часами
+симуляции, которые перед каждым событием переставляются на его ts. Сделки пишутся в NDJSON по мере
+исполнения, итоговые балансы - в JSON, сводка с пропускной способностью - в stderr.
+
+Запуск из корня репозитория:
+    python -m src.engine.replay events.ndjson --balances balances.json [--fills fills.ndjson]
+        [--balances-out final.json] [--seed 0] [--instruments MEME,GOLD] [--self-trade-prevention CANCEL_NEWEST]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import sys
+import time
+import uuid
+from dataclasses import dataclass, asdict
+from typing import Any, Callable, Dict, IO, Iterable, Iterator, List, Optional
+from fastapi import HTTPException
+from pydantic import TypeAdapter, ValidationError
+from src.dataBase.models.balance import TransactionORM
+from src.api.stockMarket.order import submit_order, cancel_user_order
+from src.engine.memory import MemoryBackend, SimulatedClock
+from src.schemas.order import MarketOrderBody, LimitOrderBody, StopOrderBody, StopLimitOrderBody, OrderStatus, SelfTradePrevention
+
+# Пользователи симуляции получают постоянные UUID по имени, независимо от порядка событий
+USER_NAMESPACE = uuid.UUID("6f1c2b1e-3c4d-4e5f-8a9b-0c1d2e3f4a5b")
+
+order_body_adapter = TypeAdapter(StopLimitOrderBody | StopOrderBody | LimitOrderBody | MarketOrderBody)
+
+@dataclass
+class ReplayStats:
+    events: int = 0
+    orders: int = 0
+    cancels: int = 0
+    deposits: int = 0
+    expired: int = 0
+    rejected: int = 0
+    fills: int = 0
+    seconds: float = 0.0
+
+    @property
+    def events_per_second(self) -> float:
+        return self.events / self.seconds if self.seconds else 0.0
+
+def parse_ts(value: Any) -> datetime.datetime:
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value, tz=datetime.timezone.utc)
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+def read_events(stream: IO[str]) -> Iterator[Dict[str, Any]]:
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+class Replay:
+    """
+    Состояние воспроизведения: биржа в памяти и соответствие имен пользователей и ордеров их UUID
+    """
+    def __init__(
+        self,
+        seed: int = 0,
+        instruments: Optional[Iterable[str]] = None,
+        on_fill: Optional[Callable[[Dict[str, Any]], None]] = None,
+        self_trade_prevention: SelfTradePrevention = SelfTradePrevention.CANCEL_NEWEST
+    ):
+        self.clock = SimulatedClock()
+        self.backend = MemoryBackend(seed=seed, clock=self.clock, on_trade=self._on_trade, self_trade_prevention=self_trade_prevention)
+        # Без явного списка инструментов тикер регистрируется при первом упоминании
+        self.fixed_instruments = instruments is not None
+        for ticker in instruments or ():
+            self.backend.add_instrument(ticker)
+        self.on_fill = on_fill
+        self.stats = ReplayStats()
+        self.users: Dict[uuid.UUID, str] = {}
+        self.refs: Dict[str, uuid.UUID] = {}
+        self.order_refs: Dict[uuid.UUID, str] = {}
+        self._trades: List[TransactionORM] = []
+
+    def user_id(self, name: str) -> uuid.UUID:
+        user_id = uuid.uuid5(USER_NAMESPACE, name)
+        self.users[user_id] = name
+        return user_id
+
+    def instrument(self, ticker: str):
+        if not self.fixed_instruments:
+            self.backend.add_instrument(ticker)
+
+    def deposit(self, user: str, ticker: str, amount: int):
+        self.instrument(ticker)
+        self.backend.deposit(self.user_id(user), ticker, amount)
+
+    def _on_trade(self, trade: TransactionORM):
+        # Сделки выводятся после события: к этому времени известен id нового ордера и его ref
+        self.stats.fills += 1
+        self._trades.append(trade)
+
+    def _emit_fills(self):
+        trades, self._trades = self._trades, []
+        if self.on_fill is None:
+            return
+        for trade in trades:
+            self.on_fill({
+                "ts": trade.timestamp.isoformat(),
+                "ticker": trade.ticker,
+                "price": trade.price,
+                "qty": trade.amount,
+                "taker_direction": trade.taker_direction.value,
+                "maker": self.users.get(trade.maker_user_id),
+                "taker": self.users.get(trade.taker_user_id),
+                "maker_ref": self.order_refs.get(trade.maker_order_id),
+                "taker_ref": self.order_refs.get(trade.taker_order_id),
+            })
+
+    async def expire_orders(self):
+        # Часы двигаются только событиями: сроки проверяются перед каждым из них
+        for order_id in self.backend.expiry.due(self.clock.now()):
+            order = self.backend.orders.get(order_id)
+            if order is not None and order.status in (OrderStatus.NEW, OrderStatus.PART_EXEC):
+                await cancel_user_order(self.backend, order_id, order.user_id)
+                self.stats.expired += 1
+
+    async def apply(self, event: Dict[str, Any]):
+        self.stats.events += 1
+        self.clock.set(parse_ts(event["ts"]))
+        await self.expire_orders()
+        action = event.get("action", "order")
+        user_id = self.user_id(event["user"])
+        try:
+            if action == "order":
+                self.stats.orders += 1
+                body = order_body_adapter.validate_python(
+                    {key: event[key] for key in ("direction", "ticker", "qty", "price", "stop_price", "time_in_force", "expires_at") if event.get(key) is not None}
+                )
+                self.instrument(body.ticker)
+                order = await submit_order(self.backend, user_id, body)
+                if event.get("ref") is not None:
+                    self.refs[event["ref"]] = order.id
+                    self.order_refs[order.id] = event["ref"]
+            elif action == "cancel":
+                self.stats.cancels += 1
+                order_id = self.refs.get(event["ref"])
+                if order_id is None:
+                    raise HTTPException(status_code=404, detail="Ордер не найден")
+                await cancel_user_order(self.backend, order_id, user_id)
+            elif action == "deposit":
+                self.stats.deposits += 1
+                self.deposit(event["user"], event["ticker"], int(event["amount"]))
+            else:
+                raise ValueError(f"Неизвестное действие: {action}")
+        except (HTTPException, ValidationError):
+            self.stats.rejected += 1
+        finally:
+            self._emit_fills()
+
+    async def run(self, events: Iterable[Dict[str, Any]]) -> ReplayStats:
+        started = time.perf_counter()
+        for event in events:
+            await self.apply(event)
+        self.stats.seconds += time.perf_counter() - started
+        return self.stats
+
+    def balances(self) -> Dict[str, Dict[str, Dict[str, int]]]:
+        result: Dict[str, Dict[str, Dict[str, int]]] = {}
+        for (user_id, ticker), balance in sorted(self.backend.balances.items(), key=lambda item: (self.users.get(item[0][0], str(item[0][0])), item[0][1])):
+            name = self.users.get(user_id, str(user_id))
+            result.setdefault(name, {})[ticker] = {"amount": balance.amount, "reserved": balance.reserved}
+        return result
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Воспроизведение потока ордеров на бирже в памяти")
+    parser.add_argument("events", help="NDJSON с событиями, '-' - stdin")
+    parser.add_argument("--balances", help="JSON с начальными балансами пользователей")
+    parser.add_argument("--fills", default="-", help="куда писать сделки (NDJSON), по умолчанию stdout")
+    parser.add_argument("--balances-out", help="куда записать итоговые балансы (JSON)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--instruments", help="список тикеров через запятую; по умолчанию все встреченные")
+    parser.add_argument("--self-trade-prevention", type=SelfTradePrevention, choices=list(SelfTradePrevention), default=SelfTradePrevention.CANCEL_NEWEST)
+    args = parser.parse_args()
+
+    fills = sys.stdout if args.fills == "-" else open(args.fills, "w", encoding="utf-8")
+    instruments = args.instruments.split(",") if args.instruments else None
+    replay = Replay(
+        seed=args.seed,
+        instruments=instruments,
+        on_fill=lambda fill: fills.write(json.dumps(fill) + "\n"),
+        self_trade_prevention=args.self_trade_prevention
+    )
+
+    if args.balances:
+        with open(args.balances, encoding="utf-8") as file:
+            for user, assets in json.load(file).items():
+                for ticker, amount in assets.items():
+                    replay.deposit(user, ticker, int(amount))
+
+    events = sys.stdin if args.events == "-" else open(args.events, encoding="utf-8")
+    try:
+        stats = asyncio.run(replay.run(read_events(events)))
+    finally:
+        if events is not sys.stdin:
+            events.close()
+        if fills is not sys.stdout:
+            fills.close()
+
+    if args.balances_out:
+        with open(args.balances_out, "w", encoding="utf-8") as file:
+            json.dump(replay.balances(), file, ensure_ascii=False, indent=2)
+
+    print(json.dumps({**asdict(stats), "events_per_second": round(stats.events_per_second)}), file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
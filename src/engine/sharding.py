@@ -0,0 +1,166 @@
+"""
+Матчинг по шардам: тикеры распределяются между процессами-шардами (MATCHING_SHARDS, по одному на ядро),
+каждый тикер всегда попадает в один и тот же шард (crc32 тикера по модулю числа шардов).
+
+Шард - отдельный процесс со своим циклом событий и своим пулом соединений, он выполняет проходы
+матчинга (match_limit_orders) своих тикеров по очереди. Всплеск ордеров по одному тикеру занимает
+только его шард, остальные тикеры матчатся параллельно на других ядрах.
+
+Согласованность балансов держится на резервах: средства под лимитный ордер резервируются при приеме
+ордера (reserve_funds, в процессе API), а проход матчинга только расходует зарезервированное. Шарды разных
+тикеров могут рассчитываться по одному и тому же балансу RUB; строки балансов блокируются одним запросом
+в порядке (user_id, ticker) (lock_balances), поэтому такие шарды ждут друг друга, но не взаимоблокируются.
+
+Кэши процесса API (леджер балансов, стаканы, номера изменений для кэша ответов) обновляются после коммита
+слушателями сессии. В шарде те же изменения перехватываются до слушателей и возвращаются вместе
+с результатом прохода, процесс API применяет их у себя.
+
+Проходы по одному тикеру склеиваются: если проход, начавшийся после запроса, уже завершился,
+новый не запускается - он увидел бы тот же стакан.
+
+Пул шардов принадлежит процессу API, поэтому шарды запускаются только при одном воркере (WEB_CONCURRENCY=1).
+При нескольких воркерах у каждого был бы свой пул: проходы одного тикера из разных воркеров шли бы параллельно
+и не склеивались, а процессов матчинга стало бы воркеры x шарды. Масштабирование по ядрам в этом режиме
+дают шарды одного воркера, а не воркеры uvicorn.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import zlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+from fastapi import HTTPException
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from src.api.profile.ledger import LEDGER_EVENTS_KEY, LedgerEvent, ledger
+from src.api.stockMarket.cache import CHANGED_TICKERS_KEY, sequences
+from src.config import settings
+from src.engine.book import BOOK_UPDATES_KEY, BookUpdate, books
+from src.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+class ShardResult(NamedTuple):
+    """
+    Изменения, закоммиченные проходом в шарде, цены его сделок и ошибка прохода (status_code, detail), если была
+    """
+    ledger_events: List[LedgerEvent]
+    book_updates: List[BookUpdate]
+    changed: Set[str]
+    prices: List[int]
+    error: Optional[Tuple[int, Any]]
+
+#-----------------------------------------------------------------------------------------------------------------#
+#                                           Процесс шарда                                                         #
+#-----------------------------------------------------------------------------------------------------------------#
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_committed: List[Tuple[List[LedgerEvent], List[BookUpdate], Set[str]]] = []
+
+def _capture_committed(session: Session):
+    # Срабатывает раньше слушателей ledger, book и cache, которые забирают эти ключи из session.info
+    _committed.append((
+        list(session.info.get(LEDGER_EVENTS_KEY, ())),
+        list(session.info.get(BOOK_UPDATES_KEY, {}).values()),
+        set(session.info.get(CHANGED_TICKERS_KEY, ()))
+    ))
+
+def _init_shard():
+    global _loop
+    # Цикл событий живет все время жизни процесса: пул соединений движка привязан к нему
+    _loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_loop)
+    event.listen(Session, "after_commit", _capture_committed, insert=True)
+
+def _match_in_shard(ticker: str) -> ShardResult:
+    from src.api.stockMarket.order import match_limit_orders
+
+    error, prices = None, []
+    try:
+        prices = _loop.run_until_complete(match_limit_orders(ticker))
+    except HTTPException as exc:
+        # HTTPException не переживает pickle: передаем код и текст
+        error = (exc.status_code, exc.detail)
+    finally:
+        committed = list(_committed)
+        _committed.clear()
+
+    ledger_events, book_updates, changed = [], [], set()
+    for events, updates, tickers in committed:
+        ledger_events.extend(events)
+        book_updates.extend(updates)
+        changed.update(tickers)
+    return ShardResult(ledger_events, book_updates, changed, prices, error)
+
+#-----------------------------------------------------------------------------------------------------------------#
+#                                            Процесс API                                                          #
+#-----------------------------------------------------------------------------------------------------------------#
+
+class MatchingShards:
+    def __init__(self):
+        self._executors: List[ProcessPoolExecutor] = []
+        self._locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        # Номер последнего запроса прохода по тикеру и номер запроса, который покрыл последний завершенный проход
+        self._requested: Dict[str, int] = defaultdict(int)
+        self._completed: Dict[str, int] = defaultdict(int)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._executors)
+
+    @property
+    def count(self) -> int:
+        return len(self._executors)
+
+    def start(self, count: int):
+        if settings.WEB_CONCURRENCY > 1:
+            raise RuntimeError(
+                f"Шарды матчинга запускаются только при одном воркере API, WEB_CONCURRENCY={settings.WEB_CONCURRENCY}: "
+                "уменьшите число воркеров или выключите MATCHING_SHARDS"
+            )
+        if count < 0:
+            count = os.cpu_count() or 1
+        # spawn: дочерний процесс не наследует соединения и цикл событий родителя
+        context = multiprocessing.get_context("spawn")
+        self._executors = [
+            ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_init_shard)
+            for _ in range(count)
+        ]
+        metrics.set("matching_shards", count)
+        logger.info("Запущено шардов матчинга: %d", count)
+
+    def stop(self):
+        executors, self._executors = self._executors, []
+        for executor in executors:
+            executor.shutdown(wait=True, cancel_futures=True)
+        metrics.set("matching_shards", 0)
+
+    def shard_for(self, ticker: str) -> int:
+        return zlib.crc32(ticker.encode()) % len(self._executors)
+
+    async def match(self, ticker: str) -> List[int]:
+        self._requested[ticker] += 1
+        request = self._requested[ticker]
+        async with self._locks[ticker]:
+            if self._completed[ticker] >= request:
+                metrics.increment("matching_passes_coalesced")
+                # Стоп-ордера по ценам сделок покрывшего прохода проверит тот, кто его запускал
+                return []
+            # Все запросы, пришедшие до этой строки, покрываются проходом, который сейчас начнется
+            covered = self._requested[ticker]
+            executor = self._executors[self.shard_for(ticker)]
+            result = await asyncio.get_running_loop().run_in_executor(executor, _match_in_shard, ticker)
+            self._completed[ticker] = covered
+
+        ledger.apply(result.ledger_events)
+        books.apply(result.book_updates)
+        sequences.bump(result.changed)
+        metrics.increment("matching_passes_sharded")
+        if result.error is not None:
+            status_code, detail = result.error
+            raise HTTPException(status_code=status_code, detail=detail)
+        return result.prices
+
+shards = MatchingShards()
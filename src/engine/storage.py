@@ -0,0 +1,301 @@
+"""
+Хранилище биржи: все, что логика ордеров и расчетов (src/api/stockMarket/order.py, src/api/profile/balance.py)
+читает и пишет, проходит через ExchangeStorage. Сама логика не знает, работает она с Postgres или с памятью.
+
+    ExchangeBackend - список инструментов и новые транзакции хранилища;
+    ExchangeStorage - одна транзакция: часы и идентификаторы, чтение стакана и балансов с блокировкой,
+                      добавление объектов, коммит и откат.
+
+SqlBackend работает через сессии SQLAlchemy (боевой режим), MemoryBackend (src/engine/memory.py) -
+в памяти процесса с симулированными часами для бэктестов.
+"""
+import datetime
+import uuid
+from contextlib import asynccontextmanager
+from typing import AsyncContextManager, AsyncIterator, Collection, Dict, Iterable, List, Optional, Protocol, Set, Tuple
+from uuid import UUID
+from sqlalchemy import select, desc, asc, func, tuple_, and_, or_, case
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.dataBase.session import async_session_factory
+from src.dataBase.models.order import OrderORM, OrderArchiveORM
+from src.dataBase.models.balance import BalanceORM, TransactionORM
+from src.api.profile.ledger import record
+from src.api.profile.instrument import get_instruments_list
+from src.config import settings
+from src.schemas.order import OrderStatus, OrderType, OperationDirection, SelfTradePrevention
+
+OPEN_STATUSES = (OrderStatus.NEW, OrderStatus.PART_EXEC)
+STOP_ORDER_TYPES = (OrderType.STOP, OrderType.STOP_LIMIT)
+
+class ExchangeStorage(Protocol):
+    self_trade_prevention: SelfTradePrevention
+
+    def now(self) -> datetime.datetime: ...
+
+    def new_id(self) -> UUID: ...
+
+    async def book_orders(
+        self,
+        ticker: str,
+        side: OperationDirection,
+        price_limit: Optional[int] = None,
+        qty: Optional[int] = None,
+        exclude_users: Collection[UUID] = ()
+    ) -> List[OrderORM]:
+        """
+        Активные лимитные ордера стороны стакана в порядке приоритета (лучшая цена, затем время).
+        price_limit - худшая цена, по которой их еще готовы исполнить.
+        qty - чтение останавливается на ордере, с которым неисполненный остаток прочитанных достигает qty;
+        ордера exclude_users (возможные самосделки) в этот остаток не входят
+        """
+        ...
+
+    async def best_price(self, ticker: str, side: OperationDirection) -> Optional[int]: ...
+
+    async def triggered_stops(self, ticker: str, low: int, high: int) -> List[OrderORM]:
+        """
+        Ожидающие стоп-ордера, которые срабатывают на сделках по ценам от low до high:
+        покупки со stop_price <= high и продажи со stop_price >= low, в порядке поступления
+        """
+        ...
+
+    async def last_price(self, ticker: str) -> Optional[int]: ...
+
+    async def find_order(self, order_id: UUID, user_id: UUID) -> Optional[OrderORM]: ...
+
+    async def is_archived(self, order_id: UUID, user_id: UUID) -> bool: ...
+
+    async def get_balance(self, user_id: UUID, ticker: str) -> Optional[BalanceORM]:
+        """
+        Баланс без блокировки, только для предварительных проверок
+        """
+        ...
+
+    async def lock_balance(self, user_id: UUID, ticker: str) -> Optional[BalanceORM]: ...
+
+    async def lock_balances(self, keys: Iterable[Tuple[UUID, str]]) -> Dict[Tuple[UUID, str], BalanceORM]:
+        """
+        Блокирует балансы в порядке (user_id, ticker), недостающие создаются с нулями
+        """
+        ...
+
+    async def increase_balance(self, user_id: UUID, ticker: str, amount: int): ...
+
+    def record(self, user_id: UUID, ticker: str, amount: int = 0, reserved: int = 0):
+        """
+        Изменение баланса для кэшей, которые должны узнать о нем после коммита
+        """
+        ...
+
+    def add(self, instance): ...
+
+    async def delete(self, instance): ...
+
+    async def refresh(self, instance): ...
+
+    async def commit(self): ...
+
+    async def rollback(self): ...
+
+class ExchangeBackend(Protocol):
+    async def tickers(self) -> Set[str]: ...
+
+    def transaction(self) -> AsyncContextManager[ExchangeStorage]:
+        """
+        Новая транзакция хранилища; незакоммиченные изменения откатываются при выходе
+        """
+        ...
+
+def book_priority(side: OperationDirection, orders=OrderORM):
+    if side == OperationDirection.BUY:
+        return desc(orders.price), asc(orders.timestamp)
+    return asc(orders.price), asc(orders.timestamp)
+
+def book_query(ticker: str, side: OperationDirection):
+    return select(OrderORM).where(
+        OrderORM.ticker == ticker,
+        OrderORM.type == OrderType.LIMIT,
+        OrderORM.status.in_(OPEN_STATUSES),
+        OrderORM.direction == side
+    ).order_by(*book_priority(side))
+
+def covering_prefix(query, side: OperationDirection, qty: int, exclude_users: Collection[UUID]):
+    """
+    Начало стакана из query, неисполненного остатка которого хватает на qty: нарастающий итог остатка
+    до ордера (окно по приоритету стакана) меньше qty. Ордера exclude_users в итог не входят
+    """
+    available = OrderORM.qty - func.coalesce(OrderORM.filled, 0)
+    if exclude_users:
+        available = case((OrderORM.user_id.in_(exclude_users), 0), else_=available)
+    covered = func.coalesce(func.sum(available).over(order_by=book_priority(side), rows=(None, -1)), 0)
+    book = query.add_columns(covered.label("covered")).order_by(None).subquery()
+    orders = aliased(OrderORM, book)
+    return select(orders).where(book.c.covered < qty).order_by(*book_priority(side, orders))
+
+class SqlStorage:
+    """
+    Транзакция хранилища поверх сессии SQLAlchemy
+    """
+    def __init__(self, session: AsyncSession):
+        self.session = session
+        # Балансы, заблокированные в текущей транзакции: до ее конца их никто другой не изменит,
+        # повторные блокировки и пополнения обходятся без запросов. Блокировки снимаются коммитом и откатом
+        self._locked: Dict[Tuple[UUID, str], BalanceORM] = {}
+
+    @property
+    def self_trade_prevention(self) -> SelfTradePrevention:
+        return settings.SELF_TRADE_PREVENTION
+
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    def new_id(self) -> UUID:
+        return uuid.uuid4()
+
+    async def book_orders(
+        self,
+        ticker: str,
+        side: OperationDirection,
+        price_limit: Optional[int] = None,
+        qty: Optional[int] = None,
+        exclude_users: Collection[UUID] = ()
+    ) -> List[OrderORM]:
+        # Ордера читаются без блокировок: изменения записываются с проверкой версии (OrderORM.version)
+        query = book_query(ticker, side)
+        if price_limit is not None:
+            query = query.where(OrderORM.price >= price_limit if side == OperationDirection.BUY else OrderORM.price <= price_limit)
+        if qty is not None:
+            query = covering_prefix(query, side, qty, exclude_users)
+        return (await self.session.execute(query)).scalars().all()
+
+    async def best_price(self, ticker: str, side: OperationDirection) -> Optional[int]:
+        best = func.max(OrderORM.price) if side == OperationDirection.BUY else func.min(OrderORM.price)
+        query = select(best).where(
+            OrderORM.ticker == ticker,
+            OrderORM.type == OrderType.LIMIT,
+            OrderORM.status.in_(OPEN_STATUSES),
+            OrderORM.direction == side
+        )
+        return (await self.session.execute(query)).scalar_one_or_none()
+
+    async def triggered_stops(self, ticker: str, low: int, high: int) -> List[OrderORM]:
+        # Оба условия - диапазоны по частичному индексу ix_order_stop_trigger: читаются только сработавшие стопы
+        query = select(OrderORM).where(
+            OrderORM.ticker == ticker,
+            OrderORM.type.in_(STOP_ORDER_TYPES),
+            OrderORM.status == OrderStatus.NEW,
+            or_(
+                and_(OrderORM.direction == OperationDirection.BUY, OrderORM.stop_price <= high),
+                and_(OrderORM.direction == OperationDirection.SELL, OrderORM.stop_price >= low)
+            )
+        ).order_by(asc(OrderORM.timestamp), asc(OrderORM.id))
+        return (await self.session.execute(query)).scalars().all()
+
+    async def last_price(self, ticker: str) -> Optional[int]:
+        query = select(TransactionORM.price).where(TransactionORM.ticker == ticker).order_by(desc(TransactionORM.timestamp)).limit(1)
+        return (await self.session.execute(query)).scalar_one_or_none()
+
+    async def find_order(self, order_id: UUID, user_id: UUID) -> Optional[OrderORM]:
+        result = await self.session.execute(select(OrderORM).where(OrderORM.id == order_id, OrderORM.user_id == user_id))
+        return result.scalar_one_or_none()
+
+    async def is_archived(self, order_id: UUID, user_id: UUID) -> bool:
+        result = await self.session.execute(
+            select(OrderArchiveORM.id).where(OrderArchiveORM.id == order_id, OrderArchiveORM.user_id == user_id)
+        )
+        return result.scalar_one_or_none() is not None
+
+    async def get_balance(self, user_id: UUID, ticker: str) -> Optional[BalanceORM]:
+        result = await self.session.execute(select(BalanceORM).where(BalanceORM.user_id == user_id, BalanceORM.ticker == ticker))
+        return result.scalar_one_or_none()
+
+    async def lock_balance(self, user_id: UUID, ticker: str) -> Optional[BalanceORM]:
+        balance = self._locked.get((user_id, ticker))
+        if balance is not None:
+            return balance
+        result = await self.session.execute(
+            select(BalanceORM).where(BalanceORM.user_id == user_id, BalanceORM.ticker == ticker).with_for_update(),
+            execution_options={"populate_existing": True}
+        )
+        balance = result.scalar_one_or_none()
+        if balance is not None:
+            self._locked[(user_id, ticker)] = balance
+        return balance
+
+    async def lock_balances(self, keys: Iterable[Tuple[UUID, str]]) -> Dict[Tuple[UUID, str], BalanceORM]:
+        """
+        Блокирует балансы (user_id, ticker) одним SELECT ... FOR UPDATE в порядке (user_id, ticker).
+        Расчет по сделкам берет все нужные блокировки этой функцией до первого изменения балансов,
+        поэтому параллельные проходы матчинга ждут друг друга, а не взаимоблокируются.
+        Недостающие строки создаются заранее в том же порядке
+        """
+        keys = sorted(set(keys))
+        if not keys:
+            return {}
+
+        await self.session.execute(
+            insert(BalanceORM)
+            .values([{"user_id": user_id, "ticker": ticker, "amount": 0, "reserved": 0} for user_id, ticker in keys])
+            .on_conflict_do_nothing(index_elements=["user_id", "ticker"])
+        )
+        result = await self.session.execute(
+            select(BalanceORM)
+            .where(tuple_(BalanceORM.user_id, BalanceORM.ticker).in_(keys))
+            .order_by(BalanceORM.user_id, BalanceORM.ticker)
+            .with_for_update(),
+            execution_options={"populate_existing": True}
+        )
+        balances = {(balance.user_id, balance.ticker): balance for balance in result.scalars()}
+        self._locked.update(balances)
+        return balances
+
+    async def increase_balance(self, user_id: UUID, ticker: str, amount: int):
+        balance = self._locked.get((user_id, ticker))
+        if balance is not None:
+            balance.amount += amount
+            return
+        stmt = (
+            insert(BalanceORM)
+            .values(user_id=user_id, ticker=ticker, amount=amount, reserved=0)
+            .on_conflict_do_update(
+                index_elements=["user_id", "ticker"],
+                set_={"amount": BalanceORM.amount + amount}
+            )
+            .returning(BalanceORM)
+        )
+        # Строка может быть уже загружена в сессию (lock_balances) - обновляем ее, чтобы не записать потом старый amount
+        await self.session.execute(stmt, execution_options={"populate_existing": True})
+
+    def record(self, user_id: UUID, ticker: str, amount: int = 0, reserved: int = 0):
+        record(self.session, user_id, ticker, amount=amount, reserved=reserved)
+
+    def add(self, instance):
+        self.session.add(instance)
+
+    async def delete(self, instance):
+        await self.session.delete(instance)
+
+    async def refresh(self, instance):
+        await self.session.refresh(instance)
+
+    async def commit(self):
+        self._locked.clear()
+        await self.session.commit()
+
+    async def rollback(self):
+        self._locked.clear()
+        await self.session.rollback()
+
+class SqlBackend:
+    async def tickers(self) -> Set[str]:
+        # Список инструментов читается из кэша процесса, отдельно от транзакции
+        return {ticker for _, ticker in await get_instruments_list()}
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[SqlStorage]:
+        async with async_session_factory() as session:
+            yield SqlStorage(session)
+
+sql_backend = SqlBackend()
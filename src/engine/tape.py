@@ -0,0 +1,182 @@
+"""
+Лента сделок и изменений стакана для аналитики: файлы записей фиксированной ширины по тикеру и дню (UTC)
+    {TAPE_DIR}/{ticker}/{YYYY-MM-DD}.trades - сделки: время (нс), цена, количество, сторона тейкера;
+    {TAPE_DIR}/{ticker}/{YYYY-MM-DD}.l2     - изменения уровней стакана: время (нс), сторона, цена,
+                                              изменение количества на уровне (+ новый/увеличенный остаток,
+                                              - исполнение или отмена). Сумма изменений по (сторона, цена) - стакан.
+Без TAPE_DIR лента не пишется.
+
+Запись идет после коммита транзакции, которая изменила ордера или добавила сделки: изменения собираются
+в after_flush, как для леджера и стакана, и дописываются в конец файлов. Файл открыт с O_APPEND, записи одного
+коммита уходят одним write: несколько воркеров и шардов могут писать в один файл, не перемешивая записи.
+Лента пишется построчно, а не по колонкам: колонки файла с несколькими писателями пришлось бы размечать заранее.
+Читатель отображает файл в память (numpy.memmap) и отдает структурированный массив: колонки
+(trades["price"], l2["delta"]) - представления без копирования.
+
+Чтение из корня репозитория:
+    >>> from src.engine.tape import read_trades
+    >>> trades = read_trades("MEME", datetime.date(2026, 1, 5))
+    >>> vwap = (trades["price"] * trades["qty"]).sum() / trades["qty"].sum()
+"""
+import datetime
+import logging
+import os
+import struct
+from itertools import chain
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from src.config import settings
+from src.dataBase.models.order import OrderORM
+from src.dataBase.models.balance import TransactionORM
+from src.schemas.order import OrderStatus, OrderType, OperationDirection
+
+if TYPE_CHECKING:
+    import numpy
+
+logger = logging.getLogger(__name__)
+
+TAPE_EVENTS_KEY = "tape_events"
+OPEN_STATUSES = (OrderStatus.NEW, OrderStatus.PART_EXEC)
+# Число открытых файлов ленты в процессе; при переполнении все закрываются (обычно это смена дня)
+MAX_OPEN_FILES = 256
+
+# Раскладка записи (32 байта) одна для обеих лент: struct для записи и такой же dtype для чтения.
+# Сторона: 1 - покупка, -1 - продажа
+RECORD = struct.Struct("<qqqb7x")
+TRADE_FIELDS = ("ts", "price", "qty", "side")
+L2_FIELDS = ("ts", "price", "delta", "side")
+
+# (тикер, день, "trades" | "l2") -> упакованные записи
+TapeKey = Tuple[str, datetime.date, str]
+
+def side_code(direction: OperationDirection) -> int:
+    return 1 if direction == OperationDirection.BUY else -1
+
+def tape_path(directory: str, ticker: str, day: datetime.date, kind: str) -> str:
+    return os.path.join(directory, ticker, f"{day.isoformat()}.{kind}")
+
+def to_ns(moment: datetime.datetime) -> int:
+    return int(moment.timestamp()) * 1_000_000_000 + moment.microsecond * 1000
+
+def resting_qty(order_type: Optional[OrderType], status: Optional[OrderStatus], qty: Optional[int], filled: Optional[int]) -> int:
+    if order_type != OrderType.LIMIT or status not in OPEN_STATUSES or qty is None:
+        return 0
+    return qty - (filled or 0)
+
+def previous_value(order: OrderORM, name: str):
+    # Значение до flush; неизмененный или не загруженный атрибут читается из __dict__ без запроса в БД
+    history = order._sa_instance_state.attrs[name].history
+    if history.deleted:
+        return history.deleted[0]
+    return order.__dict__.get(name)
+
+def level_delta(order: OrderORM, is_new: bool) -> int:
+    state = order.__dict__
+    after = resting_qty(state.get("type"), state.get("status"), state.get("qty"), state.get("filled"))
+    if is_new:
+        return after
+    before = resting_qty(*(previous_value(order, name) for name in ("type", "status", "qty", "filled")))
+    return after - before
+
+def record_level_changes(session: Session, changes: List[Tuple[str, OperationDirection, int, int]]):
+    """
+    Изменения стакана, сделанные в обход ORM (массовый UPDATE): (тикер, сторона, цена, изменение количества)
+    """
+    if not settings.TAPE_DIR:
+        return
+    now = datetime.datetime.now(datetime.timezone.utc)
+    pending = session.info.setdefault(TAPE_EVENTS_KEY, {})
+    for ticker, direction, price, delta in changes:
+        if delta:
+            pending.setdefault((ticker, now.date(), "l2"), []).append(RECORD.pack(to_ns(now), price, delta, side_code(direction)))
+
+@event.listens_for(Session, "after_flush")
+def _collect_tape_events(session: Session, flush_context):
+    if not settings.TAPE_DIR:
+        return
+    now = datetime.datetime.now(datetime.timezone.utc)
+    pending = session.info.setdefault(TAPE_EVENTS_KEY, {})
+    for instance in chain(session.new, session.dirty):
+        if isinstance(instance, TransactionORM):
+            pending.setdefault((instance.ticker, instance.timestamp.astimezone(datetime.timezone.utc).date(), "trades"), []).append(
+                RECORD.pack(to_ns(instance.timestamp), instance.price, instance.amount, side_code(instance.taker_direction))
+            )
+        elif isinstance(instance, OrderORM) and instance.__dict__.get("price") is not None:
+            delta = level_delta(instance, instance in session.new)
+            if delta:
+                pending.setdefault((instance.ticker, now.date(), "l2"), []).append(
+                    RECORD.pack(to_ns(now), instance.price, delta, side_code(instance.direction))
+                )
+
+@event.listens_for(Session, "after_commit")
+def _write_committed(session: Session):
+    pending = session.info.pop(TAPE_EVENTS_KEY, None)
+    if pending:
+        try:
+            tape.append(pending)
+        except OSError:
+            # Лента - вспомогательные данные: ошибка диска не должна ломать уже закоммиченный запрос
+            logger.exception("Не удалось дописать ленту")
+
+@event.listens_for(Session, "after_transaction_end")
+def _discard_uncommitted(session: Session, transaction):
+    if transaction.parent is None:
+        session.info.pop(TAPE_EVENTS_KEY, None)
+
+class TapeWriter:
+    def __init__(self):
+        self._files: Dict[str, int] = {}
+
+    def _descriptor(self, path: str) -> int:
+        fd = self._files.get(path)
+        if fd is None:
+            if len(self._files) >= MAX_OPEN_FILES:
+                self.close()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = self._files[path] = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        return fd
+
+    def append(self, pending: Dict[TapeKey, List[bytes]]):
+        for (ticker, day, kind), records in pending.items():
+            os.write(self._descriptor(tape_path(settings.TAPE_DIR, ticker, day, kind)), b"".join(records))
+
+    def close(self):
+        files, self._files = self._files, {}
+        for fd in files.values():
+            os.close(fd)
+
+tape = TapeWriter()
+
+#-----------------------------------------------------------------------------------------------------------------#
+#                                               Чтение                                                            #
+#-----------------------------------------------------------------------------------------------------------------#
+
+def record_dtype(fields: Tuple[str, ...]) -> "numpy.dtype":
+    import numpy
+
+    return numpy.dtype({
+        "names": list(fields),
+        "formats": ["<i8", "<i8", "<i8", "i1"],
+        "offsets": [0, 8, 16, 24],
+        "itemsize": RECORD.size
+    })
+
+def read_tape(ticker: str, day: datetime.date, kind: str, directory: Optional[str] = None) -> "numpy.ndarray":
+    """
+    Отображает файл ленты в память; недописанная последняя запись (запись идет параллельно) отбрасывается
+    """
+    import numpy
+
+    dtype = record_dtype(TRADE_FIELDS if kind == "trades" else L2_FIELDS)
+    path = tape_path(directory or settings.TAPE_DIR, ticker, day, kind)
+    count = os.path.getsize(path) // dtype.itemsize if os.path.exists(path) else 0
+    if count == 0:
+        return numpy.empty(0, dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+def read_trades(ticker: str, day: datetime.date, directory: Optional[str] = None) -> "numpy.ndarray":
+    return read_tape(ticker, day, "trades", directory)
+
+def read_l2(ticker: str, day: datetime.date, directory: Optional[str] = None) -> "numpy.ndarray":
+    return read_tape(ticker, day, "l2", directory)
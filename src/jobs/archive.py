@@ -0,0 +1,126 @@
+"""
+Обслуживание истории торгов:
+    * перенос исполненных и отмененных ордеров из order в order_archive пачками;
+    * создание месячных секций transaction наперед;
+    * удаление секций transaction старше срока хранения (если он задан).
+
+Работает фоновой задачей в lifespan приложения, разовый запуск из корня репозитория:
+    python -m src.jobs.archive
+"""
+import asyncio
+import datetime
+import logging
+import re
+from sqlalchemy import select, delete, insert, text
+from src.config import settings
+from src.dataBase.session import async_session_factory
+from src.dataBase.models.order import OrderORM, OrderArchiveORM
+from src.schemas.order import OrderStatus
+
+TERMINAL_STATUSES = [OrderStatus.EXEC, OrderStatus.CANCELLED]
+PARTITION_NAME = re.compile(r"^transaction_y(\d{4})m(\d{2})$")
+
+logger = logging.getLogger(__name__)
+
+def add_months(month: datetime.date, months: int) -> datetime.date:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+def current_month() -> datetime.date:
+    return datetime.datetime.now(datetime.timezone.utc).date().replace(day=1)
+
+async def archive_terminal_orders() -> int:
+    """
+    Переносит завершенные ордера старше ORDER_ARCHIVE_AFTER_HOURS в архив, каждая пачка - отдельная транзакция
+    """
+    order_table, archive_table = OrderORM.__table__, OrderArchiveORM.__table__
+    columns = [column.name for column in archive_table.columns]
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=settings.ORDER_ARCHIVE_AFTER_HOURS)
+
+    batch = (
+        select(order_table.c.id)
+        .where(order_table.c.status.in_(TERMINAL_STATUSES), order_table.c.timestamp < cutoff)
+        .order_by(order_table.c.timestamp)
+        .limit(settings.ORDER_ARCHIVE_BATCH_SIZE)
+        .with_for_update(skip_locked=True)
+    )
+    moved = (
+        delete(order_table)
+        .where(order_table.c.id.in_(batch))
+        .returning(*(order_table.c[name] for name in columns))
+        .cte("moved")
+    )
+    statement = (
+        insert(archive_table)
+        .from_select(columns, select(*(moved.c[name] for name in columns)))
+        .returning(archive_table.c.id)
+    )
+
+    total = 0
+    while True:
+        async with async_session_factory() as session:
+            result = await session.execute(statement)
+            archived = len(result.all())
+            await session.commit()
+        total += archived
+        if archived < settings.ORDER_ARCHIVE_BATCH_SIZE:
+            return total
+
+async def ensure_transaction_partitions():
+    """
+    Создает месячные секции transaction на текущий и TRANSACTION_PARTITIONS_AHEAD следующих месяцев
+    """
+    month = current_month()
+    async with async_session_factory() as session:
+        for offset in range(settings.TRANSACTION_PARTITIONS_AHEAD + 1):
+            start, end = add_months(month, offset), add_months(month, offset + 1)
+            await session.execute(text(
+                f"CREATE TABLE IF NOT EXISTS transaction_y{start.year}m{start.month:02d} "
+                f"PARTITION OF transaction FOR VALUES FROM ('{start}') TO ('{end}')"
+            ))
+        await session.commit()
+
+async def drop_expired_transaction_partitions() -> int:
+    """
+    Отсоединяет и удаляет секции transaction старше TRANSACTION_RETENTION_MONTHS; 0 - хранить всё
+    """
+    if settings.TRANSACTION_RETENTION_MONTHS <= 0:
+        return 0
+
+    oldest_kept = add_months(current_month(), -settings.TRANSACTION_RETENTION_MONTHS)
+    dropped = 0
+    async with async_session_factory() as session:
+        result = await session.execute(text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE parent.relname = 'transaction'"
+        ))
+        for partition, in result.all():
+            match = PARTITION_NAME.match(partition)
+            if match is None or datetime.date(int(match[1]), int(match[2]), 1) >= oldest_kept:
+                continue
+            await session.execute(text(f"ALTER TABLE transaction DETACH PARTITION {partition}"))
+            await session.execute(text(f"DROP TABLE {partition}"))
+            dropped += 1
+        await session.commit()
+    return dropped
+
+async def run_maintenance():
+    await ensure_transaction_partitions()
+    archived = await archive_terminal_orders()
+    dropped = await drop_expired_transaction_partitions()
+    if archived or dropped:
+        logger.info("В архив перенесено ордеров: %s, удалено секций transaction: %s", archived, dropped)
+
+async def run_archiver():
+    while True:
+        try:
+            await run_maintenance()
+        except Exception:
+            logger.exception("Ошибка обслуживания истории торгов")
+        await asyncio.sleep(settings.ARCHIVE_INTERVAL_SECONDS)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_maintenance())
@@ -0,0 +1,83 @@
+"""
+Снятие GTD-ордеров по сроку (expires_at).
+
+Каждый воркер держит кучу ближайших истечений (src/engine/expiry.py). Ордера, принятые этим воркером,
+попадают в нее сразу, ордера других воркеров - при подгрузке раз в ORDER_EXPIRY_LOAD_SECONDS: читаются
+активные ордера со сроком в ближайшие два интервала (диапазон по частичному индексу ix_order_expiry).
+
+Раз в ORDER_EXPIRY_TICK_SECONDS наступившие сроки снимаются пачками по ORDER_EXPIRY_BATCH_SIZE: ордера пачки
+отменяются одним UPDATE, резервы под их остатки снимаются одним проходом по балансам (cancel_resting_orders).
+Ордер, который уже исполнили или отменили, UPDATE не находит среди активных, поэтому снимать один и тот же
+ордер из нескольких воркеров безопасно. Пачка, которую не удалось снять, вернется при следующей подгрузке.
+"""
+import asyncio
+import datetime
+import logging
+from typing import List
+from uuid import UUID
+from sqlalchemy import select
+from src.config import settings
+from src.dataBase.session import async_session_factory
+from src.dataBase.retry import run_with_retry
+from src.dataBase.models.order import OrderORM
+from src.api.profile.deletion import cancel_resting_orders
+from src.engine.expiry import ExpiryScheduler
+from src.metrics import metrics
+from src.schemas.order import OrderStatus
+
+OPEN_STATUSES = [OrderStatus.NEW, OrderStatus.PART_EXEC]
+
+logger = logging.getLogger(__name__)
+
+expiry = ExpiryScheduler()
+
+async def load_expiring(until: datetime.datetime) -> int:
+    """
+    Планирует активные ордера со сроком не позже until, в том числе уже просроченные
+    """
+    async with async_session_factory() as session:
+        result = await session.execute(
+            select(OrderORM.id, OrderORM.expires_at).where(
+                OrderORM.status.in_(OPEN_STATUSES),
+                OrderORM.expires_at.is_not(None),
+                OrderORM.expires_at <= until
+            )
+        )
+        rows = result.all()
+    for order_id, expires_at in rows:
+        expiry.schedule(order_id, expires_at)
+    return len(rows)
+
+async def expire_orders(order_ids: List[UUID], now: datetime.datetime) -> int:
+    """
+    Отменяет ордера со сроком не позже now и снимает резервы под их остатки, каждая пачка - отдельная транзакция
+    """
+    async def expire_batch(batch: List[UUID]) -> int:
+        async with async_session_factory() as session:
+            expired = await cancel_resting_orders(session, OrderORM.id.in_(batch), OrderORM.expires_at <= now)
+            await session.commit()
+            return expired
+
+    total = 0
+    for start in range(0, len(order_ids), settings.ORDER_EXPIRY_BATCH_SIZE):
+        batch = order_ids[start:start + settings.ORDER_EXPIRY_BATCH_SIZE]
+        total += await run_with_retry(lambda: expire_batch(batch))
+    metrics.increment("orders_expired", total)
+    return total
+
+async def run_order_expiry():
+    next_load = None
+    while True:
+        try:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            if next_load is None or now >= next_load:
+                load_interval = datetime.timedelta(seconds=settings.ORDER_EXPIRY_LOAD_SECONDS)
+                await load_expiring(now + 2 * load_interval)
+                next_load = now + load_interval
+            due = expiry.due(now)
+            if due:
+                await expire_orders(due, now)
+            metrics.set("orders_expiry_scheduled", len(expiry))
+        except Exception:
+            logger.exception("Не удалось снять истекшие ордера")
+        await asyncio.sleep(settings.ORDER_EXPIRY_TICK_SECONDS)
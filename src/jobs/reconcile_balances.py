@@ -0,0 +1,318 @@
+"""
+Сверка балансов с ордерами и сделками.
+
+Все балансы, ордера и сделки выгружаются из Postgres бинарным COPY прямо в массивы NumPy
+(без создания Python-объектов на строку), после чего проверки выполняются векторно:
+    * amount и reserved неотрицательны, reserved не превышает amount;
+    * reserved каждого пользователя равен сумме резервов его активных ордеров
+      (order.reserved: BUY - в RUB, SELL - в самом инструменте);
+    * filled каждого ордера равен объему сделок, где он записан стороной. Сверяются только ордера, все сделки
+      которых еще хранятся: не старше срока хранения секций transaction (TRANSACTION_RETENTION_MONTHS)
+      и по тикерам без сделок без контрагентов (записанных до появления maker/taker в transaction).
+      Сделки, чей ордер удален вместе с пользователем, на эту проверку не влияют;
+    * чистая позиция каждого счета по тем же ордерам (filled покупок - filled продаж) равна позиции
+      по сторонам их сделок (maker_user_id/taker_user_id).
+Счета (пользователь, тикер) нумеруются только среди встречающихся в данных, поэтому память не растет
+как пользователи x тикеры.
+Балансы по сделкам целиком не восстанавливаются: пополнения и выводы не журналируются, а ордера не хранят
+сумму RUB по исполнениям, поэтому поток RUB по сделкам выводится в отчет, но не сверяется.
+
+Запуск из корня репозитория:
+    python -m src.jobs.reconcile_balances
+"""
+import datetime
+import sys
+import time
+from typing import Dict, List, Tuple
+import numpy as np
+from sqlalchemy import text
+from src.config import settings
+from src.dataBase.session import get_sync_engine
+from src.jobs.archive import add_months, current_month
+
+PG_COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+PG_COPY_HEADER_SIZE = len(PG_COPY_SIGNATURE) + 8
+PG_COPY_TRAILER_SIZE = 2
+
+# Big-endian тип NumPy для поддерживаемых типов Postgres
+PG_TYPES = {
+    "int2": ">i2",
+    "int4": ">i4",
+    "int8": ">i8",
+}
+
+TICKERS_QUERY = "SELECT ticker FROM instrument ORDER BY ticker"
+USERS_QUERY = 'SELECT id FROM "user" ORDER BY id'
+
+# Тикеры и пользователи кодируются в БД плотными номерами в том же порядке, что и в запросах выше
+CODES_CTE = """
+    WITH tickers AS (
+        SELECT ticker, (row_number() OVER (ORDER BY ticker) - 1)::int4 AS code FROM instrument
+    ), users AS (
+        SELECT id, (row_number() OVER (ORDER BY id) - 1)::int4 AS code FROM "user"
+    )
+"""
+
+BALANCES_QUERY = CODES_CTE + """
+    SELECT u.code, t.code, b.amount::int8, b.reserved::int8
+    FROM balance b
+    JOIN tickers t ON t.ticker = b.ticker
+    JOIN users u ON u.id = b.user_id
+"""
+BALANCE_FIELDS = [("user", "int4"), ("ticker", "int4"), ("amount", "int8"), ("reserved", "int8")]
+
+# Ордера из order и order_archive тоже нумеруются плотно по id, чтобы сопоставлять их со сторонами сделок
+ORDERS_CTE = CODES_CTE + """
+    , orders AS (
+        SELECT o.*, (row_number() OVER (ORDER BY o.id) - 1)::int4 AS code
+        FROM (
+            SELECT id, user_id, ticker, direction, status, qty, filled, price, reserved, "timestamp" FROM "order"
+            UNION ALL
+            SELECT id, user_id, ticker, direction, status, qty, filled, price, reserved, "timestamp" FROM order_archive
+        ) o
+    )
+"""
+
+ORDERS_QUERY = ORDERS_CTE + """
+    SELECT o.code, u.code, t.code,
+           (o.direction = 'SELL')::int::int2,
+           (o.status IN ('NEW', 'PART_EXEC'))::int::int2,
+           o.qty::int8, coalesce(o.filled, 0)::int8, coalesce(o.price, 0)::int8, o.reserved::int8,
+           (extract(epoch FROM o."timestamp") * 1000000)::int8
+    FROM orders o
+    JOIN tickers t ON t.ticker = o.ticker
+    JOIN users u ON u.id = o.user_id
+"""
+ORDER_FIELDS = [
+    ("code", "int4"), ("user", "int4"), ("ticker", "int4"), ("sell", "int2"), ("live", "int2"),
+    ("qty", "int8"), ("filled", "int8"), ("price", "int8"), ("reserved", "int8"), ("timestamp", "int8"),
+]
+
+# Номер пользователя стороны сделки: UNATTRIBUTED - контрагент не записан, DELETED_USER - пользователь удален.
+# Номер ордера стороны сделки: MISSING_ORDER - ордер не записан или удален вместе с пользователем
+UNATTRIBUTED = -2
+DELETED_USER = -1
+MISSING_ORDER = -1
+
+TRANSACTIONS_QUERY = ORDERS_CTE + """
+    SELECT t.code, tr.amount::int8, tr.price::int8,
+           CASE WHEN tr.buyer_id IS NULL THEN -2 ELSE coalesce(buyer.code, -1) END::int4,
+           CASE WHEN tr.seller_id IS NULL THEN -2 ELSE coalesce(seller.code, -1) END::int4,
+           coalesce(buy_order.code, -1)::int4,
+           coalesce(sell_order.code, -1)::int4
+    FROM (
+        SELECT ticker, amount, price,
+               CASE WHEN taker_direction = 'BUY' THEN taker_user_id ELSE maker_user_id END AS buyer_id,
+               CASE WHEN taker_direction = 'BUY' THEN maker_user_id ELSE taker_user_id END AS seller_id,
+               CASE WHEN taker_direction = 'BUY' THEN taker_order_id ELSE maker_order_id END AS buy_order_id,
+               CASE WHEN taker_direction = 'BUY' THEN maker_order_id ELSE taker_order_id END AS sell_order_id
+        FROM transaction
+    ) tr
+    JOIN tickers t ON t.ticker = tr.ticker
+    LEFT JOIN users buyer ON buyer.id = tr.buyer_id
+    LEFT JOIN users seller ON seller.id = tr.seller_id
+    LEFT JOIN orders buy_order ON buy_order.id = tr.buy_order_id
+    LEFT JOIN orders sell_order ON sell_order.id = tr.sell_order_id
+"""
+TRANSACTION_FIELDS = [
+    ("ticker", "int4"), ("amount", "int8"), ("price", "int8"), ("buyer", "int4"), ("seller", "int4"),
+    ("buy_order", "int4"), ("sell_order", "int4"),
+]
+
+def copy_dtype(fields: List[Tuple[str, str]]) -> np.dtype:
+    # Строка бинарного COPY: int16 число полей, затем для каждого поля int32 длина и значение
+    layout = [("_fields", ">i2")]
+    for name, pg_type in fields:
+        layout += [(f"_{name}_len", ">i4"), (name, PG_TYPES[pg_type])]
+    return np.dtype(layout)
+
+def copy_to_array(cursor, query: str, fields: List[Tuple[str, str]]) -> np.ndarray:
+    """
+    Выгружает результат запроса бинарным COPY и отображает его на структурированный массив без копирования.
+    Все колонки запроса должны быть NOT NULL и фиксированной длины
+    """
+    buffer = bytearray()
+    with cursor.copy(f"COPY ({query}) TO STDOUT (FORMAT BINARY)") as copy:
+        for chunk in copy:
+            buffer += chunk
+
+    if not buffer.startswith(PG_COPY_SIGNATURE):
+        raise ValueError("Неожиданный формат бинарного COPY")
+    extension_size = int.from_bytes(buffer[PG_COPY_HEADER_SIZE - 4:PG_COPY_HEADER_SIZE], "big")
+    body = memoryview(buffer)[PG_COPY_HEADER_SIZE + extension_size:len(buffer) - PG_COPY_TRAILER_SIZE]
+    return np.frombuffer(body, dtype=copy_dtype(fields))
+
+def group_sum(keys: np.ndarray, values: np.ndarray, size: int) -> np.ndarray:
+    result = np.zeros(size, dtype=np.int64)
+    np.add.at(result, keys, values)
+    return result
+
+def retained_since() -> int:
+    """
+    Начало срока хранения секций transaction в микросекундах эпохи; более старые сделки могли быть удалены
+    """
+    if settings.TRANSACTION_RETENTION_MONTHS <= 0:
+        return np.iinfo(np.int64).min
+    oldest_kept = add_months(current_month(), -settings.TRANSACTION_RETENTION_MONTHS)
+    since = datetime.datetime.combine(oldest_kept, datetime.time(), datetime.timezone.utc)
+    return int(since.timestamp()) * 1_000_000
+
+def load(connection) -> Dict[str, np.ndarray]:
+    with connection.cursor() as cursor:
+        cursor.execute(TICKERS_QUERY)
+        tickers = [ticker for ticker, in cursor.fetchall()]
+        cursor.execute(USERS_QUERY)
+        users = [user_id for user_id, in cursor.fetchall()]
+        return {
+            "tickers": np.array(tickers, dtype=object),
+            "users": np.array(users, dtype=object),
+            "balances": copy_to_array(cursor, BALANCES_QUERY, BALANCE_FIELDS),
+            "orders": copy_to_array(cursor, ORDERS_QUERY, ORDER_FIELDS),
+            "transactions": copy_to_array(cursor, TRANSACTIONS_QUERY, TRANSACTION_FIELDS),
+            "retained_since": retained_since(),
+        }
+
+def reconcile(data: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """
+    Возвращает расхождения по каждой проверке: индексы строк или ключей, не прошедших проверку
+    """
+    tickers, balances, orders, transactions = data["tickers"], data["balances"], data["orders"], data["transactions"]
+    ticker_count = len(tickers)
+
+    amount = balances["amount"].astype(np.int64)
+    reserved = balances["reserved"].astype(np.int64)
+
+    order_users = orders["user"].astype(np.int64)
+    order_tickers = orders["ticker"].astype(np.int64)
+    order_reserved = orders["reserved"].astype(np.int64)
+    filled = orders["filled"].astype(np.int64)
+    live = orders["live"] == 1
+    sell = orders["sell"] == 1
+
+    trade_tickers = transactions["ticker"].astype(np.int64)
+    trade_amount = transactions["amount"].astype(np.int64)
+    unattributed = (transactions["buyer"] == UNATTRIBUTED) | (transactions["seller"] == UNATTRIBUTED)
+    checked_tickers = group_sum(trade_tickers[unattributed], np.ones(unattributed.sum(), dtype=np.int64), ticker_count) == 0
+
+    # Исполнение сверяется только по ордерам, все сделки которых еще хранятся: сделки моложе ордера,
+    # поэтому ордер не старше срока хранения transaction не мог потерять сделки при удалении секций
+    kept = checked_tickers[order_tickers] & (orders["timestamp"] >= data["retained_since"])
+    order_count = int(orders["code"].max()) + 1 if len(orders) else 0
+    kept_codes = np.zeros(order_count, dtype=bool)
+    kept_codes[orders["code"][kept]] = True
+
+    # Ключ счета - (пользователь, тикер); ниже он сжимается до номера среди счетов, которые есть в данных
+    balance_keys = balances["user"].astype(np.int64) * ticker_count + balances["ticker"]
+
+    rub = np.flatnonzero(tickers == "RUB")
+    reserving = live & (sell | bool(len(rub)))
+    reserve_tickers = np.where(sell, order_tickers, rub[0] if len(rub) else 0)[reserving]
+    reserve_keys = order_users[reserving] * ticker_count + reserve_tickers
+
+    position_keys = order_users[kept] * ticker_count + order_tickers[kept]
+    position_values = np.where(sell, -filled, filled)[kept]
+
+    # Стороны сделок: объем по ордеру стороны и по счету пользователя стороны
+    traded = np.zeros(order_count, dtype=np.int64)
+    trade_keys, trade_values = [], []
+    trade_rub = np.zeros(len(data["users"]), dtype=np.int64)
+    trade_value = trade_amount * transactions["price"]
+    for side, sign in (("buy", 1), ("sell", -1)):
+        users = transactions[side + "er"].astype(np.int64)
+        codes = transactions[side + "_order"].astype(np.int64)
+        known = users >= 0
+        trade_rub -= sign * group_sum(users[known], trade_value[known], len(trade_rub))
+        recorded = codes != MISSING_ORDER
+        np.add.at(traded, codes[recorded], trade_amount[recorded])
+        counted = recorded & known
+        counted[counted] = kept_codes[codes[counted]]
+        trade_keys.append(users[counted] * ticker_count + trade_tickers[counted])
+        trade_values.append(sign * trade_amount[counted])
+    trade_keys, trade_values = np.concatenate(trade_keys), np.concatenate(trade_values)
+
+    accounts, account_codes = np.unique(
+        np.concatenate([balance_keys, reserve_keys, position_keys, trade_keys]), return_inverse=True,
+    )
+    balance_codes, reserve_codes, position_codes, trade_codes = np.split(
+        account_codes, np.cumsum([len(balance_keys), len(reserve_keys), len(position_keys)]),
+    )
+    account_count = len(accounts)
+
+    expected_reserved = group_sum(reserve_codes, order_reserved[reserving], account_count)
+    actual_reserved = np.zeros(account_count, dtype=np.int64)
+    actual_reserved[balance_codes] = reserved
+
+    order_position = group_sum(position_codes, position_values, account_count)
+    trade_position = group_sum(trade_codes, trade_values, account_count)
+
+    return {
+        "negative_balance": np.flatnonzero((amount < 0) | (reserved < 0)),
+        "reserved_over_amount": np.flatnonzero(reserved > amount),
+        "reserved_mismatch": np.flatnonzero(expected_reserved != actual_reserved),
+        "accounts": accounts,
+        "expected_reserved": expected_reserved,
+        "actual_reserved": actual_reserved,
+        "fill_mismatch": np.flatnonzero(kept & (filled != traded[orders["code"]])),
+        "traded": traded,
+        "unchecked_orders": np.flatnonzero(~kept),
+        "position_mismatch": np.flatnonzero(order_position != trade_position),
+        "order_position": order_position,
+        "trade_position": trade_position,
+        "trade_rub": trade_rub,
+        "unchecked_tickers": np.flatnonzero(~checked_tickers),
+    }
+
+def report(data: Dict[str, np.ndarray], result: Dict[str, np.ndarray], examples: int = 10) -> bool:
+    tickers, balances, orders, users = data["tickers"], data["balances"], data["orders"], data["users"]
+    ticker_count = len(tickers)
+
+    def account(index: int) -> str:
+        key = result["accounts"][index]
+        return f"{users[key // ticker_count]} {tickers[key % ticker_count]}"
+
+    print(f"балансов: {len(balances)}, ордеров: {len(orders)}, сделок: {len(data['transactions'])}")
+
+    for index in result["negative_balance"][:examples]:
+        row = balances[index]
+        print(f"отрицательный баланс: {users[row['user']]} {tickers[row['ticker']]} amount={row['amount']} reserved={row['reserved']}")
+    for index in result["reserved_over_amount"][:examples]:
+        row = balances[index]
+        print(f"резерв больше баланса: {users[row['user']]} {tickers[row['ticker']]} amount={row['amount']} reserved={row['reserved']}")
+    for index in result["reserved_mismatch"][:examples]:
+        print(f"резерв не совпадает с ордерами: {account(index)} ожидается={result['expected_reserved'][index]} в балансе={result['actual_reserved'][index]}")
+    for index in result["fill_mismatch"][:examples]:
+        row = orders[index]
+        direction = "SELL" if row["sell"] else "BUY"
+        print(f"исполнение не сходится со сделками: {users[row['user']]} {tickers[row['ticker']]} {direction} "
+              f"qty={row['qty']} filled={row['filled']} в сделках={result['traded'][row['code']]}")
+
+    for index in result["position_mismatch"][:examples]:
+        print(f"позиция не сходится со сделками: {account(index)} по ордерам={result['order_position'][index]} по сделкам={result['trade_position'][index]}")
+    if len(result["unchecked_tickers"]):
+        print(f"исполнение не сверялось (сделки без контрагентов): {', '.join(tickers[result['unchecked_tickers']])}")
+    if len(result["unchecked_orders"]):
+        print(f"ордеров без сверки исполнения: {len(result['unchecked_orders'])}")
+    rub_flows = np.flatnonzero(result["trade_rub"])
+    print(f"пользователей с потоком RUB по сделкам: {len(rub_flows)}, сумма потоков: {result['trade_rub'].sum()}")
+
+    problems = {name: len(result[name]) for name in ("negative_balance", "reserved_over_amount", "reserved_mismatch", "fill_mismatch", "position_mismatch")}
+    print(", ".join(f"{name}: {count}" for name, count in problems.items()))
+    return not any(problems.values())
+
+def main() -> int:
+    started = time.perf_counter()
+    with get_sync_engine().connect() as connection:
+        # Все выгрузки читают один снимок БД
+        connection.execute(text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY"))
+        data = load(connection.connection.driver_connection)
+    loaded = time.perf_counter()
+
+    result = reconcile(data)
+    checked = time.perf_counter()
+
+    ok = report(data, result)
+    print(f"выгрузка {loaded - started:.2f} с, проверка {checked - loaded:.2f} с")
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
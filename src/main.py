@@ -1,8 +1,45 @@
+import asyncio
 
-import uvicorn
-
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from src.router import main_router
+from src.dataBase.session import get_async_engine, dispose_engines
+from src.dataBase.redis_pool import close_redis
+from src.api.profile.ledger import run_ledger_reconciliation
+from src.jobs.archive import run_archiver
+from src.jobs.expiry import run_order_expiry
+from src.api.service.ratelimit import RateLimitMiddleware
+from src.api.service.warmup import run_warmup
+from src.engine.sharding import shards
+from src.config import settings
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Движок БД создается здесь, а не при импорте модулей
+    get_async_engine()
+    if settings.MATCHING_SHARDS:
+        shards.start(settings.MATCHING_SHARDS)
+    ledger_task = asyncio.create_task(run_ledger_reconciliation())
+    archive_task = asyncio.create_task(run_archiver())
+    # Прогрев идет в фоне: воркер отвечает на /public/ready кодом 503, пока он не закончится
+    warmup_task = asyncio.create_task(run_warmup())
+    expiry_task = asyncio.create_task(run_order_expiry())
+    yield
+    ledger_task.cancel()
+    archive_task.cancel()
+    warmup_task.cancel()
+    expiry_task.cancel()
+    shards.stop()
+    await dispose_engines()
+    await close_redis()
+
+def create_app() -> FastAPI:
+    """
+    Фабрика приложения: uvicorn src.main:app или uvicorn --factory src.main:create_app
+    """
+    app = FastAPI(title='stockMarket App', lifespan=lifespan)
+    app.include_router(main_router)
+    app.add_middleware(RateLimitMiddleware)
+    return app
 
-app = FastAPI(title='stockMarket App')
-app.include_router(main_router)
\ No newline at end of file
+app = create_app()
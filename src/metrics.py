@@ -0,0 +1,23 @@
+from collections import defaultdict
+from typing import Dict
+
+class Metrics:
+    """
+    Счетчики процесса: число событий по имени и текущие значения (gauge). Читаются через /api/v1/admin/metrics
+    """
+    def __init__(self):
+        self._counters: Dict[str, int] = defaultdict(int)
+
+    def increment(self, name: str, value: int = 1):
+        self._counters[name] += value
+
+    def set(self, name: str, value: int):
+        self._counters[name] = value
+
+    def get(self, name: str) -> int:
+        return self._counters.get(name, 0)
+
+    def snapshot(self) -> Dict[str, int]:
+        return dict(sorted(self._counters.items()))
+
+metrics = Metrics()
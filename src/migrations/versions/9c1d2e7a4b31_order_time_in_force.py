@@ -0,0 +1,32 @@
+"""order time in force
+
+Revision ID: 9c1d2e7a4b31
+Revises: 4f6ee16547a0
+Create Date: 2026-10-19 10:12:41.530118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = '9c1d2e7a4b31'
+down_revision: Union[str, None] = '4f6ee16547a0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+timeinforce = postgresql.ENUM('GTC', 'IOC', 'FOK', 'POST_ONLY', name='timeinforce')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    timeinforce.create(op.get_bind(), checkfirst=True)
+    op.add_column('order', sa.Column('time_in_force', timeinforce, nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('order', 'time_in_force')
+    timeinforce.drop(op.get_bind(), checkfirst=True)
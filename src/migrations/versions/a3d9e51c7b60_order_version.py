@@ -0,0 +1,32 @@
+"""order version
+
+Revision ID: a3d9e51c7b60
+Revises: f18b0d6c3e92
+Create Date: 2026-10-19 15:02:41.318094
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3d9e51c7b60'
+down_revision: Union[str, None] = 'f18b0d6c3e92'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('order', sa.Column('version', sa.Integer(), server_default=sa.text('0'), nullable=False))
+    op.add_column('order_archive', sa.Column('version', sa.Integer(), server_default=sa.text('0'), nullable=False))
+    # В архив версия всегда переносится из order, значение по умолчанию нужно только для существующих строк
+    op.alter_column('order_archive', 'version', server_default=None)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('order_archive', 'version')
+    op.drop_column('order', 'version')
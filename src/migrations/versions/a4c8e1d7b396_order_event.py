@@ -0,0 +1,50 @@
+"""order event
+
+Revision ID: a4c8e1d7b396
+Revises: f3b9d6e2a815
+Create Date: 2026-10-19 20:41:08.513276
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a4c8e1d7b396'
+down_revision: Union[str, None] = 'f3b9d6e2a815'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('order_event',
+    sa.Column('id', sa.BigInteger(), sa.Identity(), nullable=False),
+    sa.Column('xid', sa.BigInteger(), server_default=sa.text('pg_current_xact_id()::text::bigint'), nullable=False),
+    sa.Column('order_id', sa.Uuid(), nullable=False),
+    sa.Column('user_id', sa.Uuid(), nullable=False),
+    sa.Column('ticker', sa.String(), nullable=False),
+    sa.Column('kind', sa.Enum('ACCEPTED', 'TRIGGERED', 'FILLED', 'CANCELLED', 'EXPIRED', name='ordereventkind'), nullable=False),
+    sa.Column('qty', sa.Integer(), nullable=False),
+    sa.Column('filled', sa.Integer(), nullable=False),
+    sa.Column('status', postgresql.ENUM(name='orderstatus', create_type=False), nullable=False),
+    sa.Column('timestamp', sa.TIMESTAMP(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['ticker'], ['instrument.ticker'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_order_event_user_xid_id', 'order_event', ['user_id', 'xid', 'id'], unique=False)
+    op.create_index('ix_order_event_order_id', 'order_event', ['order_id'], unique=False)
+    op.create_index('ix_order_event_ticker', 'order_event', ['ticker'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_order_event_ticker', table_name='order_event')
+    op.drop_index('ix_order_event_order_id', table_name='order_event')
+    op.drop_index('ix_order_event_user_xid_id', table_name='order_event')
+    op.drop_table('order_event')
+    sa.Enum(name='ordereventkind').drop(op.get_bind(), checkfirst=True)
@@ -0,0 +1,28 @@
+"""order user keyset index
+
+Revision ID: b5e8f03c9a27
+Revises: 9c1d2e7a4b31
+Create Date: 2026-10-19 11:03:18.204577
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b5e8f03c9a27'
+down_revision: Union[str, None] = '9c1d2e7a4b31'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_order_user_timestamp_id', 'order', ['user_id', 'timestamp', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_order_user_timestamp_id', table_name='order')
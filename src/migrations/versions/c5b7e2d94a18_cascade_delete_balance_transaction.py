@@ -0,0 +1,40 @@
+"""cascade delete balance, transaction
+
+Revision ID: c5b7e2d94a18
+Revises: a3d9e51c7b60
+Create Date: 2026-10-19 15:41:07.502318
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c5b7e2d94a18'
+down_revision: Union[str, None] = 'a3d9e51c7b60'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (имя ограничения, таблица, колонка, таблица-родитель, колонка родителя)
+FOREIGN_KEYS = [
+    ('balance_user_id_fkey', 'balance', 'user_id', 'user', 'id'),
+    ('balance_ticker_fkey', 'balance', 'ticker', 'instrument', 'ticker'),
+    # Внешний ключ секционированной таблицы пересоздается и на всех секциях
+    ('transaction_ticker_fkey', 'transaction', 'ticker', 'instrument', 'ticker'),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    for name, table, column, referent, referent_column in FOREIGN_KEYS:
+        op.drop_constraint(name, table, type_='foreignkey')
+        op.create_foreign_key(name, table, referent, [column], [referent_column], ondelete='CASCADE')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for name, table, column, referent, referent_column in FOREIGN_KEYS:
+        op.drop_constraint(name, table, type_='foreignkey')
+        op.create_foreign_key(name, table, referent, [column], [referent_column])
@@ -0,0 +1,44 @@
+"""balance bigint
+
+Revision ID: d41a6b9e2f58
+Revises: b5e8f03c9a27
+Create Date: 2026-10-19 12:41:07.918352
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd41a6b9e2f58'
+down_revision: Union[str, None] = 'b5e8f03c9a27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.alter_column('balance', 'amount',
+               existing_type=sa.Float(),
+               type_=sa.BigInteger(),
+               existing_nullable=False,
+               postgresql_using='round(amount)::bigint')
+    op.alter_column('balance', 'reserved',
+               existing_type=sa.Float(),
+               type_=sa.BigInteger(),
+               existing_nullable=False,
+               postgresql_using='round(reserved)::bigint')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.alter_column('balance', 'reserved',
+               existing_type=sa.BigInteger(),
+               type_=sa.Float(),
+               existing_nullable=False)
+    op.alter_column('balance', 'amount',
+               existing_type=sa.BigInteger(),
+               type_=sa.Float(),
+               existing_nullable=False)
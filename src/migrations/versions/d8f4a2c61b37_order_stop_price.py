@@ -0,0 +1,42 @@
+"""order stop price
+
+Revision ID: d8f4a2c61b37
+Revises: c5b7e2d94a18
+Create Date: 2026-10-19 17:20:44.918305
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd8f4a2c61b37'
+down_revision: Union[str, None] = 'c5b7e2d94a18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Новое значение enum нельзя использовать в транзакции, которая его добавила (частичный индекс ниже)
+    with op.get_context().autocommit_block():
+        op.execute("ALTER TYPE ordertype ADD VALUE IF NOT EXISTS 'STOP'")
+        op.execute("ALTER TYPE ordertype ADD VALUE IF NOT EXISTS 'STOP_LIMIT'")
+    op.add_column('order', sa.Column('stop_price', sa.Integer(), nullable=True))
+    op.add_column('order_archive', sa.Column('stop_price', sa.Integer(), nullable=True))
+    op.create_check_constraint('check_stop_price_positive', 'order', 'stop_price > 0')
+    op.create_index(
+        'ix_order_stop_trigger', 'order', ['ticker', 'direction', 'stop_price'], unique=False,
+        postgresql_where=sa.text("status = 'NEW' AND type IN ('STOP', 'STOP_LIMIT')")
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_order_stop_trigger', table_name='order', postgresql_where=sa.text("status = 'NEW' AND type IN ('STOP', 'STOP_LIMIT')"))
+    op.drop_constraint('check_stop_price_positive', 'order', type_='check')
+    op.drop_column('order_archive', 'stop_price')
+    op.drop_column('order', 'stop_price')
+    # Значения STOP и STOP_LIMIT остаются в типе ordertype: Postgres не удаляет значения enum
@@ -0,0 +1,38 @@
+"""order expires at
+
+Revision ID: e1a7c3f95d02
+Revises: d8f4a2c61b37
+Create Date: 2026-10-19 18:05:12.604127
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e1a7c3f95d02'
+down_revision: Union[str, None] = 'd8f4a2c61b37'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        op.execute("ALTER TYPE timeinforce ADD VALUE IF NOT EXISTS 'GTD'")
+    op.add_column('order', sa.Column('expires_at', sa.TIMESTAMP(timezone=True), nullable=True))
+    op.add_column('order_archive', sa.Column('expires_at', sa.TIMESTAMP(timezone=True), nullable=True))
+    op.create_index(
+        'ix_order_expiry', 'order', ['expires_at'], unique=False,
+        postgresql_where=sa.text("status IN ('NEW', 'PART_EXEC') AND expires_at IS NOT NULL")
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_order_expiry', table_name='order', postgresql_where=sa.text("status IN ('NEW', 'PART_EXEC') AND expires_at IS NOT NULL"))
+    op.drop_column('order_archive', 'expires_at')
+    op.drop_column('order', 'expires_at')
+    # Значение GTD остается в типе timeinforce: Postgres не удаляет значения enum
@@ -0,0 +1,44 @@
+"""transaction counterparties
+
+Revision ID: e7c3a1f95d04
+Revises: d41a6b9e2f58
+Create Date: 2026-10-19 13:27:55.604913
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7c3a1f95d04'
+down_revision: Union[str, None] = 'd41a6b9e2f58'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('transaction', sa.Column('maker_order_id', sa.Uuid(), nullable=True))
+    op.add_column('transaction', sa.Column('taker_order_id', sa.Uuid(), nullable=True))
+    op.add_column('transaction', sa.Column('maker_user_id', sa.Uuid(), nullable=True))
+    op.add_column('transaction', sa.Column('taker_user_id', sa.Uuid(), nullable=True))
+    op.add_column('transaction', sa.Column('taker_direction', postgresql.ENUM('BUY', 'SELL', name='operationdirection', create_type=False), nullable=True))
+    op.create_index('ix_transaction_maker_user_timestamp_id', 'transaction', ['maker_user_id', 'timestamp', 'id'], unique=False)
+    op.create_index('ix_transaction_taker_user_timestamp_id', 'transaction', ['taker_user_id', 'timestamp', 'id'], unique=False)
+    op.create_index('ix_transaction_maker_order_id', 'transaction', ['maker_order_id'], unique=False)
+    op.create_index('ix_transaction_taker_order_id', 'transaction', ['taker_order_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_transaction_taker_order_id', table_name='transaction')
+    op.drop_index('ix_transaction_maker_order_id', table_name='transaction')
+    op.drop_index('ix_transaction_taker_user_timestamp_id', table_name='transaction')
+    op.drop_index('ix_transaction_maker_user_timestamp_id', table_name='transaction')
+    op.drop_column('transaction', 'taker_direction')
+    op.drop_column('transaction', 'taker_user_id')
+    op.drop_column('transaction', 'maker_user_id')
+    op.drop_column('transaction', 'taker_order_id')
+    op.drop_column('transaction', 'maker_order_id')
@@ -0,0 +1,124 @@
+"""partition transaction, archive order
+
+Revision ID: f18b0d6c3e92
+Revises: e7c3a1f95d04
+Create Date: 2026-10-19 14:52:10.377264
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = 'f18b0d6c3e92'
+down_revision: Union[str, None] = 'e7c3a1f95d04'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+TRANSACTION_COLUMNS = 'id, ticker, amount, price, "timestamp", maker_order_id, taker_order_id, maker_user_id, taker_user_id, taker_direction'
+
+TRANSACTION_INDEXES = [
+    ('ix_transaction_maker_user_timestamp_id', ['maker_user_id', 'timestamp', 'id']),
+    ('ix_transaction_taker_user_timestamp_id', ['taker_user_id', 'timestamp', 'id']),
+    ('ix_transaction_maker_order_id', ['maker_order_id']),
+    ('ix_transaction_taker_order_id', ['taker_order_id']),
+]
+
+
+def transaction_columns() -> list:
+    return [
+        sa.Column('id', sa.Uuid(), nullable=False),
+        sa.Column('ticker', sa.String(), nullable=False),
+        sa.Column('amount', sa.Integer(), nullable=False),
+        sa.Column('price', sa.Integer(), nullable=False),
+        sa.Column('timestamp', sa.TIMESTAMP(timezone=True), nullable=False),
+        sa.Column('maker_order_id', sa.Uuid(), nullable=True),
+        sa.Column('taker_order_id', sa.Uuid(), nullable=True),
+        sa.Column('maker_user_id', sa.Uuid(), nullable=True),
+        sa.Column('taker_user_id', sa.Uuid(), nullable=True),
+        sa.Column('taker_direction', postgresql.ENUM('BUY', 'SELL', name='operationdirection', create_type=False), nullable=True),
+        sa.ForeignKeyConstraint(['ticker'], ['instrument.ticker'], name='transaction_ticker_fkey'),
+    ]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # transaction -> секционированная по месяцам таблица
+    for name, _ in TRANSACTION_INDEXES:
+        op.drop_index(name, table_name='transaction')
+    op.rename_table('transaction', 'transaction_legacy')
+    op.execute('ALTER INDEX transaction_pkey RENAME TO transaction_legacy_pkey')
+
+    op.create_table('transaction',
+    *transaction_columns(),
+    sa.PrimaryKeyConstraint('id', 'timestamp', name='transaction_pkey'),
+    postgresql_partition_by='RANGE (timestamp)'
+    )
+    op.execute('CREATE TABLE transaction_default PARTITION OF transaction DEFAULT')
+    # Месячные секции от первой сделки до двух месяцев вперед, чтобы секция по умолчанию оставалась пустой
+    op.execute("""
+        DO $$
+        DECLARE
+            month_start date := date_trunc('month', coalesce((SELECT min("timestamp") FROM transaction_legacy), now()));
+        BEGIN
+            WHILE month_start < date_trunc('month', now()) + interval '3 months' LOOP
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF transaction FOR VALUES FROM (%L) TO (%L)',
+                    'transaction_' || to_char(month_start, '"y"YYYY"m"MM'),
+                    month_start,
+                    month_start + interval '1 month'
+                );
+                month_start := month_start + interval '1 month';
+            END LOOP;
+        END $$
+    """)
+    op.execute(f'INSERT INTO transaction ({TRANSACTION_COLUMNS}) SELECT {TRANSACTION_COLUMNS} FROM transaction_legacy')
+    op.drop_table('transaction_legacy')
+
+    for name, columns in TRANSACTION_INDEXES:
+        op.create_index(name, 'transaction', columns, unique=False)
+    op.create_index('ix_transaction_ticker_timestamp', 'transaction', ['ticker', 'timestamp'], unique=False)
+
+    # Архив завершенных ордеров и частичный индекс стакана по активным ордерам
+    op.create_table('order_archive',
+    sa.Column('id', sa.Uuid(), nullable=False),
+    sa.Column('type', postgresql.ENUM(name='ordertype', create_type=False), nullable=False),
+    sa.Column('status', postgresql.ENUM(name='orderstatus', create_type=False), nullable=False),
+    sa.Column('user_id', sa.Uuid(), nullable=False),
+    sa.Column('timestamp', sa.TIMESTAMP(timezone=True), nullable=False),
+    sa.Column('direction', postgresql.ENUM(name='operationdirection', create_type=False), nullable=False),
+    sa.Column('ticker', sa.String(), nullable=False),
+    sa.Column('qty', sa.Integer(), nullable=False),
+    sa.Column('price', sa.Integer(), nullable=True),
+    sa.Column('filled', sa.Integer(), nullable=True),
+    sa.Column('time_in_force', postgresql.ENUM(name='timeinforce', create_type=False), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_order_archive_user_timestamp_id', 'order_archive', ['user_id', 'timestamp', 'id'], unique=False)
+    op.create_index('ix_order_book', 'order', ['ticker', 'direction', 'price', 'timestamp'], unique=False,
+                    postgresql_where=sa.text("status IN ('NEW', 'PART_EXEC') AND type = 'LIMIT'"))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_order_book', table_name='order')
+    op.execute('INSERT INTO "order" SELECT * FROM order_archive')
+    op.drop_index('ix_order_archive_user_timestamp_id', table_name='order_archive')
+    op.drop_table('order_archive')
+
+    op.rename_table('transaction', 'transaction_partitioned')
+    op.execute('ALTER INDEX transaction_pkey RENAME TO transaction_partitioned_pkey')
+    for name, _ in TRANSACTION_INDEXES:
+        op.drop_index(name, table_name='transaction_partitioned')
+    op.drop_index('ix_transaction_ticker_timestamp', table_name='transaction_partitioned')
+
+    op.create_table('transaction',
+    *transaction_columns(),
+    sa.PrimaryKeyConstraint('id', name='transaction_pkey')
+    )
+    op.execute(f'INSERT INTO transaction ({TRANSACTION_COLUMNS}) SELECT {TRANSACTION_COLUMNS} FROM transaction_partitioned')
+    op.drop_table('transaction_partitioned')
+    for name, columns in TRANSACTION_INDEXES:
+        op.create_index(name, 'transaction', columns, unique=False)
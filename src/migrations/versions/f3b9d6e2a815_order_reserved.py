@@ -0,0 +1,47 @@
+"""order reserved
+
+Revision ID: f3b9d6e2a815
+Revises: e1a7c3f95d02
+Create Date: 2026-10-19 19:32:27.113904
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3b9d6e2a815'
+down_revision: Union[str, None] = 'e1a7c3f95d02'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('order', sa.Column('reserved', sa.BigInteger(), server_default=sa.text('0'), nullable=False))
+    op.add_column('order_archive', sa.Column('reserved', sa.BigInteger(), server_default=sa.text('0'), nullable=False))
+    # Резерв активных ордеров - их остаток по цене ордера, как его снимала отмена
+    op.execute("""
+        UPDATE "order"
+        SET reserved = CASE WHEN direction = 'BUY' THEN (qty - COALESCE(filled, 0)) * price ELSE qty - COALESCE(filled, 0) END
+        WHERE type IN ('LIMIT', 'STOP_LIMIT') AND status IN ('NEW', 'PART_EXEC')
+    """)
+    # Резерв баланса приводится к сумме резервов ордеров: прежний матчинг обнулял его целиком или оставлял лишнее
+    op.execute("""
+        UPDATE balance
+        SET reserved = COALESCE((
+            SELECT SUM(o.reserved)
+            FROM "order" AS o
+            WHERE o.user_id = balance.user_id
+              AND o.reserved > 0
+              AND CASE WHEN o.direction = 'BUY' THEN 'RUB' ELSE o.ticker END = balance.ticker
+        ), 0)
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('order_archive', 'reserved')
+    op.drop_column('order', 'reserved')
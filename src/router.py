@@ -3,10 +3,18 @@ from src.api.profile.user import auth_router
 from src.api.profile.instrument import instrument_router
 from src.api.profile.balance import balance_router
 from src.api.stockMarket.order import order_router
+from src.api.stockMarket.fill import fill_router
+from src.api.stockMarket.marketdata import marketdata_router
+from src.api.service.metrics import metrics_router
+from src.api.service.warmup import readiness_router
 
 main_router = APIRouter()
 
 main_router.include_router(auth_router)
 main_router.include_router(instrument_router)
 main_router.include_router(balance_router)
-main_router.include_router(order_router)
\ No newline at end of file
+main_router.include_router(order_router)
+main_router.include_router(fill_router)
+main_router.include_router(marketdata_router)
+main_router.include_router(metrics_router)
+main_router.include_router(readiness_router)
\ No newline at end of file
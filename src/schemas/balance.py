@@ -1,9 +1,23 @@
 from pydantic import BaseModel, UUID4, Field
-from typing import Annotated
+from typing import Annotated, List
 
 AmountInt = Annotated[int, Field(gt=0)]
 
 class BalanceTransaction(BaseModel):
     user_id: UUID4
     ticker: str = Field(pattern=r"[A-Z]{2,10}")
-    amount: AmountInt
\ No newline at end of file
+    amount: AmountInt
+
+class BalanceView(BaseModel):
+    amount: int
+    reserved: int
+    available: int
+
+class BatchRowError(BaseModel):
+    # Номер строки во входных данных, начиная с 1 (для CSV - без заголовка)
+    row: int
+    error: str
+
+class BalanceBatchResult(BaseModel):
+    applied: int
+    errors: List[BatchRowError]
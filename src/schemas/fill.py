@@ -0,0 +1,18 @@
+from enum import Enum
+from datetime import datetime
+from pydantic import BaseModel, UUID4
+from src.schemas.order import OperationDirection
+
+class LiquidityRole(str, Enum):
+    MAKER = "MAKER"
+    TAKER = "TAKER"
+
+class Fill(BaseModel):
+    trade_id: UUID4
+    order_id: UUID4
+    ticker: str
+    direction: OperationDirection
+    role: LiquidityRole
+    qty: int
+    price: int
+    timestamp: datetime
@@ -1,5 +1,4 @@
 from pydantic import BaseModel, Field
-from src.schemas.balance import BalanceTransaction
 from datetime import datetime
 from typing import Annotated
 
@@ -10,5 +9,8 @@ class Instrument(BaseModel):
     name: str
     ticker: TickerStr
 
-class Transaction(BalanceTransaction):
+class Transaction(BaseModel):
+    ticker: TickerStr
+    amount: LimitInt
+    price: LimitInt
     timestamp: datetime
\ No newline at end of file
@@ -1,7 +1,9 @@
 from enum import Enum
 from datetime import datetime
 from pydantic import BaseModel, Field, UUID4
-from typing import List
+from typing import List, Annotated, Optional
+
+PageLimitInt = Annotated[int, Field(gt=0, le=1000)]
 
 class OperationDirection(str, Enum):
     BUY = "BUY"
@@ -13,12 +15,35 @@ class OrderStatus(str, Enum):
     PART_EXEC = "PARTIALLY_EXECUTED"
     CANCELLED = "CANCELLED"
 
+class TimeInForce(str, Enum):
+    GTC = "GTC"
+    IOC = "IOC"
+    FOK = "FOK"
+    POST_ONLY = "POST_ONLY"
+    # Действует до expires_at, затем снимается с остатком
+    GTD = "GTD"
+
+class SelfTradePrevention(str, Enum):
+    """
+    Что делать, когда встречные ордера принадлежат одному пользователю
+    """
+    NONE = "NONE"
+    CANCEL_NEWEST = "CANCEL_NEWEST"
+    CANCEL_OLDEST = "CANCEL_OLDEST"
+    DECREMENT_BOTH = "DECREMENT_BOTH"
+
 class OrderType(str, Enum):
     MARKET = "MARKET"
     LIMIT = "LIMIT"
+    # Стоп-ордера ждут, пока цена сделки дойдет до stop_price, и тогда становятся рыночным (STOP) или лимитным (STOP_LIMIT)
+    STOP = "STOP"
+    STOP_LIMIT = "STOP_LIMIT"
     @classmethod
     def from_order(cls, order: 'OrderBody') -> 'OrderType':
-        return cls.LIMIT if hasattr(order, 'price') and order.price is not None else cls.MARKET
+        limit = hasattr(order, 'price') and order.price is not None
+        if getattr(order, 'stop_price', None) is not None:
+            return cls.STOP_LIMIT if limit else cls.STOP
+        return cls.LIMIT if limit else cls.MARKET
 
 class OrderBody(BaseModel):
     direction : OperationDirection
@@ -33,6 +58,18 @@ class MarketOrderBody(OrderBody):
 
 class LimitOrderBody(OrderBody):
     price : int = Field(gt=0)
+    time_in_force: TimeInForce = Field(default=TimeInForce.GTC)
+    expires_at: Optional[datetime] = None
+
+class StopOrderBody(OrderBody):
+    """
+    Покупка срабатывает, когда цена сделки поднимется до stop_price, продажа - когда опустится до него
+    """
+    stop_price: int = Field(gt=0)
+
+class StopLimitOrderBody(OrderBody):
+    price: int = Field(gt=0)
+    stop_price: int = Field(gt=0)
 
 class Order(BaseModel):
     id: UUID4
@@ -47,6 +84,13 @@ class LimitOrder(Order):
     body: LimitOrderBody
     filled: int = Field(default=0)
 
+class StopOrder(Order):
+    body: StopOrderBody
+
+class StopLimitOrder(Order):
+    body: StopLimitOrderBody
+    filled: int = Field(default=0)
+
 class CreateOrderResponse(BaseModel):
     success: bool = Field(default=True)
     order_id: UUID4
@@ -57,4 +101,13 @@ class Level(BaseModel):
 
 class L2OrderBook(BaseModel):
     bid_levels : List[Level]
-    ask_levels : List[Level]
\ No newline at end of file
+    ask_levels : List[Level]
+
+class TickerMarketData(BaseModel):
+    ticker: str
+    best_bid: Optional[int] = None
+    best_ask: Optional[int] = None
+    last_price: Optional[int] = None
+    volume_24h: int = Field(default=0)
+    bid_levels: List[Level]
+    ask_levels: List[Level]
\ No newline at end of file
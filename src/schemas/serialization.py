@@ -0,0 +1,110 @@
+from datetime import datetime
+from typing import List, Optional, TYPE_CHECKING
+from typing_extensions import TypedDict, NotRequired
+from pydantic import TypeAdapter, ConfigDict, UUID4
+from src.schemas.order import OrderStatus, OrderType, OperationDirection, TimeInForce
+from src.schemas.fill import LiquidityRole
+
+if TYPE_CHECKING:
+    from src.dataBase.models.order import OrderORM
+
+# Быстрый путь сериализации ответов: строки из БД превращаются в словари той же формы,
+# что и pydantic-модели ответа, и сразу кодируются в JSON заранее собранными TypeAdapter.
+# Валидация при этом не выполняется - данные уже прошли ее при записи в БД.
+# Схемы адаптеров собираются при первом использовании, а не при импорте (это заметная часть старта воркера).
+
+DEFERRED = ConfigDict(defer_build=True)
+
+class OrderBodyDict(TypedDict):
+    direction: OperationDirection
+    ticker: str
+    qty: int
+    price: NotRequired[int]
+    time_in_force: NotRequired[TimeInForce]
+    stop_price: NotRequired[int]
+    expires_at: NotRequired[datetime]
+
+class OrderDict(TypedDict):
+    __pydantic_config__ = DEFERRED
+    id: UUID4
+    status: OrderStatus
+    user_id: UUID4
+    timestamp: datetime
+    body: OrderBodyDict
+    filled: NotRequired[int]
+
+class LevelDict(TypedDict):
+    price: int
+    qty: int
+
+class L2OrderBookDict(TypedDict):
+    __pydantic_config__ = DEFERRED
+    bid_levels: List[LevelDict]
+    ask_levels: List[LevelDict]
+
+class MarketDataDict(TypedDict):
+    ticker: str
+    best_bid: Optional[int]
+    best_ask: Optional[int]
+    last_price: Optional[int]
+    volume_24h: int
+    bid_levels: List[LevelDict]
+    ask_levels: List[LevelDict]
+
+class InstrumentDict(TypedDict):
+    name: str
+    ticker: str
+
+class TransactionDict(TypedDict):
+    ticker: str
+    amount: int
+    price: int
+    timestamp: datetime
+
+class FillDict(TypedDict):
+    trade_id: UUID4
+    order_id: UUID4
+    ticker: str
+    direction: OperationDirection
+    role: LiquidityRole
+    qty: int
+    price: int
+    timestamp: datetime
+
+order_adapter = TypeAdapter(OrderDict)
+orders_adapter = TypeAdapter(List[OrderDict], config=DEFERRED)
+orderbook_adapter = TypeAdapter(L2OrderBookDict)
+marketdata_adapter = TypeAdapter(List[MarketDataDict], config=DEFERRED)
+transactions_adapter = TypeAdapter(List[TransactionDict], config=DEFERRED)
+instruments_adapter = TypeAdapter(List[InstrumentDict], config=DEFERRED)
+fills_adapter = TypeAdapter(List[FillDict], config=DEFERRED)
+
+def order_to_dict(order: "OrderORM") -> OrderDict:
+    """
+    Собирает словарь в форме LimitOrder/MarketOrder (StopLimitOrder/StopOrder) напрямую из строки БД, без промежуточных моделей.
+    Сработавший стоп-ордер отдается как рыночный или лимитный, но сохраняет stop_price
+    """
+    body: OrderBodyDict = {"direction": order.direction, "ticker": order.ticker, "qty": order.qty}
+    if order.stop_price is not None:
+        body["stop_price"] = order.stop_price
+    if order.type in (OrderType.MARKET, OrderType.STOP):
+        return {
+            "id": order.id,
+            "status": order.status,
+            "user_id": order.user_id,
+            "timestamp": order.timestamp,
+            "body": body,
+        }
+    body["price"] = order.price
+    if order.type == OrderType.LIMIT:
+        body["time_in_force"] = order.time_in_force or TimeInForce.GTC
+    if order.expires_at is not None:
+        body["expires_at"] = order.expires_at
+    return {
+        "id": order.id,
+        "status": order.status,
+        "user_id": order.user_id,
+        "timestamp": order.timestamp,
+        "body": body,
+        "filled": order.filled or 0,
+    }